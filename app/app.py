@@ -9,6 +9,7 @@ import asyncio
 # More info: https://github.com/aio-libs/aiohttp/discussions/6044.
 setattr(asyncio.sslproto._SSLProtocolTransport, "_start_tls_compatible", True)
 import collections
+import hmac
 import random
 import time
 import ujson as json
@@ -18,14 +19,27 @@ from fastapi import FastAPI, \
     Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from internal.extensions.ext_cache import init_instance as init_tiered_cache_instance
+from internal.extensions.ext_cache import instance as tiered_cache_instance
 from internal.extensions.ext_kafka.producer import init_instance as init_kafka_producer_instance
 from internal.extensions.ext_kafka.producer import instance as kafka_producer_instance
 from internal.extensions.ext_mongo.ha import init_instance as init_db_instance
 from internal.extensions.ext_mongo.ha import instance as db_instance
 from internal.extensions.ext_redis import init_instance as init_cache_instance
 from internal.extensions.ext_redis import instance as cache_instance
+from internal.extensions.ext_redis.leaderboard import init_instance as init_leaderboard_instance
+from internal.extensions.ext_redis.leaderboard import instance as leaderboard_instance
 from internal.extensions.ext_redis.keys import CKEY_TOTAL_USER_CNT_KEY, \
-    CKEY_USER_DEVICE_ID_EXT
+    CKEY_ACCOUNT_HASH, \
+    CKEY_USER_HASH, \
+    CKEY_USER_DEVICE_ID_EXT, \
+    ACCOUNT_HASH_LAYOUT, \
+    USER_HASH_LAYOUT, \
+    HFIELD_DEVICE_ID, \
+    HFIELD_DEVICE_TYPE, \
+    HFIELD_JPUSH_REGISTRATION_ID, \
+    hash_fields, \
+    key_prefix
 from internal.infra.alarm import init_alarm_vars, \
     clear_alarm_vars, \
     request_oss_access_token, \
@@ -72,7 +86,10 @@ from routers.h_config import load_business_conf, \
     get_business_conf
 from routers.model import Response
 from starlette.middleware.base import RequestResponseEndpoint
-from typing import Dict
+from typing import Any, \
+    Dict, \
+    List, \
+    Tuple
 
 
 app = FastAPI(
@@ -128,6 +145,8 @@ async def startup_event():
                 "auth_mechanism": settings.MONGODB_AUTH_MECHANISM,
                 "database": settings.MONGODB_DATABASE,
                 "replica_set": settings.MONGODB_REPLICA_SET,
+                "game_result_use_timeseries": settings.MONGODB_GAME_RESULT_USE_TIMESERIES,
+                "game_result_expire_secs": settings.MONGODB_GAME_RESULT_EXPIRE_SECS,
             }
         )
     except Exception as e:
@@ -160,6 +179,20 @@ async def startup_event():
                 "endpoint": settings.REDIS_SERVER_ENDPOINT,
                 "password": settings.REDIS_PASSWORD,
                 "db": settings.REDIS_DB,
+                "cluster_mode": settings.REDIS_CLUSTER_MODE,
+                "codec_compress_threshold": settings.REDIS_CODEC_COMPRESS_THRESHOLD,
+                "hot_key_sample_rate": settings.REDIS_HOT_KEY_SAMPLE_RATE,
+                "max_connections": settings.REDIS_MAX_CONNECTIONS,
+                "pool_timeout": settings.REDIS_POOL_TIMEOUT,
+                "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+                "socket_keepalive": settings.REDIS_SOCKET_KEEPALIVE,
+                "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+                "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                # NOTE: 鉴权中间件每个请求都要查设备ID, 而设备ID几乎不变, 适合走客户端缓存.
+                "client_cache_prefixes": [
+                    key_prefix(CKEY_ACCOUNT_HASH if settings.REDIS_HASH_LAYOUT else CKEY_USER_DEVICE_ID_EXT, env=settings.DEPLOY_ENV),
+                ] if settings.REDIS_CLIENT_CACHE_ENABLED else [],
+                "client_cache_max_entries": settings.REDIS_CLIENT_CACHE_MAX_ENTRIES,
             }
         )
     except Exception as e:
@@ -171,7 +204,17 @@ async def startup_event():
     else:
         loguru_logger.error("Cannot setup redis connection (pool).")
         sys.exit(-1)
-    init_redlock_instance(connections=[cache_instance().get_connection()])
+    # NOTE: Redlock的安全性依赖多个互相独立的节点, 未配置时退化为只用主Redis一个节点.
+    init_redlock_instance(
+        connections=[cache_instance().get_connection()],
+        endpoints=settings.REDLOCK_SERVER_ENDPOINTS,
+        password=settings.REDIS_PASSWORD,
+        node_timeout=settings.REDLOCK_NODE_TIMEOUT,
+        wait_mode=settings.REDLOCK_WAIT_MODE,
+        wait_deadline=settings.REDLOCK_WAIT_DEADLINE,
+        pubsub_conn=cache_instance().get_pubsub_connection(),
+        local_lock=settings.REDLOCK_LOCAL_LOCK,
+    )
     ok, dlock = await redlock_instance().alock(resource="test_redlock_key", ttl=50)
     if not ok:
         loguru_logger.error("Cannot acquire redlock.")
@@ -181,6 +224,15 @@ async def startup_event():
         loguru_logger.error("Cannot release redlock.")
         sys.exit(-1)
     loguru_logger.info("Redlock is ready.")
+    init_leaderboard_instance(conn=cache_instance().get_connection(), env=settings.DEPLOY_ENV)
+    loguru_logger.info("Setup game leaderboard.")
+    init_tiered_cache_instance(
+        conn=cache_instance().get_connection(),
+        env=settings.DEPLOY_ENV,
+        l1_max_entries=settings.TIERED_CACHE_L1_MAX_ENTRIES,
+        pubsub_conn=cache_instance().get_pubsub_connection(),
+    )
+    loguru_logger.info("Setup tiered cache.")
     # Setup kafka producer.
     try:
         init_kafka_producer_instance(
@@ -189,6 +241,19 @@ async def startup_event():
                 "client_id": settings.KAFKA_PRODUCER_CLIENT_ID,
                 "default_topic": settings.KAFKA_PRODUCER_TOPIC,
                 "default_room_event_topic": settings.KAFKA_PRODUCER_ROOM_EVENT_TOPIC,
+                "send_queue_size": settings.KAFKA_PRODUCER_SEND_QUEUE_SIZE,
+                "ack_timeout_secs": settings.KAFKA_PRODUCER_ACK_TIMEOUT,
+                "room_event_wait_ack": settings.KAFKA_PRODUCER_ROOM_EVENT_WAIT_ACK,
+                "api_version": settings.KAFKA_PRODUCER_API_VERSION,
+                "linger_ms": settings.KAFKA_PRODUCER_LINGER_MS,
+                "batch_size": settings.KAFKA_PRODUCER_BATCH_SIZE,
+                "compression_type": settings.KAFKA_PRODUCER_COMPRESSION_TYPE,
+                "acks": settings.KAFKA_PRODUCER_ACKS,
+                "topic_acks": settings.KAFKA_PRODUCER_TOPIC_ACKS,
+                "spool_dir": settings.KAFKA_PRODUCER_SPOOL_DIR,
+                "spool_max_bytes": settings.KAFKA_PRODUCER_SPOOL_MAX_BYTES,
+                "spool_segment_bytes": settings.KAFKA_PRODUCER_SPOOL_SEGMENT_BYTES,
+                "spool_fsync_interval_ms": settings.KAFKA_PRODUCER_SPOOL_FSYNC_INTERVAL_MS,
             }
         )
     except Exception as e:
@@ -534,15 +599,81 @@ async def init_cache() -> bool:
         loguru_logger.error("Failed to init cache data.")
         return False
     loguru_logger.info("Inited cache data.")
+    if settings.CACHE_WARM_UP_ENABLED:
+        # NOTE: 预热失败不影响启动, 只是退化为按需回源.
+        try:
+            await asyncio.wait_for(warm_up_cache(), timeout=settings.CACHE_WARM_UP_TIMEOUT)
+        except asyncio.TimeoutError:
+            loguru_logger.warning(f"Cache warm-up did not finish within {settings.CACHE_WARM_UP_TIMEOUT}s.")
     return True
 
 
+async def warm_up_cache():
+    '''
+    启动时预加载热点数据: 已安装的游戏和AI玩家进入两级缓存, 最近活跃用户的设备映射写入Redis,
+    避免刚发布后的几分钟内大量请求同时击穿到MongoDB.
+    '''
+    st = time.time()
+    sem = asyncio.Semaphore(settings.CACHE_WARM_UP_CONCURRENCY)
+
+    async def _load(coro):
+        async with sem:
+            return await coro
+
+    await db_instance().list_games()
+    game_indexes, _ = await db_instance().list_game_indexes()
+    aids, _ = await db_instance().list_ai_player_ids()
+    await asyncio.gather(
+        *[_load(db_instance().query_game(game_index)) for game_index in game_indexes],
+        *[_load(db_instance().query_ai_player(aid)) for aid in aids],
+    )
+    loguru_logger.info(f"Warmed up {len(game_indexes)} games and {len(aids)} ai players.")
+
+    users, _ = await db_instance().list_recently_active_users(
+        since_ts=int(time.time()) - settings.CACHE_WARM_UP_RECENT_USER_SECS,
+        limit=settings.CACHE_WARM_UP_RECENT_USER_LIMIT,
+    )
+    env = settings.DEPLOY_ENV
+    for i in range(0, len(users), 500):
+        user_pairs: List[Tuple[Dict[str, Any], Dict[str, str], Dict[str, str]]] = []
+        for user in users[i:i + 500]:
+            # NOTE: 设备ID决定鉴权结果, 被有意删除的映射不能由预热复活, 因此不预热设备ID, 只预热推送相关的映射.
+            user_values = {
+                HFIELD_DEVICE_TYPE: user.get("device_type"),
+                HFIELD_JPUSH_REGISTRATION_ID: user.get("jpush_registration_id"),
+            }
+            user_values = {k: v for k, v in user_values.items() if v is not None and v != ""}
+            account_values = {k: v for k, v in user_values.items() if k in ACCOUNT_HASH_LAYOUT}
+            user_pairs.append((user, user_values, account_values))
+        # NOTE: 只补齐缺失的值, 不覆盖写入方的更新. 只预热当前读取的布局, 读hash时写入方已切换到set_hash_fields.
+        batch = cache_instance().batch()
+        for user, user_values, account_values in user_pairs:
+            if settings.REDIS_HASH_LAYOUT:
+                batch.cache_hash_fields_if_absent(CKEY_USER_HASH.format(env=env, uid=user["uid"]), user_values)
+                batch.cache_hash_fields_if_absent(CKEY_ACCOUNT_HASH.format(env=env, account=user["account"]), account_values)
+                continue
+            for field, key in hash_fields(USER_HASH_LAYOUT, list(user_values), env=env, uid=user["uid"]).items():
+                batch.cache_string_if_absent(key, user_values[field])
+            for field, key in hash_fields(ACCOUNT_HASH_LAYOUT, list(account_values), env=env, account=user["account"]).items():
+                batch.cache_string_if_absent(key, account_values[field])
+        await batch.execute()
+    loguru_logger.info(f"Warmed up device mappings for {len(users)} recently active users, cost:{time.time() - st:.2f}s.")
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
     loguru_logger.info("Stoping GameCompanionPlatformApiGatewayService Server...")
     # Release mongodb connection (pool).
     await db_instance().close()
     loguru_logger.info("Release mongodb connection (pool).")
+    # Stop tiered cache invalidation listener.
+    await tiered_cache_instance().stop()
+    loguru_logger.info("Stop tiered cache.")
+    # Flush pending leaderboard updates.
+    await leaderboard_instance().stop()
+    loguru_logger.info("Flush game leaderboard.")
+    # Release redlock connections.
+    await redlock_instance().aclose()
     # Release redis connection (pool).
     await cache_instance().close()
     loguru_logger.info("Release redis connection (pool).")
@@ -579,12 +710,50 @@ async def index():
     return Response(code=0, msg="OK")
 
 
+@app.get("/metrics")
+async def metrics():
+    return JSONResponse(
+        content={
+            "code": 0,
+            "msg": "OK",
+            "data": {
+                "redis": {
+                    "pool": cache_instance().pool_stats(),
+                    "client_cache": cache_instance().client_cache_stats(),
+                    "codec": cache_instance().codec_stats(),
+                    "commands": cache_instance().metrics_stats(),
+                },
+                "tiered_cache": tiered_cache_instance().stats(),
+                "redlock": redlock_instance().metrics_stats(),
+                "kafka_producer": kafka_producer_instance().stats(),
+            },
+        },
+        status_code=200,
+    )
+
+
+@app.get("/debug/locks")
+async def debug_locks():
+    return JSONResponse(
+        content={
+            "code": 0,
+            "msg": "OK",
+            "data": {
+                "held": redlock_instance().held_locks(),
+            },
+        },
+        status_code=200,
+    )
+
+
 @app.middleware("http")
 async def recover_panic_and_report_latency_middleware(request: Request, call_next: RequestResponseEndpoint) -> Response:
     if (request.method == "HEAD" and request.url.path == "/") or \
         (request.method == "GET" and request.url.path == "/favicon.ico") or \
         (request.method == "GET" and request.url.path == "/docs") or \
-        (request.method == "GET" and request.url.path == "/openapi.json"):
+        (request.method == "GET" and request.url.path == "/openapi.json") or \
+        (request.method == "GET" and request.url.path == "/metrics") or \
+        (request.method == "GET" and request.url.path == "/debug/locks"):
         response = await call_next(request)
         return response
     else:
@@ -604,7 +773,7 @@ async def recover_panic_and_report_latency_middleware(request: Request, call_nex
 
 def check_app_version_core(method: str, api: str, headers: Dict[str, str]) -> bool:
     # The following paths are always allowed:
-    if api == "/" or api[1:] in ["docs", "openapi.json", "favicon.ico"]:
+    if api == "/" or api[1:] in ["docs", "openapi.json", "favicon.ico", "metrics", "debug/locks"]:
         return True
     if api.split("?")[0] in [
         "/api/v1/game/result",
@@ -633,7 +802,25 @@ async def check_app_version_middleware(request: Request, call_next: RequestRespo
     return await call_next(request)
 
 
+OPS_APIS = [
+    "/metrics",
+    "/debug/locks",
+]
+
+
+def check_ops_token(headers: Dict[str, str]) -> bool:
+    '''
+    运维接口只接受携带x-ops-token的内部调用, 未配置OPS_API_TOKEN时一律拒绝.
+    '''
+    token = headers.get("x-ops-token", "")
+    if len(settings.OPS_API_TOKEN) == 0 or len(token) == 0:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), settings.OPS_API_TOKEN.encode("utf-8"))
+
+
 async def check_authentication_core(method: str, api: str, headers: Dict[str, str]) -> bool:
+    if api in OPS_APIS:
+        return check_ops_token(headers)
     if api == "/" or api[1:] in ["docs", "openapi.json", "favicon.ico"]:
         return True
     if api.split("?")[0] in [
@@ -648,6 +835,12 @@ async def check_authentication_core(method: str, api: str, headers: Dict[str, st
     
     if account == SYS_ACCOUNT:
         device_id = SYS_DEVICE_ID
+    elif settings.REDIS_HASH_LAYOUT:
+        values, _ = await cache_instance().get_hash_fields(
+            key=CKEY_ACCOUNT_HASH.format(env=settings.DEPLOY_ENV, account=account),
+            fields=[HFIELD_DEVICE_ID],
+        )
+        device_id = values[HFIELD_DEVICE_ID]
     else:
         device_id, _, _ = await cache_instance().exist_or_get_string(key=CKEY_USER_DEVICE_ID_EXT.format(
             env=settings.DEPLOY_ENV, account=account))
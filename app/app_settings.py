@@ -2,10 +2,12 @@
 import os
 
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Dict, \
+    List
 
 DEFAULTS = {
     "SKIP_APP_VERSION_CHECK": "false",
+    "OPS_API_TOKEN": "",  # x-ops-token for /metrics and /debug/locks, empty to disable
     "APP_VERSION": "0.1.0",
     "DEPLOY_ENV": "dev",
     "LOG_SERVICE_NAME": "GameCompanionPlatformApiGatewayService",
@@ -20,9 +22,34 @@ DEFAULTS = {
     "MONGODB_AUTH_MECHANISM": "SCRAM-SHA-256",
     "MONGODB_DATABASE": "ai_play",
     "MONGODB_REPLICA_SET": "replicaset",
+    "MONGODB_GAME_RESULT_USE_TIMESERIES": "false",
+    "MONGODB_GAME_RESULT_EXPIRE_SECS": "7776000",
     "REDIS_SERVER_ENDPOINT": "localhost:6379",
     "REDIS_PASSWORD": "sOmE_sEcUrE_pAsS",
     "REDIS_DB": "0",
+    "REDIS_CLUSTER_MODE": "false",
+    "REDIS_HASH_LAYOUT": "false",  # read user/account state from hashes; enable after migrate_keys --hash-layout
+    "REDIS_CODEC_COMPRESS_THRESHOLD": "1024",
+    "REDIS_HOT_KEY_SAMPLE_RATE": "0.05",
+    "REDIS_MAX_CONNECTIONS": "64",
+    "REDIS_POOL_TIMEOUT": "2",
+    "REDIS_HEALTH_CHECK_INTERVAL": "30",
+    "REDIS_SOCKET_KEEPALIVE": "true",
+    "REDIS_SOCKET_TIMEOUT": "5",
+    "REDIS_SOCKET_CONNECT_TIMEOUT": "2",
+    "REDIS_CLIENT_CACHE_ENABLED": "true",
+    "REDIS_CLIENT_CACHE_MAX_ENTRIES": "10000",
+    "TIERED_CACHE_L1_MAX_ENTRIES": "4096",
+    "REDLOCK_SERVER_ENDPOINTS": "",
+    "REDLOCK_NODE_TIMEOUT": "0.1",  # only for dedicated REDLOCK_SERVER_ENDPOINTS nodes
+    "REDLOCK_WAIT_MODE": "notify",  # or "backoff", "poll"
+    "REDLOCK_WAIT_DEADLINE": "2",
+    "REDLOCK_LOCAL_LOCK": "true",
+    "CACHE_WARM_UP_ENABLED": "true",
+    "CACHE_WARM_UP_TIMEOUT": "30",
+    "CACHE_WARM_UP_CONCURRENCY": "16",
+    "CACHE_WARM_UP_RECENT_USER_SECS": "86400",
+    "CACHE_WARM_UP_RECENT_USER_LIMIT": "5000",
     "CELERY_BROKER_URL": "redis://:sOmE_sEcUrE_pAsS@localhost:6379/2",
     "CELERY_BROKER_USE_SSL": "false",
     "CELERY_RESULT_BACKEND_URL": "redis://:sOmE_sEcUrE_pAsS@localhost:6379/2",
@@ -31,6 +58,19 @@ DEFAULTS = {
     "KAFKA_PRODUCER_CLIENT_ID": "GameCompanionPlatformApiGatewayService_dev",
     "KAFKA_PRODUCER_TOPIC": "game-companion-platform-game-result-dev",
     "KAFKA_PRODUCER_ROOM_EVENT_TOPIC": "game-companion-platform-room-event-dev",
+    "KAFKA_PRODUCER_SEND_QUEUE_SIZE": "10000",
+    "KAFKA_PRODUCER_ACK_TIMEOUT": "12",  # must exceed max_block_ms + request_timeout_ms + linger_ms
+    "KAFKA_PRODUCER_ROOM_EVENT_WAIT_ACK": "false",
+    "KAFKA_PRODUCER_API_VERSION": "0.10.2",
+    "KAFKA_PRODUCER_LINGER_MS": "20",
+    "KAFKA_PRODUCER_BATCH_SIZE": "131072",
+    "KAFKA_PRODUCER_COMPRESSION_TYPE": "lz4",  # or "zstd" (api version >= 2.1.0), "gzip", "snappy", "none"
+    "KAFKA_PRODUCER_ACKS": "1",
+    "KAFKA_PRODUCER_SPOOL_DIR": "./kafka_spool",  # empty to disable
+    "KAFKA_PRODUCER_SPOOL_MAX_BYTES": "1073741824",  # per worker, each worker process claims its own slot under the spool dir
+    "KAFKA_PRODUCER_SPOOL_SEGMENT_BYTES": "67108864",
+    "KAFKA_PRODUCER_SPOOL_FSYNC_INTERVAL_MS": "200",
+    "KAFKA_PRODUCER_TOPIC_ACKS": "",  # e.g. "game-companion-platform-game-result-dev=all,game-companion-platform-room-event-dev=0"
     "OSS_GRPC_ENDPOINT": "localhost:17774",
     "OSS_BUCKET": "go",
     "CAS_GRPC_ENDPOINT": "localhost:17375",
@@ -62,12 +102,17 @@ def get_int_env(key: str) -> int:
     return int(get_env(key))
 
 
+def get_float_env(key: str) -> float:
+    return float(get_env(key))
+
+
 def get_array_env(key: str) -> List[str]:
     return get_env(key).split(",")
 
 
 class AppSettings(BaseSettings):
     SKIP_APP_VERSION_CHECK: bool = get_bool_env("SKIP_APP_VERSION_CHECK")
+    OPS_API_TOKEN: str = get_env("OPS_API_TOKEN")
     APP_VERSION: str = get_env("APP_VERSION")
     DEPLOY_ENV: str = get_env("DEPLOY_ENV")
     LOG_SERVICE_NAME: str = get_env("LOG_SERVICE_NAME")
@@ -82,9 +127,35 @@ class AppSettings(BaseSettings):
     MONGODB_AUTH_MECHANISM: str = get_env("MONGODB_AUTH_MECHANISM")
     MONGODB_DATABASE: str = get_env("MONGODB_DATABASE")
     MONGODB_REPLICA_SET: str = get_env("MONGODB_REPLICA_SET")
+    MONGODB_GAME_RESULT_USE_TIMESERIES: bool = get_bool_env("MONGODB_GAME_RESULT_USE_TIMESERIES")
+    MONGODB_GAME_RESULT_EXPIRE_SECS: int = get_int_env("MONGODB_GAME_RESULT_EXPIRE_SECS")
     REDIS_SERVER_ENDPOINT: str = get_env("REDIS_SERVER_ENDPOINT")
     REDIS_PASSWORD: str = get_env("REDIS_PASSWORD")
     REDIS_DB: int = get_int_env("REDIS_DB")
+    REDIS_CLUSTER_MODE: bool = get_bool_env("REDIS_CLUSTER_MODE")
+    REDIS_HASH_LAYOUT: bool = get_bool_env("REDIS_HASH_LAYOUT")
+    REDIS_CODEC_COMPRESS_THRESHOLD: int = get_int_env("REDIS_CODEC_COMPRESS_THRESHOLD")
+    REDIS_HOT_KEY_SAMPLE_RATE: float = get_float_env("REDIS_HOT_KEY_SAMPLE_RATE")
+    REDIS_MAX_CONNECTIONS: int = get_int_env("REDIS_MAX_CONNECTIONS")
+    REDIS_POOL_TIMEOUT: int = get_int_env("REDIS_POOL_TIMEOUT")
+    REDIS_HEALTH_CHECK_INTERVAL: int = get_int_env("REDIS_HEALTH_CHECK_INTERVAL")
+    REDIS_SOCKET_KEEPALIVE: bool = get_bool_env("REDIS_SOCKET_KEEPALIVE")
+    REDIS_SOCKET_TIMEOUT: int = get_int_env("REDIS_SOCKET_TIMEOUT")
+    REDIS_SOCKET_CONNECT_TIMEOUT: int = get_int_env("REDIS_SOCKET_CONNECT_TIMEOUT")
+    REDIS_CLIENT_CACHE_ENABLED: bool = get_bool_env("REDIS_CLIENT_CACHE_ENABLED")
+    REDIS_CLIENT_CACHE_MAX_ENTRIES: int = get_int_env("REDIS_CLIENT_CACHE_MAX_ENTRIES")
+    TIERED_CACHE_L1_MAX_ENTRIES: int = get_int_env("TIERED_CACHE_L1_MAX_ENTRIES")
+    CACHE_WARM_UP_ENABLED: bool = get_bool_env("CACHE_WARM_UP_ENABLED")
+    CACHE_WARM_UP_TIMEOUT: int = get_int_env("CACHE_WARM_UP_TIMEOUT")
+    CACHE_WARM_UP_CONCURRENCY: int = get_int_env("CACHE_WARM_UP_CONCURRENCY")
+    CACHE_WARM_UP_RECENT_USER_SECS: int = get_int_env("CACHE_WARM_UP_RECENT_USER_SECS")
+    CACHE_WARM_UP_RECENT_USER_LIMIT: int = get_int_env("CACHE_WARM_UP_RECENT_USER_LIMIT")
+    # 逗号分隔的独立Redis节点列表 (非集群, 互不复制), 为空时复用主Redis连接作为唯一节点
+    REDLOCK_SERVER_ENDPOINTS: List[str] = [x for x in get_array_env("REDLOCK_SERVER_ENDPOINTS") if len(x) > 0]
+    REDLOCK_NODE_TIMEOUT: float = get_float_env("REDLOCK_NODE_TIMEOUT")
+    REDLOCK_WAIT_MODE: str = get_env("REDLOCK_WAIT_MODE")
+    REDLOCK_WAIT_DEADLINE: float = get_float_env("REDLOCK_WAIT_DEADLINE")
+    REDLOCK_LOCAL_LOCK: bool = get_bool_env("REDLOCK_LOCAL_LOCK")
     CELERY_BROKER_URL: str = get_env("CELERY_BROKER_URL")
     CELERY_BROKER_USE_SSL: bool = get_bool_env("CELERY_BROKER_USE_SSL")
     CELERY_RESULT_BACKEND_URL: str = get_env("CELERY_RESULT_BACKEND_URL")
@@ -93,6 +164,22 @@ class AppSettings(BaseSettings):
     KAFKA_PRODUCER_CLIENT_ID: str = get_env("KAFKA_PRODUCER_CLIENT_ID")
     KAFKA_PRODUCER_TOPIC: str = get_env("KAFKA_PRODUCER_TOPIC")
     KAFKA_PRODUCER_ROOM_EVENT_TOPIC: str = get_env("KAFKA_PRODUCER_ROOM_EVENT_TOPIC")
+    KAFKA_PRODUCER_SEND_QUEUE_SIZE: int = get_int_env("KAFKA_PRODUCER_SEND_QUEUE_SIZE")
+    KAFKA_PRODUCER_ACK_TIMEOUT: float = get_float_env("KAFKA_PRODUCER_ACK_TIMEOUT")
+    # 为false时房间事件只放入发送队列不等待broker确认, 投递失败时异步告警
+    KAFKA_PRODUCER_ROOM_EVENT_WAIT_ACK: bool = get_bool_env("KAFKA_PRODUCER_ROOM_EVENT_WAIT_ACK")
+    KAFKA_PRODUCER_API_VERSION: str = get_env("KAFKA_PRODUCER_API_VERSION")
+    KAFKA_PRODUCER_LINGER_MS: int = get_int_env("KAFKA_PRODUCER_LINGER_MS")
+    KAFKA_PRODUCER_BATCH_SIZE: int = get_int_env("KAFKA_PRODUCER_BATCH_SIZE")
+    KAFKA_PRODUCER_COMPRESSION_TYPE: str = get_env("KAFKA_PRODUCER_COMPRESSION_TYPE")
+    KAFKA_PRODUCER_ACKS: str = get_env("KAFKA_PRODUCER_ACKS")
+    KAFKA_PRODUCER_SPOOL_DIR: str = get_env("KAFKA_PRODUCER_SPOOL_DIR")
+    KAFKA_PRODUCER_SPOOL_MAX_BYTES: int = get_int_env("KAFKA_PRODUCER_SPOOL_MAX_BYTES")
+    KAFKA_PRODUCER_SPOOL_SEGMENT_BYTES: int = get_int_env("KAFKA_PRODUCER_SPOOL_SEGMENT_BYTES")
+    KAFKA_PRODUCER_SPOOL_FSYNC_INTERVAL_MS: int = get_int_env("KAFKA_PRODUCER_SPOOL_FSYNC_INTERVAL_MS")
+    KAFKA_PRODUCER_TOPIC_ACKS: Dict[str, str] = {
+        x.split("=")[0]: x.split("=")[1] for x in get_array_env("KAFKA_PRODUCER_TOPIC_ACKS") if len(x) > 0
+    }
     OSS_GRPC_ENDPOINT: str = get_env("OSS_GRPC_ENDPOINT")
     OSS_BUCKET: str = get_env("OSS_BUCKET")
     CAS_GRPC_ENDPOINT: str = get_env("CAS_GRPC_ENDPOINT")
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import copy
+import functools
+import inspect
+import os
+import redis.asyncio as aio_redis
+import redis.exceptions as redis_exceptions
+import socket
+import time
+import ujson as json
+
+from bson import json_util
+from collections import OrderedDict, defaultdict
+from internal.infra.alarm import perror
+from loguru import logger as loguru_logger
+from typing import Any, \
+    Awaitable, \
+    Callable, \
+    Dict, \
+    Optional, \
+    Set, \
+    Tuple
+
+# 二级缓存的key, 以命名空间作为hash tag, 集群模式下整体删除命名空间时所有key都在同一个slot上
+CKEY_TIERED_CACHE_ENTRY = "gcp_ags_{env}_cache_{{{namespace}}}_{key}"
+# 二级缓存中某个命名空间下已写入的key集合, 用于整体删除命名空间
+CKEY_TIERED_CACHE_NAMESPACE_KEYS = "gcp_ags_{env}_cache_{{{namespace}}}_keys"
+# 二级缓存中某个命名空间下各key的版本号, 每次失效时递增, 回源结果只有在版本号未变时才写入
+CKEY_TIERED_CACHE_VERSIONS = "gcp_ags_{env}_cache_{{{namespace}}}_versions"
+# 跨进程失效通知的频道
+CKEY_TIERED_CACHE_INVALIDATION_CHANNEL = "gcp_ags_{env}_cache_invalidation"
+# 版本号hash中代表整个命名空间的字段
+_NAMESPACE_VERSION_FIELD = "__namespace__"
+
+# KEYS[1]: 缓存key; KEYS[2]: 命名空间key集合; KEYS[3]: 版本号hash
+# ARGV[1]: 命名空间版本号字段; ARGV[2]: 缓存key名; ARGV[3], ARGV[4]: 回源前读到的命名空间和key的版本号; ARGV[5]: 缓存值; ARGV[6]: 过期秒数
+# 回源期间发生过失效(版本号变化)时不写入并返回0, 避免旧值在失效之后又被写回.
+TIERED_CACHE_FILL_SCRIPT = """local versions = redis.call("HMGET", KEYS[3], ARGV[1], ARGV[2])
+if (versions[1] or "0") ~= ARGV[3] or (versions[2] or "0") ~= ARGV[4] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[5], "EX", ARGV[6])
+redis.call("SADD", KEYS[2], ARGV[2])
+redis.call("EXPIRE", KEYS[2], 86400)
+return 1"""
+
+class _Entry(object):
+
+    __slots__ = ("value", "soft_expire_at", "hard_expire_at")
+
+    def __init__(self, value: Any, soft_expire_at: float, hard_expire_at: float) -> None:
+        self.value = value
+        self.soft_expire_at = soft_expire_at
+        self.hard_expire_at = hard_expire_at
+
+
+class _NamespaceStats(object):
+
+    __slots__ = ("l1_hits", "l2_hits", "misses", "stale_hits", "loads", "load_failures", "coalesced")
+
+    def __init__(self) -> None:
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.coalesced = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        total = self.l1_hits + self.l2_hits + self.misses
+        return {
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "loads": self.loads,
+            "load_failures": self.load_failures,
+            "coalesced": self.coalesced,
+            "hit_ratio": (self.l1_hits + self.l2_hits) / total if total > 0 else 0.0,
+        }
+
+
+class TieredCache(object):
+    '''
+    两级缓存: 进程内TTL LRU (L1) + Redis (L2).
+
+    - 同一进程内对同一个key的并发回源会被合并为一次 (single-flight), 回源在独立的任务中执行, 发起者被取消不影响其他等待者.
+    - 回源期间发生过失效的结果不写入L1/L2, 进程内按进行中的回源标记, 跨进程按L2中的版本号判断.
+    - 软过期之后、硬过期之前的数据会先返回旧值, 同时在后台刷新 (stale-while-revalidate).
+    - 回源结果为None时按negative_ttl缓存, 避免不存在的数据反复击穿到数据库.
+    - 写操作通过Redis pub/sub通知所有进程删除各自的L1副本.
+    '''
+
+    def __init__(self, conn: aio_redis.Redis, env: str, l1_max_entries: int = 4096, pubsub_conn: Optional[aio_redis.Redis] = None) -> None:
+        self._conn = conn
+        # NOTE: 集群客户端不支持pub/sub, 需要单独提供一个连到任意节点的连接, PUBLISH会在集群内广播.
+        self._pubsub_conn = pubsub_conn if pubsub_conn is not None else conn
+        self._env = env
+        self._l1_max_entries = l1_max_entries
+        self._l1: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        # 进行中的回源/L2读取计数, 以及其间被失效过的key
+        self._fills: Dict[Tuple[str, str], int] = {}
+        self._stale_fills: Set[Tuple[str, str]] = set()
+        self._stats: Dict[str, _NamespaceStats] = defaultdict(_NamespaceStats)
+        self._channel = CKEY_TIERED_CACHE_INVALIDATION_CHANNEL.format(env=env)
+        self._origin = f"{socket.gethostname()}_{os.getpid()}"
+        self._listen_task: Optional[asyncio.Task] = None
+        self._fill_script = conn.register_script(TIERED_CACHE_FILL_SCRIPT)
+
+    def _l2_key(self, namespace: str, key: str) -> str:
+        return CKEY_TIERED_CACHE_ENTRY.format(env=self._env, namespace=namespace, key=key)
+
+    def _l1_get(self, namespace: str, key: str) -> Optional[_Entry]:
+        entry = self._l1.get((namespace, key))
+        if entry is None:
+            return None
+        if entry.hard_expire_at <= time.time():
+            del self._l1[(namespace, key)]
+            return None
+        self._l1.move_to_end((namespace, key))
+        return entry
+
+    def _l1_set(self, namespace: str, key: str, entry: _Entry):
+        self._l1[(namespace, key)] = entry
+        self._l1.move_to_end((namespace, key))
+        while len(self._l1) > self._l1_max_entries:
+            self._l1.popitem(last=False)
+
+    def _l1_drop(self, namespace: str, key: Optional[str]):
+        if key is not None:
+            self._l1.pop((namespace, key), None)
+            if (namespace, key) in self._fills:
+                self._stale_fills.add((namespace, key))
+        else:
+            for k in [k for k in self._l1 if k[0] == namespace]:
+                del self._l1[k]
+            self._stale_fills.update([k for k in self._fills if k[0] == namespace])
+
+    def _l1_clear(self):
+        self._l1.clear()
+        self._stale_fills.update(self._fills)
+
+    def _begin_fill(self, namespace: str, key: str):
+        self._fills[(namespace, key)] = self._fills.get((namespace, key), 0) + 1
+
+    def _end_fill(self, namespace: str, key: str) -> bool:
+        '''
+        结束一次回源/L2读取, 返回其间是否没有发生过失效.
+        '''
+        k = (namespace, key)
+        valid = k not in self._stale_fills
+        self._fills[k] -= 1
+        if self._fills[k] == 0:
+            del self._fills[k]
+            self._stale_fills.discard(k)
+        return valid
+
+    async def _l2_get(self, namespace: str, key: str) -> Optional[_Entry]:
+        try:
+            raw = await self._conn.execute_command("GET", self._l2_key(namespace, key))
+            if raw is None:
+                return None
+            envelope = json_util.loads(raw)
+            return _Entry(envelope["v"], envelope["s"], envelope["h"])
+        except redis_exceptions.RedisError as e:
+            loguru_logger.warning(f"Failed to read L2 cache for {namespace}:{key}, err:{e}.")
+            return None
+
+    async def _l2_version(self, namespace: str, key: str) -> Optional[Tuple[str, str]]:
+        try:
+            versions_key = CKEY_TIERED_CACHE_VERSIONS.format(env=self._env, namespace=namespace)
+            ns_ver, key_ver = await self._conn.execute_command("HMGET", versions_key, _NAMESPACE_VERSION_FIELD, key)
+            return (
+                ns_ver.decode("utf-8") if ns_ver is not None else "0",
+                key_ver.decode("utf-8") if key_ver is not None else "0",
+            )
+        except redis_exceptions.RedisError as e:
+            loguru_logger.warning(f"Failed to read L2 cache version for {namespace}:{key}, err:{e}.")
+            return None
+
+    async def _l2_set(self, namespace: str, key: str, entry: _Entry, version: Optional[Tuple[str, str]]) -> bool:
+        '''
+        按回源前读到的版本号条件写入L2, 版本号已变化时返回False. 读不到版本号时不写L2.
+        '''
+        if version is None:
+            return True
+        try:
+            ttl = max(int(entry.hard_expire_at - time.time()), 1)
+            raw = json_util.dumps({"v": entry.value, "s": entry.soft_expire_at, "h": entry.hard_expire_at})
+            # NOTE: 集合里残留已过期的key无妨, 删除命名空间时DEL不存在的key是无害的.
+            stored = await self._fill_script(
+                keys=[
+                    self._l2_key(namespace, key),
+                    CKEY_TIERED_CACHE_NAMESPACE_KEYS.format(env=self._env, namespace=namespace),
+                    CKEY_TIERED_CACHE_VERSIONS.format(env=self._env, namespace=namespace),
+                ],
+                args=[_NAMESPACE_VERSION_FIELD, key, version[0], version[1], raw, ttl],
+            )
+            return stored == 1
+        except redis_exceptions.RedisError as e:
+            loguru_logger.warning(f"Failed to write L2 cache for {namespace}:{key}, err:{e}.")
+            return True
+
+    async def _fill(
+            self,
+            namespace: str,
+            key: str,
+            loader: Callable[[], Awaitable[Tuple[Any, bool]]],
+            ttl: float,
+            stale_ttl: float,
+            negative_ttl: float,
+        ) -> Tuple[Any, bool]:
+        self._stats[namespace].loads += 1
+        self._begin_fill(namespace, key)
+        try:
+            version = await self._l2_version(namespace, key)
+            value, done = await loader()
+            if not done:
+                self._stats[namespace].load_failures += 1
+                return (value, done)
+            now = time.time()
+            if value is None:
+                entry = _Entry(None, now + negative_ttl, now + negative_ttl)
+            else:
+                entry = _Entry(value, now + ttl, now + ttl + stale_ttl)
+            stored = await self._l2_set(namespace, key, entry, version)
+        except BaseException:
+            self._stats[namespace].load_failures += 1
+            raise
+        finally:
+            valid = self._end_fill(namespace, key)
+        if valid and stored:
+            self._l1_set(namespace, key, entry)
+        return (value, done)
+
+    def _on_fill_done(self, namespace: str, key: str, task: asyncio.Task):
+        if self._inflight.get((namespace, key)) is task:
+            del self._inflight[(namespace, key)]
+        # 没有其他等待者时避免"Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def _load(
+            self,
+            namespace: str,
+            key: str,
+            loader: Callable[[], Awaitable[Tuple[Any, bool]]],
+            ttl: float,
+            stale_ttl: float,
+            negative_ttl: float,
+        ) -> Tuple[Any, bool]:
+        task = self._inflight.get((namespace, key))
+        if task is not None:
+            self._stats[namespace].coalesced += 1
+        else:
+            # NOTE: 回源放在独立的任务里, 发起回源的调用方被取消时不会把CancelledError传给其他等待者.
+            task = asyncio.get_event_loop().create_task(self._fill(namespace, key, loader, ttl, stale_ttl, negative_ttl))
+            task.add_done_callback(functools.partial(self._on_fill_done, namespace, key))
+            self._inflight[(namespace, key)] = task
+        return await asyncio.shield(task)
+
+    def _revalidate(self, namespace: str, key: str, loader, ttl: float, stale_ttl: float, negative_ttl: float):
+        if (namespace, key) in self._inflight:
+            return
+
+        async def _run():
+            try:
+                await self._load(namespace, key, loader, ttl, stale_ttl, negative_ttl)
+            except Exception as e:
+                await perror(f"Failed to revalidate cache for {namespace}:{key}, err:{e}")
+
+        asyncio.get_event_loop().create_task(_run())
+
+    async def get_or_load(
+            self,
+            namespace: str,
+            key: str,
+            loader: Callable[[], Awaitable[Tuple[Any, bool]]],
+            ttl: float = 60,
+            stale_ttl: float = 30,
+            negative_ttl: float = 5,
+        ) -> Tuple[Any, bool]:
+        stats = self._stats[namespace]
+        now = time.time()
+
+        entry = self._l1_get(namespace, key)
+        if entry is not None:
+            stats.l1_hits += 1
+        else:
+            self._begin_fill(namespace, key)
+            try:
+                entry = await self._l2_get(namespace, key)
+            finally:
+                valid = self._end_fill(namespace, key)
+            if entry is not None and entry.hard_expire_at > now:
+                stats.l2_hits += 1
+                if valid:
+                    self._l1_set(namespace, key, entry)
+            else:
+                entry = None
+
+        if entry is None:
+            stats.misses += 1
+            value, done = await self._load(namespace, key, loader, ttl, stale_ttl, negative_ttl)
+            return (copy.deepcopy(value), done)
+
+        if entry.soft_expire_at <= now:
+            stats.stale_hits += 1
+            self._revalidate(namespace, key, loader, ttl, stale_ttl, negative_ttl)
+        return (copy.deepcopy(entry.value), True)
+
+    async def invalidate(self, namespace: str, key: Optional[str] = None) -> bool:
+        '''
+        删除缓存并通知其他进程, key为None时删除整个命名空间.
+        '''
+        done = False
+        self._l1_drop(namespace, key)
+        try:
+            keys_key = CKEY_TIERED_CACHE_NAMESPACE_KEYS.format(env=self._env, namespace=namespace)
+            versions_key = CKEY_TIERED_CACHE_VERSIONS.format(env=self._env, namespace=namespace)
+            # NOTE: 先递增版本号再删除, 删除之后不会再有回源前读到旧版本号的结果写入.
+            pipe = self._conn.pipeline(transaction=False)
+            pipe.execute_command("HINCRBY", versions_key, key if key is not None else _NAMESPACE_VERSION_FIELD, 1)
+            pipe.execute_command("EXPIRE", versions_key, 86400)
+            if key is not None:
+                pipe.execute_command("DEL", self._l2_key(namespace, key))
+                pipe.execute_command("SREM", keys_key, key)
+                await pipe.execute()
+            else:
+                pipe.execute_command("SMEMBERS", keys_key)
+                _, _, members = await pipe.execute()
+                keys = [self._l2_key(namespace, m.decode("utf-8")) for m in members]
+                await self._conn.execute_command("DEL", keys_key, *keys)
+            await self._pubsub_conn.publish(self._channel, json.dumps({"o": self._origin, "ns": namespace, "k": key}))
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to invalidate cache for {namespace}:{key}.")
+        except Exception as e:
+            await perror(f"Failed to invalidate cache for {namespace}:{key}, err:{e}")
+        finally:
+            return done
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "l1_entries": len(self._l1),
+            "l1_max_entries": self._l1_max_entries,
+            "namespaces": {ns: x.to_dict() for ns, x in self._stats.items()},
+        }
+
+    async def _listen(self):
+        while True:
+            pubsub = self._pubsub_conn.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self._channel)
+                async for msg in pubsub.listen():
+                    data = json.loads(msg["data"])
+                    if data["o"] != self._origin:
+                        self._l1_drop(data["ns"], data["k"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 订阅中断期间可能错过失效通知, 保守起见清空整个L1
+                self._l1_clear()
+                loguru_logger.warning(f"Cache invalidation listener interrupted, err:{e}.")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def start(self):
+        if self._listen_task is None:
+            self._listen_task = asyncio.get_event_loop().create_task(self._listen())
+
+    async def stop(self):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except asyncio.CancelledError:
+                pass
+            self._listen_task = None
+
+
+_instance: TieredCache = None
+
+
+def init_instance(conn: aio_redis.Redis, env: str, l1_max_entries: int = 4096, pubsub_conn: Optional[aio_redis.Redis] = None):
+    global _instance
+    _instance = TieredCache(conn, env, l1_max_entries, pubsub_conn)
+    _instance.start()
+
+
+def instance() -> TieredCache:
+    return _instance
+
+
+def cached(namespace: str, ttl: float = 60, stale_ttl: float = 30, negative_ttl: float = 5, key_args: Optional[Tuple[str, ...]] = None):
+    '''
+    缓存返回(value, done)的异步方法, 缓存未初始化时直接调用原方法.
+
+    缓存key由参数值按声明顺序以"_"拼接而成; 指定key_args时只用这些参数组成key,
+    其余参数不是默认值的调用不走缓存, 这样写操作只需按key_args失效即可.
+
+    用法:
+        @cached("game", ttl=300)
+        async def query_game(self, game_index: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if _instance is None:
+                return await func(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())[1:]
+            if key_args is not None:
+                for name, value in arguments:
+                    if name not in key_args and value != signature.parameters[name].default:
+                        return await func(self, *args, **kwargs)
+                arguments = [(name, value) for name, value in arguments if name in key_args]
+            key = "_".join([str(value) for _, value in arguments])
+            return await _instance.get_or_load(
+                namespace,
+                key,
+                lambda: func(self, *args, **kwargs),
+                ttl=ttl,
+                stale_ttl=stale_ttl,
+                negative_ttl=negative_ttl,
+            )
+        return wrapper
+    return decorator
+
+
+async def invalidate_cached(namespace: str, key: Optional[str] = None) -> bool:
+    if _instance is None:
+        return True
+    return await _instance.invalidate(namespace, key)
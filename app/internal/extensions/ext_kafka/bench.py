@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+'''
+对比房间事件的两种编码方式的耗时:
+
+- legacy: 按事件类型逐个if/elif分支, 手工逐个字段赋值.
+- registry: room_event中按事件类型登记的表驱动编码, 以及共用时间戳的批量编码.
+
+使用说明 (在app目录下执行, 不需要连接kafka):
+
+    python -m internal.extensions.ext_kafka.bench --rounds 100000
+'''
+import argparse
+import time
+
+from internal.extensions.ext_kafka.room_event import encode_room_event, \
+    encode_room_events
+from routers.proto_gens.messages_pb2 import RoomEvent, \
+    RoomEventType, \
+    EnterRoomEvent, \
+    LeaveRoomEvent, \
+    EnterQueueEvent, \
+    LeaveQueueEvent, \
+    InQueueBeReadyEvent, \
+    InQueueNotBeReadyEvent, \
+    Start3rdPartyGameEvent, \
+    End3rdPartyGameEvent
+from typing import Any, \
+    Callable, \
+    Dict, \
+    List, \
+    Optional
+
+
+def _legacy_encode(raw_event: Dict[str, Any], timestamp: Optional[int] = None) -> bytes:
+    if raw_event["type"] == RoomEventType.EVENT_TYPE_USER_ENTER_ROOM:
+        event = EnterRoomEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_LEAVE_ROOM:
+        event = LeaveRoomEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_ENTER_QUEUE:
+        event = EnterQueueEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+        event.queue_is_full = raw_event["queue_is_full"]
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_LEAVE_QUEUE:
+        event = LeaveQueueEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+        event.queue_is_full = False
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_IN_QUEUE_BE_READY:
+        event = InQueueBeReadyEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+        event.queue_is_ready = raw_event["queue_is_ready"]
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_IN_QUEUE_NOT_BE_READY:
+        event = InQueueNotBeReadyEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+        event.queue_is_ready = False
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_START_3RD_PARTY_GAME:
+        event = Start3rdPartyGameEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+        event.queue_is_in_game_battle = raw_event["queue_is_in_game_battle"]
+    elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_END_3RD_PARTY_GAME:
+        event = End3rdPartyGameEvent()
+        event.room_id = raw_event["room_id"]
+        event.game_index = raw_event["game_index"]
+        event.be_hosting = raw_event["be_hosting"]
+        event.uid = raw_event["uid"]
+        event.nickname = raw_event["nickname"]
+        event.avatar = raw_event["avatar"]
+        event.owner_id = raw_event["owner_id"]
+        event.owner_nickname = raw_event["owner_nickname"]
+        event.owner_avatar = raw_event["owner_avatar"]
+        event.queue_is_in_game_battle = False
+    else:
+        raise ValueError(f"Unknown room event type:{raw_event['type']}")
+
+    msg = RoomEvent()
+    msg.event_type = raw_event["type"]
+    msg.event_body = event.SerializeToString()
+    msg.trace_id = raw_event["trace_id"]
+    msg.timestamp = timestamp if timestamp is not None else int(time.time() * 1000)
+    return msg.SerializeToString()
+
+
+def _sample_events() -> List[Dict[str, Any]]:
+    base = {
+        "room_id": "room_000509",
+        "game_index": "lolm",
+        "be_hosting": False,
+        "uid": "u_0123456789",
+        "nickname": "nickname",
+        "avatar": "https://example.com/avatar.png",
+        "owner_id": "a_0123456789",
+        "owner_nickname": "owner",
+        "owner_avatar": "https://example.com/owner.png",
+        "queue_is_full": False,
+        "queue_is_ready": True,
+        "queue_is_in_game_battle": True,
+        "trace_id": "0123456789abcdef",
+    }
+    event_types = [
+        RoomEventType.EVENT_TYPE_USER_ENTER_ROOM,
+        RoomEventType.EVENT_TYPE_USER_LEAVE_ROOM,
+        RoomEventType.EVENT_TYPE_USER_ENTER_QUEUE,
+        RoomEventType.EVENT_TYPE_USER_LEAVE_QUEUE,
+        RoomEventType.EVENT_TYPE_USER_IN_QUEUE_BE_READY,
+        RoomEventType.EVENT_TYPE_USER_IN_QUEUE_NOT_BE_READY,
+        RoomEventType.EVENT_TYPE_USER_START_3RD_PARTY_GAME,
+        RoomEventType.EVENT_TYPE_USER_END_3RD_PARTY_GAME,
+    ]
+    return [{**base, "type": event_type} for event_type in event_types]
+
+
+def _run(name: str, fn: Callable[[], Any], rounds: int, n: int) -> float:
+    for _ in range(100):
+        fn()
+    st = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    per_event = (time.perf_counter() - st) / (rounds * n)
+    print(f"{name:<10} {per_event * 1e6:>8.2f}us per event, {rounds * n} events")
+    return per_event
+
+
+def main(rounds: int):
+    events = _sample_events()
+    # 使用相同时间戳时两种编码结果应完全一致, 逐类型的校验见test_room_event.py
+    timestamp = int(time.time() * 1000)
+    for raw_event in events:
+        assert _legacy_encode(raw_event, timestamp=timestamp) == encode_room_event(raw_event, timestamp=timestamp), \
+            f"Mismatched encoding of event type:{raw_event['type']}"
+    n = len(events)
+    legacy = _run("legacy", lambda: [_legacy_encode(x) for x in events], rounds, n)
+    registry = _run("registry", lambda: [encode_room_event(x) for x in events], rounds, n)
+    batch = _run("batch", lambda: encode_room_events(events), rounds, n)
+    print(f"speedup: registry {legacy / registry:.2f}x, batch {legacy / batch:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark room event encoding.")
+    parser.add_argument("--rounds", type=int, default=100000, help="rounds over all event types")
+    args = parser.parse_args()
+    main(args.rounds // 8 or 1)
@@ -1,33 +1,103 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import jsonschema
+import queue
+import threading
 import time
 
+from internal.extensions.ext_kafka.room_event import encode_room_event, \
+    encode_room_events
+from internal.extensions.ext_kafka.spool import DiskSpool, \
+    claim_spool_slot
+from internal.extensions.ext_redis.leaderboard import instance as leaderboard_instance
 from internal.infra.alarm import perror
 from internal.singleton import Singleton
 from loguru import logger as loguru_logger
 from kafka import KafkaProducer
-from kafka.errors import KafkaError
+from kafka.codec import has_gzip, \
+    has_lz4, \
+    has_snappy, \
+    has_zstd
+from kafka.errors import KafkaError, \
+    KafkaTimeoutError
 from routers.proto_gens.messages_pb2 import GameResult
-from routers.proto_gens.messages_pb2 import RoomEvent, \
-    RoomEventType, \
-    EnterRoomEvent, \
-    LeaveRoomEvent, \
-    EnterQueueEvent, \
-    LeaveQueueEvent, \
-    InQueueBeReadyEvent, \
-    InQueueNotBeReadyEvent, \
-    Start3rdPartyGameEvent, \
-    End3rdPartyGameEvent
 from typing import Any, \
+    Callable, \
     Dict, \
-    Optional
+    List, \
+    Optional, \
+    Tuple, \
+    Union
 
 
 class kafkaProducerSetupException(Exception):
     pass
 
 
+# kafka-python的请求超时, 以及拉取不到元数据(broker不可用)时send最多阻塞的时长
+_REQUEST_TIMEOUT_MS = 5000
+_MAX_BLOCK_MS = 5000
+
+_COMPRESSION_CODECS = {
+    "gzip": has_gzip,
+    "snappy": has_snappy,
+    "lz4": has_lz4,
+    "zstd": has_zstd,
+}
+
+
+def _parse_acks(acks: Union[str, int]) -> Union[str, int]:
+    return "all" if str(acks) in ("all", "-1") else int(acks)
+
+
+def _resolve_compression_type(compression_type: str, api_version: Tuple[int, ...]) -> Optional[str]:
+    '''
+    返回可用的压缩算法, 未安装对应的库或broker版本不支持时退回gzip.
+    '''
+    if compression_type in ("", "none"):
+        return None
+    if compression_type not in _COMPRESSION_CODECS:
+        raise kafkaProducerSetupException(f"Unknown kafka compression type:{compression_type}")
+    if compression_type == "zstd" and api_version < (2, 1, 0):
+        loguru_logger.warning(f"Kafka zstd compression needs api_version>=2.1.0 (got {api_version}), fallback to gzip.")
+        return "gzip"
+    if not _COMPRESSION_CODECS[compression_type]():
+        loguru_logger.warning(f"Libraries for kafka {compression_type} compression not found, fallback to gzip.")
+        return "gzip"
+    return compression_type
+
+
+def _record_game_result(value: bytes):
+    '''
+    对战结果投递成功后计入排行榜. 从消息本身解析, 补发spool中的消息时(包括上次进程退出前写入的)也能调用.
+    '''
+    if leaderboard_instance() is None:
+        return
+    msg = GameResult()
+    msg.ParseFromString(value)
+    if msg.status_code == 0:
+        leaderboard_instance().record(msg.app_game_index, msg.app_user_id, msg.result_win)
+
+
+class _SendRequest(object):
+
+    __slots__ = ("topic", "key", "value", "loop", "future")
+
+    def __init__(
+            self,
+            topic: str,
+            key: bytes,
+            value: bytes,
+            loop: asyncio.AbstractEventLoop,
+            future: Optional[asyncio.Future],
+        ) -> None:
+        self.topic = topic
+        self.key = key
+        self.value = value
+        self.loop = loop
+        self.future = future
+
+
 class kafkaProducer(metaclass=Singleton):
     '''
     自定义Kafka Producer客户端
@@ -40,6 +110,19 @@ class kafkaProducer(metaclass=Singleton):
             "client_id": {"type": "string"},
             "default_topic": {"type": "string"},
             "default_room_event_topic": {"type": "string"},
+            "send_queue_size": {"type": "integer"},
+            "ack_timeout_secs": {"type": "number"},
+            "room_event_wait_ack": {"type": "boolean"},
+            "api_version": {"type": "string"},
+            "linger_ms": {"type": "integer"},
+            "batch_size": {"type": "integer"},
+            "compression_type": {"type": "string"},
+            "acks": {"type": ["string", "integer"]},
+            "topic_acks": {"type": "object"},
+            "spool_dir": {"type": "string"},
+            "spool_max_bytes": {"type": "integer"},
+            "spool_segment_bytes": {"type": "integer"},
+            "spool_fsync_interval_ms": {"type": "integer"},
         },
         "required": [
             "brokers",
@@ -53,14 +136,60 @@ class kafkaProducer(metaclass=Singleton):
         if not self._validate_config(conf):
             raise kafkaProducerSetupException("Please provide valid kafka producer config file.")
 
-        self._producer = KafkaProducer(
-            bootstrap_servers=conf["brokers"],
-            client_id=conf["client_id"],
-            api_version=(0, 10, 2),
-            request_timeout_ms=5000,
-        )
+        api_version = tuple(int(x) for x in conf.get("api_version", "0.10.2").split("."))
+        producer_conf = {
+            "bootstrap_servers": conf["brokers"],
+            "client_id": conf["client_id"],
+            "api_version": api_version,
+            "request_timeout_ms": _REQUEST_TIMEOUT_MS,
+            # 超时后消息写入本地spool
+            "max_block_ms": _MAX_BLOCK_MS,
+            # NOTE: 攒批发送, 同一分区的消息在linger_ms内合并成一个批次并整体压缩, 大幅减少请求数和网络字节数.
+            "linger_ms": conf.get("linger_ms", 0),
+            "batch_size": conf.get("batch_size", 16384),
+            "compression_type": _resolve_compression_type(conf.get("compression_type", "none"), api_version),
+        }
+        # kafka-python的acks是producer级别的配置, 每种acks各用一个producer, 按topic选择
+        self._default_acks = _parse_acks(conf.get("acks", 1))
+        self._topic_acks: Dict[str, Union[str, int]] = {
+            topic: _parse_acks(acks) for topic, acks in conf.get("topic_acks", {}).items()
+        }
+        self._producers: Dict[Union[str, int], KafkaProducer] = {}
+        for acks in {self._default_acks, *self._topic_acks.values()}:
+            self._producers[acks] = KafkaProducer(acks=acks, **producer_conf)
         self.default_topic = conf["default_topic"]
         self.default_room_event_topic = conf["default_room_event_topic"]
+        # NOTE: 等待确认的时长必须超过send阻塞和请求超时之和, 否则调用方已按失败处理(并可能重试)的消息随后仍会投递成功或写入spool.
+        min_ack_timeout = (_MAX_BLOCK_MS + _REQUEST_TIMEOUT_MS + producer_conf["linger_ms"]) / 1000 + 1
+        self._ack_timeout = conf.get("ack_timeout_secs", min_ack_timeout)
+        if self._ack_timeout < min_ack_timeout:
+            loguru_logger.warning(f"Kafka ack_timeout_secs:{self._ack_timeout} is shorter than the delivery timeout, use {min_ack_timeout}s instead.")
+            self._ack_timeout = min_ack_timeout
+        self._room_event_wait_ack = conf.get("room_event_wait_ack", True)
+        # NOTE: kafka-python的send在拉取元数据或缓冲区已满时会阻塞, 不能在事件循环里调用.
+        # 由专门的发送线程调用send, 投递结果通过call_soon_threadsafe回到事件循环.
+        self._send_queue: queue.Queue = queue.Queue(maxsize=conf.get("send_queue_size", 10000))
+        self._sender = threading.Thread(target=self._run_sender, name="kafka-producer-sender", daemon=True)
+        # 消息投递成功(包括从spool补发成功)后在事件循环中调用的回调, 按topic登记, 参数为消息内容
+        self._delivered_hooks: Dict[str, Callable[[bytes], None]] = {self.default_topic: _record_game_result}
+        self._loop = io_loop if io_loop is not None else asyncio.get_event_loop()
+        # NOTE: broker不可用或发送队列已满时消息写入本地spool, 由回放线程在恢复后补发. spool_dir为空时不启用.
+        # 多个worker进程各自认领spool_dir下的一个slot子目录, 互不干扰.
+        # spool中有积压时发送线程暂停直接发送, 新消息都追加到spool, 只由回放线程按写入顺序补发.
+        # 例外: broker刚不可用时已交给kafka-python的消息失败后才写入spool, 可能排在少量更新的消息之后; 发送队列已满时直接写入spool的消息也会排在队列中更早的消息之前.
+        self._spool: Optional[DiskSpool] = None
+        self._replayer: Optional[threading.Thread] = None
+        self._closing = threading.Event()
+        if len(conf.get("spool_dir", "")) > 0:
+            self._spool = claim_spool_slot(
+                conf["spool_dir"],
+                max_bytes=conf.get("spool_max_bytes", 1 << 30),
+                segment_bytes=conf.get("spool_segment_bytes", 64 << 20),
+                fsync_interval=conf.get("spool_fsync_interval_ms", 200) / 1000,
+            )
+            self._replayer = threading.Thread(target=self._run_replayer, name="kafka-spool-replayer", daemon=True)
+            self._replayer.start()
+        self._sender.start()
 
     def _validate_config(self, conf: Optional[Dict[str, Any]] = None) -> bool:
         valid = False
@@ -82,7 +211,120 @@ class kafkaProducer(metaclass=Singleton):
         finally:
             return connected
 
-    async def send_msg(self, topic: Optional[str] = None, key: str = "", result: Dict[str, Any] = {}) -> bool:
+    def _producer_for(self, topic: str) -> KafkaProducer:
+        return self._producers[self._topic_acks.get(topic, self._default_acks)]
+
+    def _run_sender(self):
+        while True:
+            req = self._send_queue.get()
+            if req is None:
+                break
+            if self._spool is not None and not self._spool.is_empty() and self._spool.append(req.topic, req.key, req.value):
+                self._resolve(req, None, None)
+                continue
+            try:
+                future = self._producer_for(req.topic).send(req.topic, key=req.key, value=req.value)
+            except Exception as e:
+                self._fail_or_spool(req, e)
+                continue
+            future.add_callback(lambda metadata, req=req: self._resolve(req, metadata, None))
+            future.add_errback(lambda e, req=req: self._fail_or_spool(req, e))
+
+    def _fail_or_spool(self, req: _SendRequest, exc: BaseException):
+        # NOTE: 只有broker不可用、超时等可重试的错误才写入spool, 消息过大等错误重放也不会成功.
+        if self._spool is not None and getattr(exc, "retriable", False) and self._spool.append(req.topic, req.key, req.value):
+            self._resolve(req, None, None)
+        else:
+            self._resolve(req, None, exc)
+
+    def _run_replayer(self):
+        backoff = 1.0
+        while not self._closing.is_set():
+            records, position = self._spool.read_batch()
+            if len(records) == 0:
+                self._closing.wait(1.0)
+                continue
+            try:
+                futures = [
+                    self._producer_for(topic).send(topic, key=key, value=value)
+                    for topic, key, value in records
+                ]
+                for future in futures:
+                    future.get(timeout=self._ack_timeout)
+            except Exception as e:
+                # 至少投递一次: 整批从cursor处重放, 部分已成功的消息可能重复
+                loguru_logger.warning(f"Failed to replay {len(records)} spooled kafka messages, retry in {backoff}s, err:{e}.")
+                self._closing.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            self._spool.commit(position, len(records))
+            backoff = 1.0
+            try:
+                self._loop.call_soon_threadsafe(self._on_replayed, records)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+    def _on_replayed(self, records: List[Tuple[str, bytes, bytes]]):
+        for topic, _, value in records:
+            self._run_delivered_hook(topic, value)
+
+    def _run_delivered_hook(self, topic: str, value: bytes):
+        hook = self._delivered_hooks.get(topic)
+        if hook is None:
+            return
+        try:
+            hook(value)
+        except Exception as e:
+            loguru_logger.error(f"Failed to run delivered hook of topic:{topic}, err:{e}.")
+
+    def _resolve(self, req: _SendRequest, metadata: Any, exc: Optional[BaseException]):
+        # NOTE: 在发送线程或kafka-python的IO线程中被调用
+        try:
+            req.loop.call_soon_threadsafe(self._on_delivery, req, metadata, exc)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def _on_delivery(self, req: _SendRequest, metadata: Any, exc: Optional[BaseException]):
+        # NOTE: metadata为None表示消息只是写入了spool, 等回放线程补发成功后再调用回调.
+        if exc is None and metadata is not None:
+            self._run_delivered_hook(req.topic, req.value)
+        if req.future is not None:
+            if not req.future.done():
+                if exc is None:
+                    req.future.set_result(metadata)
+                else:
+                    req.future.set_exception(exc)
+        elif exc is not None:
+            req.loop.create_task(perror(f"Failed to deliver message to topic:{req.topic}, kafka-err:{exc}."))
+
+    async def _send(
+            self,
+            topic: str,
+            key: bytes,
+            value: bytes,
+            wait_ack: bool = True,
+        ):
+        '''
+        wait_ack为True时等待broker确认或写入spool, 失败时抛出KafkaError; 为False时只放入发送队列, 投递失败时异步告警.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait_ack else None
+        try:
+            self._send_queue.put_nowait(_SendRequest(topic, key, value, loop, future))
+        except queue.Full:
+            if self._spool is not None and self._spool.append(topic, key, value):
+                return
+            raise KafkaTimeoutError(f"Send queue is full ({self._send_queue.maxsize} pending messages).")
+        if future is None:
+            return
+        try:
+            await asyncio.wait_for(future, timeout=self._ack_timeout)
+        except asyncio.TimeoutError:
+            raise KafkaTimeoutError(f"No ack within {self._ack_timeout}s.")
+
+    async def send_msg(self, topic: Optional[str] = None, key: str = "", result: Dict[str, Any] = {}, wait_ack: bool = True) -> bool:
         done = False
         try:
             _topic = topic if topic else self.default_topic
@@ -138,12 +380,8 @@ class kafkaProducer(metaclass=Singleton):
                 msg.result_win = result_win
                 msg.result_screenshots.extend(result_screenshots)
                 msg.receive_time = int(time.time() * 1000)
-            future = self._producer.send(
-                _topic,
-                key=key.encode("utf-8"),
-                value=msg.SerializeToString(),
-            )
-            future.get(timeout=5)
+            self._delivered_hooks[_topic] = _record_game_result
+            await self._send(_topic, key.encode("utf-8"), msg.SerializeToString(), wait_ack)
 
             done = True
             loguru_logger.debug(f"Send one message to topic:{_topic}.")
@@ -154,118 +392,16 @@ class kafkaProducer(metaclass=Singleton):
         finally:
             return done
 
-    async def send_room_event(self, topic: Optional[str] = None, key: str = "", raw_event: Dict[str, Any] = {}) -> bool:
+    async def send_room_event(self, topic: Optional[str] = None, key: str = "", raw_event: Dict[str, Any] = {}, wait_ack: Optional[bool] = None) -> bool:
         done = False
         try:
             _topic = topic if topic else self.default_room_event_topic
             loguru_logger.debug(f"Try to send one message to topic:{_topic}...")
 
-            if raw_event["type"] == RoomEventType.EVENT_TYPE_USER_ENTER_ROOM:
-                event = EnterRoomEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_LEAVE_ROOM:
-                event = LeaveRoomEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_ENTER_QUEUE:
-                event = EnterQueueEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-                event.queue_is_full = raw_event["queue_is_full"]
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_LEAVE_QUEUE:
-                event = LeaveQueueEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-                event.queue_is_full = False
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_IN_QUEUE_BE_READY:
-                event = InQueueBeReadyEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-                event.queue_is_ready = raw_event["queue_is_ready"]
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_IN_QUEUE_NOT_BE_READY:
-                event = InQueueNotBeReadyEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-                event.queue_is_ready = False
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_START_3RD_PARTY_GAME:
-                event = Start3rdPartyGameEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-                event.queue_is_in_game_battle = raw_event["queue_is_in_game_battle"]
-            elif raw_event["type"] == RoomEventType.EVENT_TYPE_USER_END_3RD_PARTY_GAME:
-                event = End3rdPartyGameEvent()
-                event.room_id = raw_event["room_id"]
-                event.game_index = raw_event["game_index"]
-                event.be_hosting = raw_event["be_hosting"]
-                event.uid = raw_event["uid"]
-                event.nickname = raw_event["nickname"]
-                event.avatar = raw_event["avatar"]
-                event.owner_id = raw_event["owner_id"]
-                event.owner_nickname = raw_event["owner_nickname"]
-                event.owner_avatar = raw_event["owner_avatar"]
-                event.queue_is_in_game_battle = False
-
-            msg = RoomEvent()
-            msg.event_type = raw_event["type"]
-            msg.event_body = event.SerializeToString()
-            msg.trace_id = raw_event["trace_id"]
-            msg.timestamp = int(time.time() * 1000)
-            future = self._producer.send(
-                _topic,
-                key=key.encode("utf-8"),
-                value=msg.SerializeToString(),
-            )
-            future.get(timeout=5)
+            value = encode_room_event(raw_event)
+            if wait_ack is None:
+                wait_ack = self._room_event_wait_ack
+            await self._send(_topic, key.encode("utf-8"), value, wait_ack)
 
             done = True
             loguru_logger.debug(f"Send one message to topic:{_topic}.")
@@ -276,9 +412,68 @@ class kafkaProducer(metaclass=Singleton):
         finally:
             return done
 
+    async def send_room_events(self, topic: Optional[str] = None, keyed_events: List[Tuple[str, Dict[str, Any]]] = [], wait_ack: Optional[bool] = None) -> bool:
+        '''
+        批量发送房间事件, keyed_events为[(key, raw_event)], 同一批事件共用一个时间戳; 等待确认时所有事件并发等待.
+        '''
+        done = False
+        try:
+            _topic = topic if topic else self.default_room_event_topic
+            loguru_logger.debug(f"Try to send {len(keyed_events)} messages to topic:{_topic}...")
+
+            values = encode_room_events([raw_event for _, raw_event in keyed_events])
+            if wait_ack is None:
+                wait_ack = self._room_event_wait_ack
+            results = await asyncio.gather(
+                *[self._send(_topic, key.encode("utf-8"), value, wait_ack) for (key, _), value in zip(keyed_events, values)],
+                return_exceptions=True,
+            )
+            errors = [x for x in results if isinstance(x, BaseException)]
+            if len(errors) > 0:
+                raise errors[0]
+
+            done = True
+            loguru_logger.debug(f"Send {len(keyed_events)} messages to topic:{_topic}.")
+        except KafkaError as e:
+            await perror(f"Failed to send messages to topic:{_topic}, kafka-err:{e}.")
+        except Exception as e:
+            await perror(f"Failed to send messages to topic:{_topic}, err:{e}.")
+        finally:
+            return done
+
+    def stats(self) -> Dict[str, Any]:
+        '''
+        返回每个producer的批次大小、压缩率、请求速率和出口流量等指标.
+        '''
+        names = (
+            "batch-size-avg",
+            "records-per-request-avg",
+            "compression-rate-avg",
+            "request-rate",
+            "outgoing-byte-rate",
+            "record-error-rate",
+            "record-queue-time-avg",
+            "request-latency-avg",
+        )
+        stats: Dict[str, Any] = {"send_queue": self._send_queue.qsize()}
+        if self._spool is not None:
+            stats["spool"] = self._spool.stats()
+        for acks, producer in self._producers.items():
+            metrics = producer.metrics().get("producer-metrics", {})
+            stats[f"acks_{acks}"] = {name: metrics.get(name) for name in names}
+        return stats
+
     async def close(self):
-        self._producer.close()
-        await asyncio.sleep(0.1)
+        # NOTE: 发送线程处理完队列中剩余的消息后退出, 再flush并关闭producer
+        await asyncio.get_running_loop().run_in_executor(None, self._send_queue.put, None)
+        await asyncio.get_running_loop().run_in_executor(None, self._sender.join)
+        if self._replayer is not None:
+            self._closing.set()
+            await asyncio.get_running_loop().run_in_executor(None, self._replayer.join)
+        for producer in self._producers.values():
+            await asyncio.get_running_loop().run_in_executor(None, producer.close)
+        if self._spool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._spool.close)
 
 
 _instance: kafkaProducer = None
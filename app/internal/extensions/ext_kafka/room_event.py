@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import time
+
+from routers.proto_gens.messages_pb2 import RoomEvent, \
+    RoomEventType, \
+    EnterRoomEvent, \
+    LeaveRoomEvent, \
+    EnterQueueEvent, \
+    LeaveQueueEvent, \
+    InQueueBeReadyEvent, \
+    InQueueNotBeReadyEvent, \
+    Start3rdPartyGameEvent, \
+    End3rdPartyGameEvent
+from typing import Any, \
+    Callable, \
+    Dict, \
+    Iterable, \
+    List, \
+    Optional, \
+    Sequence, \
+    Tuple
+
+# 所有房间事件共有的字段, raw_event中的key与protobuf字段同名
+COMMON_FIELDS = (
+    "room_id",
+    "game_index",
+    "be_hosting",
+    "uid",
+    "nickname",
+    "avatar",
+    "owner_id",
+    "owner_nickname",
+    "owner_avatar",
+)
+
+
+class RoomEventSpec(object):
+    '''
+    一种房间事件的编码方式: 从raw_event中取fields对应的值, 加上固定取值的constants, 一次性传给message_cls的构造函数.
+    '''
+
+    __slots__ = ("message_cls", "fields", "constants")
+
+    def __init__(self, message_cls: Callable[..., Any], fields: Sequence[str], constants: Dict[str, Any]) -> None:
+        self.message_cls = message_cls
+        # (protobuf字段, raw_event中的key), 目前两者同名
+        self.fields: Tuple[Tuple[str, str], ...] = tuple((name, name) for name in fields)
+        self.constants = dict(constants)
+
+    def build(self, raw_event: Dict[str, Any]) -> Any:
+        # NOTE: 所有字段通过一次构造函数调用传入, 省去逐个setattr的开销.
+        # 与setattr不同, 构造函数把值为None的字段当作未设置, 不会报错.
+        kwargs = {f: raw_event[k] for f, k in self.fields}
+        kwargs.update(self.constants)
+        return self.message_cls(**kwargs)
+
+
+_registry: Dict[int, RoomEventSpec] = {}
+
+
+def register_room_event(
+        event_type: int,
+        message_cls: Callable[..., Any],
+        extra_fields: Sequence[str] = (),
+        constants: Optional[Dict[str, Any]] = None,
+    ):
+    '''
+    注册一种房间事件, 新增事件类型只需在这里登记, 不需要改动编码逻辑.
+    '''
+    _registry[event_type] = RoomEventSpec(message_cls, COMMON_FIELDS + tuple(extra_fields), constants or {})
+
+
+register_room_event(RoomEventType.EVENT_TYPE_USER_ENTER_ROOM, EnterRoomEvent)
+register_room_event(RoomEventType.EVENT_TYPE_USER_LEAVE_ROOM, LeaveRoomEvent)
+register_room_event(RoomEventType.EVENT_TYPE_USER_ENTER_QUEUE, EnterQueueEvent, extra_fields=("queue_is_full",))
+register_room_event(RoomEventType.EVENT_TYPE_USER_LEAVE_QUEUE, LeaveQueueEvent, constants={"queue_is_full": False})
+register_room_event(RoomEventType.EVENT_TYPE_USER_IN_QUEUE_BE_READY, InQueueBeReadyEvent, extra_fields=("queue_is_ready",))
+register_room_event(RoomEventType.EVENT_TYPE_USER_IN_QUEUE_NOT_BE_READY, InQueueNotBeReadyEvent, constants={"queue_is_ready": False})
+register_room_event(RoomEventType.EVENT_TYPE_USER_START_3RD_PARTY_GAME, Start3rdPartyGameEvent, extra_fields=("queue_is_in_game_battle",))
+register_room_event(RoomEventType.EVENT_TYPE_USER_END_3RD_PARTY_GAME, End3rdPartyGameEvent, constants={"queue_is_in_game_battle": False})
+
+
+def encode_room_event(raw_event: Dict[str, Any], timestamp: Optional[int] = None) -> bytes:
+    '''
+    把raw_event编码成序列化后的RoomEvent, timestamp为毫秒时间戳, 默认取当前时间.
+    '''
+    spec = _registry.get(raw_event["type"])
+    if spec is None:
+        raise ValueError(f"Unknown room event type:{raw_event['type']}")
+    return RoomEvent(
+        event_type=raw_event["type"],
+        event_body=spec.build(raw_event).SerializeToString(),
+        trace_id=raw_event["trace_id"],
+        timestamp=timestamp if timestamp is not None else int(time.time() * 1000),
+    ).SerializeToString()
+
+
+def encode_room_events(raw_events: Iterable[Dict[str, Any]]) -> List[bytes]:
+    '''
+    批量编码, 同一批事件共用一个时间戳.
+    '''
+    timestamp = int(time.time() * 1000)
+    registry = _registry
+    encoded = []
+    for raw_event in raw_events:
+        spec = registry.get(raw_event["type"])
+        if spec is None:
+            raise ValueError(f"Unknown room event type:{raw_event['type']}")
+        encoded.append(RoomEvent(
+            event_type=raw_event["type"],
+            event_body=spec.build(raw_event).SerializeToString(),
+            trace_id=raw_event["trace_id"],
+            timestamp=timestamp,
+        ).SerializeToString())
+    return encoded
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import os
+import struct
+import threading
+import zlib
+
+from loguru import logger as loguru_logger
+from typing import Any, \
+    BinaryIO, \
+    Dict, \
+    List, \
+    Tuple
+
+# 每条记录: CRC32(4B) + TOPIC_LEN(2B) + KEY_LEN(2B) + VALUE_LEN(4B) + TOPIC + KEY + VALUE, CRC覆盖后三部分
+_RECORD_HEADER = struct.Struct(">IHHI")
+_SEGMENT_SUFFIX = ".seg"
+_CURSOR_FILENAME = "cursor"
+_LOCK_FILENAME = "lock"
+_SLOT_PREFIX = "slot-"
+# 回放时单次最多读取的字节数
+_READ_CHUNK_BYTES = 1 << 20
+
+# (topic, key, value)
+SpoolRecord = Tuple[str, bytes, bytes]
+# (segment序号, 段内偏移)
+SpoolPosition = Tuple[int, int]
+
+
+class SpoolLocked(Exception):
+    pass
+
+
+class DiskSpool(object):
+    '''
+    Kafka不可用时的本地磁盘缓冲.
+
+    - 记录追加写入分段文件, 单个分段超过segment_bytes时滚动到新分段; 待回放的总字节数超过max_bytes时拒绝写入.
+    - 写入只进入页缓存, 由后台线程每fsync_interval秒批量fsync一次, 滚动出去的旧分段也交给后台线程fsync, 写入方不会等待磁盘.
+    - 回放位置(cursor)单独持久化, 已回放完的分段被删除; 崩溃重启后从cursor继续回放, 可能重复投递最后一批.
+    - 锁内只做内存操作和写页缓存, fsync、保存cursor和删除分段都在锁外进行, append不会被回放线程的磁盘操作阻塞.
+    - 每次启动都写入新分段, 上次崩溃时写了一半的记录只会出现在旧分段末尾, 回放时校验CRC后跳过.
+    - 目录用flock独占, 已被其他进程使用时抛出SpoolLocked; 进程退出(包括崩溃)时锁自动释放.
+    - 写磁盘失败(例如磁盘已满)时丢弃该条记录并返回False, 下次写入先滚动到新分段, 不在写坏的分段后面继续追加.
+    '''
+
+    def __init__(
+            self,
+            directory: str,
+            max_bytes: int = 1 << 30,
+            segment_bytes: int = 64 << 20,
+            fsync_interval: float = 0.2,
+        ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(directory, _LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._lock_fd)
+            raise SpoolLocked(f"Kafka spool directory:{directory} is in use by another process.")
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._segments: List[int] = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(_SEGMENT_SUFFIX)
+        )
+        # 各分段已写入的字节数(含尚未flush的部分), 计算待回放字节数时不用访问磁盘
+        self._sizes: Dict[int, int] = {seq: os.path.getsize(self._segment_path(seq)) for seq in self._segments}
+        self._cursor: SpoolPosition = self._load_cursor()
+        for seq in self._detach_segments(self._cursor[0]):
+            self._remove_segment_file(seq)
+        self._writer_seq = self._segments[-1] + 1 if len(self._segments) > 0 else 0
+        self._writer = open(self._segment_path(self._writer_seq), "ab")
+        self._segments.append(self._writer_seq)
+        self._sizes[self._writer_seq] = 0
+        # 已滚动出去、等待后台线程fsync并关闭的分段文件
+        self._retired: List[BinaryIO] = []
+        if self._cursor[0] not in self._segments:
+            self._cursor = (self._segments[0], 0)
+        self._pending_bytes = self._count_pending_bytes()
+        self._dirty = False
+        self._write_failed = False
+        self._appended = 0
+        self._replayed = 0
+        self._dropped = 0
+        self._corrupted = 0
+        self._closed = threading.Event()
+        self._syncer = threading.Thread(target=self._run_syncer, name="kafka-spool-syncer", daemon=True)
+        self._syncer.start()
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self._dir, f"{seq:020d}{_SEGMENT_SUFFIX}")
+
+    def _load_cursor(self) -> SpoolPosition:
+        try:
+            with open(os.path.join(self._dir, _CURSOR_FILENAME), "r") as f:
+                seq, offset = f.read().strip().split(":")
+                return (int(seq), int(offset))
+        except (OSError, ValueError):
+            return (self._segments[0] if len(self._segments) > 0 else 0, 0)
+
+    def _save_cursor(self, position: SpoolPosition):
+        path = os.path.join(self._dir, _CURSOR_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{position[0]}:{position[1]}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _detach_segments(self, before: int) -> List[int]:
+        '''
+        把序号小于before的分段移出列表并返回, 调用方在锁外删除文件.
+        '''
+        detached = [seq for seq in self._segments if seq < before]
+        for seq in detached:
+            self._segments.remove(seq)
+            del self._sizes[seq]
+        return detached
+
+    def _remove_segment_file(self, seq: int):
+        try:
+            os.remove(self._segment_path(seq))
+        except OSError:
+            pass
+
+    def _count_pending_bytes(self) -> int:
+        n = 0
+        for seq in self._segments:
+            if seq >= self._cursor[0]:
+                n += self._sizes[seq]
+        return n - self._cursor[1]
+
+    def _roll(self):
+        # NOTE: 在锁内调用, 只flush到页缓存; 旧分段的fsync和关闭交给后台线程.
+        writer = open(self._segment_path(self._writer_seq + 1), "ab")
+        try:
+            self._writer.flush()
+        except OSError:
+            # 写坏的分段, 回放时校验CRC后跳过末尾
+            pass
+        self._retired.append(self._writer)
+        self._writer_seq += 1
+        self._writer = writer
+        self._segments.append(self._writer_seq)
+        self._sizes[self._writer_seq] = 0
+
+    def append(self, topic: str, key: bytes, value: bytes) -> bool:
+        '''
+        追加一条记录, 超过容量上限时丢弃并返回False.
+        '''
+        t = topic.encode("utf-8")
+        body = t + key + value
+        record = _RECORD_HEADER.pack(zlib.crc32(body), len(t), len(key), len(value)) + body
+        with self._lock:
+            if self._closed.is_set() or self._pending_bytes + len(record) > self._max_bytes:
+                self._dropped += 1
+                return False
+            try:
+                if self._write_failed or self._writer.tell() >= self._segment_bytes:
+                    self._roll()
+                    self._write_failed = False
+                self._writer.write(record)
+            except OSError as e:
+                self._write_failed = True
+                self._dropped += 1
+                loguru_logger.error(f"Failed to append to kafka spool:{self._dir}, err:{e}.")
+                return False
+            self._sizes[self._writer_seq] += len(record)
+            self._pending_bytes += len(record)
+            self._appended += 1
+            self._dirty = True
+        return True
+
+    def _run_syncer(self):
+        while not self._closed.wait(self._fsync_interval):
+            self._sync()
+
+    def _sync(self):
+        fd = -1
+        with self._lock:
+            retired, self._retired = self._retired, []
+            if self._dirty and not self._writer.closed:
+                self._writer.flush()
+                # NOTE: fsync在锁外进行, 不阻塞写入; 复制一份fd, 期间滚动分段关闭原文件也不影响.
+                fd = os.dup(self._writer.fileno())
+                self._dirty = False
+        # NOTE: 磁盘故障时只记录日志, 不能让后台线程退出; close在flush失败时也会关闭底层文件.
+        for f in retired:
+            try:
+                os.fsync(f.fileno())
+                f.close()
+            except OSError as e:
+                loguru_logger.error(f"Failed to fsync kafka spool:{self._dir}, err:{e}.")
+        if fd >= 0:
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                loguru_logger.error(f"Failed to fsync kafka spool:{self._dir}, err:{e}.")
+            finally:
+                os.close(fd)
+
+    def read_batch(self, max_records: int = 500) -> Tuple[List[SpoolRecord], SpoolPosition]:
+        '''
+        从cursor开始按写入顺序读取最多max_records条记录, 返回记录和读完这些记录之后的位置, 回放成功后再commit该位置.
+        '''
+        with self._lock:
+            seq, offset = self._cursor
+            while True:
+                if seq == self._writer_seq:
+                    self._writer.flush()
+                size = self._sizes[seq]
+                if offset < size or seq == self._writer_seq:
+                    break
+                seq, offset = self._segments[self._segments.index(seq) + 1], 0
+        if offset >= size:
+            return ([], (seq, offset))
+        with open(self._segment_path(seq), "rb") as f:
+            f.seek(offset)
+            buf = f.read(min(size - offset, _READ_CHUNK_BYTES))
+        records: List[SpoolRecord] = []
+        pos = 0
+        while len(records) < max_records and pos + _RECORD_HEADER.size <= len(buf):
+            crc, topic_len, key_len, value_len = _RECORD_HEADER.unpack_from(buf, pos)
+            end = pos + _RECORD_HEADER.size + topic_len + key_len + value_len
+            if end > len(buf):
+                if pos == 0 and end - pos > _READ_CHUNK_BYTES and offset + end <= size:
+                    # 单条记录超过读取块大小, 按实际长度单独读取
+                    with open(self._segment_path(seq), "rb") as f:
+                        f.seek(offset)
+                        buf = f.read(end)
+                    continue
+                break
+            body = buf[pos + _RECORD_HEADER.size:end]
+            if zlib.crc32(body) != crc:
+                break
+            records.append((
+                body[:topic_len].decode("utf-8"),
+                body[topic_len:topic_len + key_len],
+                body[topic_len + key_len:],
+            ))
+            pos = end
+        if len(records) == 0 and seq != self._writer_seq:
+            # 旧分段末尾是崩溃时写了一半的记录, 跳过该分段剩余部分
+            loguru_logger.warning(f"Skip corrupted kafka spool segment:{seq} from offset:{offset}.")
+            self._corrupted += 1
+            self.commit((seq, size))
+            return ([], (seq, size))
+        return (records, (seq, offset + pos))
+
+    def commit(self, position: SpoolPosition, n: int = 0):
+        '''
+        只由回放线程调用. 先持久化cursor再删除已回放完的分段, 两步之间崩溃时重启后会从下一个仍存在的分段开始回放.
+        '''
+        with self._lock:
+            self._cursor = position
+            detached = self._detach_segments(position[0])
+            self._pending_bytes = self._count_pending_bytes()
+            self._replayed += n
+        self._save_cursor(position)
+        for seq in detached:
+            self._remove_segment_file(seq)
+
+    def is_empty(self) -> bool:
+        return self._pending_bytes <= 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_bytes": self._pending_bytes,
+            "segments": len(self._segments),
+            "appended": self._appended,
+            "replayed": self._replayed,
+            "dropped": self._dropped,
+            "corrupted": self._corrupted,
+        }
+
+    def close(self):
+        self._closed.set()
+        self._syncer.join()
+        with self._lock:
+            retired, self._retired = self._retired, []
+            try:
+                for f in retired + [self._writer]:
+                    try:
+                        f.flush()
+                        os.fsync(f.fileno())
+                    finally:
+                        f.close()
+            finally:
+                # 关闭文件描述符即释放flock
+                os.close(self._lock_fd)
+
+
+def claim_spool_slot(root: str, **kwargs) -> DiskSpool:
+    '''
+    多个worker进程共用root时, 每个进程按序号从小到大认领第一个未被占用的slot子目录, 各自独立写入和回放.
+    进程退出后slot的锁自动释放, 重启(或新启动)的worker认领到该slot时接管其中尚未回放的消息.
+    NOTE: worker数减少后序号较大的slot不会再被认领, 其中的积压要等worker数恢复后才会回放.
+    '''
+    os.makedirs(root, exist_ok=True)
+    i = 0
+    while True:
+        try:
+            return DiskSpool(os.path.join(root, f"{_SLOT_PREFIX}{i:03d}"), **kwargs)
+        except SpoolLocked:
+            i += 1
@@ -0,0 +1,52 @@
+import unittest
+
+from app.internal.extensions.ext_kafka.bench import _legacy_encode, \
+    _sample_events
+from app.internal.extensions.ext_kafka.room_event import RoomEvent, \
+    RoomEventType, \
+    EnterRoomEvent, \
+    encode_room_event, \
+    encode_room_events
+
+TIMESTAMP = 1700000000000
+
+
+class RoomEventTests(unittest.TestCase):
+
+    def setUp(self):
+        self.base = dict(_sample_events()[0])
+
+    def test_matches_legacy_encoding(self):
+        for event_type in RoomEventType.values():
+            raw_event = {**self.base, "type": event_type}
+            with self.subTest(event_type=RoomEventType.Name(event_type)):
+                try:
+                    legacy = _legacy_encode(raw_event, timestamp=TIMESTAMP)
+                except ValueError:
+                    # Types without a legacy branch must be rejected as well
+                    with self.assertRaises(ValueError):
+                        encode_room_event(raw_event, timestamp=TIMESTAMP)
+                    continue
+                self.assertEqual(encode_room_event(raw_event, timestamp=TIMESTAMP), legacy)
+
+    def test_batch_matches_single(self):
+        raw_events = _sample_events()
+        encoded = encode_room_events(raw_events)
+        timestamp = RoomEvent.FromString(encoded[0]).timestamp
+        self.assertEqual(encoded, [encode_room_event(x, timestamp=timestamp) for x in raw_events])
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            encode_room_event({**self.base, "type": max(RoomEventType.values()) + 1000}, timestamp=TIMESTAMP)
+
+    def test_none_is_unset(self):
+        # The legacy setattr raised TypeError on None; the constructor treats None as an unset field
+        raw_event = {**self.base, "type": RoomEventType.EVENT_TYPE_USER_ENTER_ROOM, "nickname": None}
+        with self.assertRaises(TypeError):
+            _legacy_encode(raw_event, timestamp=TIMESTAMP)
+        msg = RoomEvent.FromString(encode_room_event(raw_event, timestamp=TIMESTAMP))
+        self.assertEqual(EnterRoomEvent.FromString(msg.event_body).nickname, "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app.internal.extensions.ext_kafka.spool import DiskSpool, \
+    SpoolLocked, \
+    claim_spool_slot
+
+
+class DiskSpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _segment_files(self):
+        return sorted(name for name in os.listdir(self.dir) if name.endswith(".seg"))
+
+    def test_read_and_commit(self):
+        spool = DiskSpool(self.dir)
+        self.assertTrue(spool.is_empty())
+        self.assertTrue(spool.append("topic-a", b"k1", b"v1"))
+        self.assertTrue(spool.append("topic-b", b"", b"v2"))
+        self.assertFalse(spool.is_empty())
+
+        records, position = spool.read_batch()
+        self.assertEqual(records, [("topic-a", b"k1", b"v1"), ("topic-b", b"", b"v2")])
+        # Not committed yet, the same batch is read again
+        self.assertEqual(spool.read_batch()[0], records)
+
+        spool.commit(position, len(records))
+        self.assertTrue(spool.is_empty())
+        self.assertEqual(spool.read_batch()[0], [])
+        self.assertEqual(spool.stats()["replayed"], 2)
+        spool.close()
+
+    def test_cursor_resume(self):
+        spool = DiskSpool(self.dir)
+        for i in range(5):
+            spool.append("topic", b"", f"v{i}".encode())
+        records, position = spool.read_batch(max_records=2)
+        self.assertEqual([x[2] for x in records], [b"v0", b"v1"])
+        spool.commit(position, len(records))
+        spool.close()
+
+        # Reopen: replay continues from the committed cursor
+        spool = DiskSpool(self.dir)
+        spool.append("topic", b"", b"v5")
+        values = []
+        while True:
+            records, position = spool.read_batch()
+            if len(records) == 0:
+                break
+            values.extend(x[2] for x in records)
+            spool.commit(position, len(records))
+        self.assertEqual(values, [b"v2", b"v3", b"v4", b"v5"])
+        self.assertTrue(spool.is_empty())
+        spool.close()
+
+    def test_torn_tail_is_skipped(self):
+        spool = DiskSpool(self.dir)
+        spool.append("topic", b"", b"v0")
+        spool.append("topic", b"", b"v1")
+        spool.close()
+        # Simulate a crash in the middle of writing the last record
+        path = os.path.join(self.dir, self._segment_files()[-1])
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+
+        spool = DiskSpool(self.dir)
+        spool.append("topic", b"", b"v2")
+        values = []
+        while True:
+            records, position = spool.read_batch()
+            if len(records) == 0 and spool.is_empty():
+                break
+            values.extend(x[2] for x in records)
+            spool.commit(position, len(records))
+        self.assertEqual(values, [b"v0", b"v2"])
+        self.assertEqual(spool.stats()["corrupted"], 1)
+        spool.close()
+
+    def test_corrupted_record_is_skipped(self):
+        spool = DiskSpool(self.dir)
+        spool.append("topic", b"", b"v0")
+        spool.close()
+        path = os.path.join(self.dir, self._segment_files()[-1])
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"x")
+
+        spool = DiskSpool(self.dir)
+        records, position = spool.read_batch()
+        self.assertEqual(records, [])
+        self.assertEqual(spool.stats()["corrupted"], 1)
+        self.assertTrue(spool.is_empty())
+        spool.close()
+
+    def test_max_bytes(self):
+        spool = DiskSpool(self.dir, max_bytes=100)
+        # Each record: 12B header + 5B topic + 20B value
+        self.assertTrue(spool.append("topic", b"", b"x" * 20))
+        self.assertTrue(spool.append("topic", b"", b"x" * 20))
+        self.assertFalse(spool.append("topic", b"", b"x" * 20))
+        self.assertEqual(spool.stats()["dropped"], 1)
+
+        # Room is freed once the records are replayed
+        records, position = spool.read_batch(max_records=1)
+        spool.commit(position, len(records))
+        self.assertTrue(spool.append("topic", b"", b"x" * 20))
+        spool.close()
+
+    def test_segment_roll(self):
+        spool = DiskSpool(self.dir, segment_bytes=64)
+        for i in range(6):
+            spool.append("topic", b"", (f"v{i}" * 10).encode())
+        self.assertGreater(len(self._segment_files()), 1)
+
+        values = []
+        while True:
+            records, position = spool.read_batch()
+            if len(records) == 0:
+                break
+            values.extend(x[2] for x in records)
+            spool.commit(position, len(records))
+        self.assertEqual(values, [(f"v{i}" * 10).encode() for i in range(6)])
+        self.assertTrue(spool.is_empty())
+        # Replayed segments are removed
+        self.assertEqual(len(self._segment_files()), 1)
+        spool.close()
+
+    def test_directory_is_exclusive(self):
+        spool = DiskSpool(self.dir)
+        with self.assertRaises(SpoolLocked):
+            DiskSpool(self.dir)
+        spool.close()
+        # The lock is released on close
+        DiskSpool(self.dir).close()
+
+    def test_claim_spool_slot(self):
+        first = claim_spool_slot(self.dir)
+        second = claim_spool_slot(self.dir)
+        self.assertNotEqual(first._dir, second._dir)
+        first.append("topic", b"", b"v0")
+        first.close()
+
+        # A restarted worker takes over the abandoned slot and its backlog
+        restarted = claim_spool_slot(self.dir)
+        self.assertEqual(restarted._dir, first._dir)
+        self.assertEqual(restarted.read_batch()[0], [("topic", b"", b"v0")])
+        restarted.close()
+        second.close()
+
+    def test_append_failure_rolls_segment(self):
+        spool = DiskSpool(self.dir)
+        spool.append("topic", b"", b"v0")
+        writer = spool._writer
+
+        def fail(_):
+            raise OSError(28, "No space left on device")
+
+        writer.write = fail
+        self.assertFalse(spool.append("topic", b"", b"v1"))
+        self.assertEqual(spool.stats()["dropped"], 1)
+        del writer.write
+        self.assertTrue(spool.append("topic", b"", b"v2"))
+        self.assertIsNot(spool._writer, writer)
+
+        values = []
+        while True:
+            records, position = spool.read_batch()
+            if len(records) == 0 and spool.is_empty():
+                break
+            values.extend(x[2] for x in records)
+            spool.commit(position, len(records))
+        self.assertEqual(values, [b"v0", b"v2"])
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
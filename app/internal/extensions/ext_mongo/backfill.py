@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+从对战结果流水中重建用户对战统计 (personal_game_stats), 以及把对战结果迁移到时序集合 (game_result_ts).
+
+使用说明 (在app目录下执行):
+
+    python -m internal.extensions.ext_mongo.backfill               # 重建全部用户
+    python -m internal.extensions.ext_mongo.backfill --uid User_x  # 只重建指定用户
+    python -m internal.extensions.ext_mongo.backfill --migrate-game-results  # 迁移对战结果到时序集合
+
+打开MONGODB_GAME_RESULT_USE_TIMESERIES之前先执行一次迁移, 打开之后再执行一次补齐切换期间写入旧集合的结果.
+'''
+import argparse
+import asyncio
+import sys
+
+from dependencies import settings
+from internal.extensions.ext_mongo.ha import init_instance as init_db_instance
+from internal.extensions.ext_mongo.ha import instance as db_instance
+from loguru import logger as loguru_logger
+
+
+async def _init_db(game_result_use_timeseries: bool) -> bool:
+    init_db_instance(
+        client_conf={
+            "endpoints": settings.MONGODB_SERVER_ENDPOINTS,
+            "username": settings.MONGODB_USERNAME,
+            "password": settings.MONGODB_PASSWORD,
+            "auth_mechanism": settings.MONGODB_AUTH_MECHANISM,
+            "database": settings.MONGODB_DATABASE,
+            "replica_set": settings.MONGODB_REPLICA_SET,
+            "game_result_use_timeseries": game_result_use_timeseries,
+            "game_result_expire_secs": settings.MONGODB_GAME_RESULT_EXPIRE_SECS,
+        }
+    )
+    connected = await db_instance().is_connected()
+    if not connected:
+        loguru_logger.error("Cannot setup mongodb connection (pool).")
+        return False
+    ok = await db_instance().init_indexes()
+    if not ok:
+        loguru_logger.error("Failed db.init_indexes stage.")
+        await db_instance().close()
+        return False
+    return True
+
+
+async def backfill_personal_game_stats(uid: str = None, batch_size: int = 500) -> bool:
+    if not await _init_db(settings.MONGODB_GAME_RESULT_USE_TIMESERIES):
+        return False
+
+    n, ok = await db_instance().rebuild_personal_game_stats(uid=uid, batch_size=batch_size)
+    if ok:
+        loguru_logger.info(f"Rebuilt game stats for {n} users.")
+    else:
+        loguru_logger.error("Failed to rebuild game stats.")
+    await db_instance().close()
+    return ok
+
+
+async def migrate_game_results(batch_size: int = 500) -> bool:
+    if not await _init_db(True):
+        return False
+
+    n, ok = await db_instance().migrate_game_results_to_timeseries(batch_size=batch_size)
+    if ok:
+        loguru_logger.info(f"Migrated {n} game results to time-series collection.")
+    else:
+        loguru_logger.error("Failed to migrate game results.")
+    await db_instance().close()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild personal game stats from game results.")
+    parser.add_argument("--uid", type=str, default=None, help="only rebuild stats for this user")
+    parser.add_argument("--migrate-game-results", action="store_true", help="copy game results into the time-series collection")
+    parser.add_argument("--batch-size", type=int, default=500, help="cursor batch size and bulk write size")
+    args = parser.parse_args()
+    if args.migrate_game_results:
+        ok = asyncio.run(migrate_game_results(batch_size=args.batch_size))
+    else:
+        ok = asyncio.run(backfill_personal_game_stats(uid=args.uid, batch_size=args.batch_size))
+    sys.exit(0 if ok else -1)
@@ -9,7 +9,10 @@ import pymongoexplain
 import time
 import ujson as json
 
+from bson import ObjectId
 from dependencies import settings
+from internal.extensions.ext_cache import cached, \
+    invalidate_cached
 from internal.infra.alarm import perror
 from internal.singleton import Singleton
 from internal.utils.helper import new_uid
@@ -29,6 +32,9 @@ from typing import Any, \
     Optional, \
     Tuple
 
+# 对战结果迁移续跑时, 从断点往前回退重新扫描的秒数
+_GAME_RESULT_MIGRATION_RESCAN_SECS = 300
+
 
 def _create_retry_decorator(min_secs: int = 1, max_secs: int = 60, max_retries: int = 3) -> Callable[[Any], Any]:
     return retry(
@@ -67,6 +73,10 @@ class MongoClientSetupException(Exception):
     pass
 
 
+class StaleFencingToken(Exception):
+    pass
+
+
 class MongoClient(metaclass=Singleton):
     '''
     MongoDB自定义客户端
@@ -81,6 +91,8 @@ class MongoClient(metaclass=Singleton):
             "auth_mechanism": {"type": "string"},
             "database": {"type": "string"},
             "replica_set": {"type": "string"},
+            "game_result_use_timeseries": {"type": "boolean"},
+            "game_result_expire_secs": {"type": "number"},
         },
         "required": [
             "endpoints",
@@ -133,6 +145,9 @@ class MongoClient(metaclass=Singleton):
                 authMechanism=client_conf["auth_mechanism"],
             )
         self._db = self._client[f"ha_{client_conf['database']}_{settings.DEPLOY_ENV}"]
+        # NOTE: 对战结果是只追加的流水数据, 开启后写入时序集合, 由MongoDB按桶压缩存储并自动过期.
+        self._game_result_use_timeseries = client_conf.get("game_result_use_timeseries", False)
+        self._game_result_expire_secs = int(client_conf.get("game_result_expire_secs", 0))
 
     def _validate_config(self, conf: Optional[Dict[str, Any]] = None) -> bool:
         valid = False
@@ -168,6 +183,7 @@ class MongoClient(metaclass=Singleton):
             await self._user_profile_store.create_index("device_id", unique=False)
             await self._user_profile_store.create_index("create_ts", unique=False)
             await self._user_profile_store.create_index("is_deleted", unique=False)
+            await self._user_profile_store.create_index("update_ts", unique=False)
             # 用于用户注销再注册后, 老账号能保留数据, 新账号的数据为空
             self._user_profile_store_s = self._db["user_profile_for_bad_man"]
             await self._user_profile_store_s.create_index("uid", unique=True)
@@ -209,6 +225,15 @@ class MongoClient(metaclass=Singleton):
             self._personal_game_result_store = self._db["personal_game_result"]
             await self._personal_game_result_store.create_index("uid", unique=True)
             await self._personal_game_result_store.create_index("update_ts", unique=False)
+            # 用户游戏对战统计数据存储文档 (按游戏增量累计, game_index为"all"的文档是全部游戏的汇总)
+            self._personal_game_stats_store = self._db["personal_game_stats"]
+            await self._personal_game_stats_store.create_index(
+                [
+                    ("uid", pymongo.ASCENDING),
+                    ("game_index", pymongo.ASCENDING),
+                ],
+                unique=True,
+            )
             # 用户专属邀请码数据存储文档
             self._personal_invite_code_store = self._db["personal_invite_code"]
             await self._personal_invite_code_store.create_index("uid", unique=True)
@@ -224,14 +249,44 @@ class MongoClient(metaclass=Singleton):
                 unique=True,
             )
             # 用户游戏对战结果数据存储文档
-            self._game_result_store = self._db["game_result"]
-            await self._game_result_store.create_index(
-                [
-                    ("app_uid", pymongo.ASCENDING),
-                    ("create_ts", pymongo.DESCENDING),
-                ],
-                unique=True,
-            )
+            if self._game_result_use_timeseries:
+                # 时序集合: metaField为(app_uid, app_game_index), timeField为接收时间
+                if "game_result_ts" not in await self._db.list_collection_names():
+                    options = {
+                        "timeseries": {
+                            "timeField": "receive_time",
+                            "metaField": "meta",
+                            "granularity": "minutes",
+                        },
+                    }
+                    if self._game_result_expire_secs > 0:
+                        options["expireAfterSeconds"] = self._game_result_expire_secs
+                    await self._db.create_collection("game_result_ts", **options)
+                elif self._game_result_expire_secs > 0:
+                    await self._db.command({
+                        "collMod": "game_result_ts",
+                        "expireAfterSeconds": self._game_result_expire_secs,
+                    })
+                self._game_result_store = self._db["game_result_ts"]
+                # 切换前写入的对战结果, 由migrate_game_results_to_timeseries迁移到时序集合
+                self._legacy_game_result_store = self._db["game_result"]
+                self._game_result_migration_store = self._db["game_result_migration"]
+                await self._game_result_store.create_index(
+                    [
+                        ("meta.app_uid", pymongo.ASCENDING),
+                        ("receive_time", pymongo.DESCENDING),
+                    ],
+                    unique=False,
+                )
+            else:
+                self._game_result_store = self._db["game_result"]
+                await self._game_result_store.create_index(
+                    [
+                        ("app_uid", pymongo.ASCENDING),
+                        ("create_ts", pymongo.DESCENDING),
+                    ],
+                    unique=True,
+                )
             # 用户私聊数据存储文档
             self._chat_store = self._db["chat"]
             await self._chat_store.create_index(
@@ -514,6 +569,28 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (profile, done)
 
+    async def list_recently_active_users(self, since_ts: int, limit: int = 5000) -> Tuple[List[Dict[str, Any]], bool]:
+        '''
+        返回update_ts不早于since_ts的用户的设备信息, 用于启动时预热缓存.
+        '''
+        users: List[Dict[str, Any]] = []
+        done = False
+        try:
+            query = {"is_deleted": False, "update_ts": {"$gte": since_ts}}
+            projection = {"_id": 0, "uid": 1, "account": 1, "device_type": 1, "device_id": 1, "jpush_registration_id": 1}
+            async for x in self._user_profile_store.find(query, projection).sort([("update_ts", -1)]).limit(limit):
+                users.append(x)
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror("Timeout to list recently active users.")
+            else:
+                await perror(f"Failed to list recently active users, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to list recently active users, err:{exc}.")
+        finally:
+            return (users, done)
+
     async def set_user_online(self, account: str, online: bool) -> bool:
         done = False
         try:
@@ -714,6 +791,7 @@ class MongoClient(metaclass=Singleton):
                 "update_ts": update_ts,
             }}
             await self._app_permission_store.update_one(query, update, upsert=True)
+            await invalidate_cached("app_permission", permission["device_id"])
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -725,6 +803,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
+    @cached("app_permission", ttl=60, key_args=("device_id",))
     async def query_all_app_permissions(self, device_id: str, n: int = 10) -> Tuple[List[Dict[str, Any]], bool]:
         permissions: List[Dict[str, Any]] = []
         done = False
@@ -770,6 +849,7 @@ class MongoClient(metaclass=Singleton):
                 "create_ts": create_ts,
             }}
             await self._personal_ai_player_store.update_one(query, update, upsert=True)
+            await invalidate_cached("personal_ai_player", settings["uid"])
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -781,6 +861,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
+    @cached("personal_ai_player", ttl=60)
     async def query_personal_ai_player(self, uid: str) -> Tuple[Optional[Dict[str, Any]], bool]:
         ai_player = None
         done = False
@@ -973,6 +1054,17 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
+    @staticmethod
+    def _to_timeseries_game_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "meta": {
+                "app_uid": result["app_uid"],
+                "app_game_index": result.get("app_game_index", ""),
+            },
+            "receive_time": datetime.datetime.fromtimestamp(result["create_ts"], tz=datetime.timezone.utc),
+            **{k: v for k, v in result.items() if k not in ("app_uid", "app_game_index")},
+        }
+
     @retry_decorator
     async def add_game_result(self, result: Dict[str, Any] = {}) -> bool:
         done = False
@@ -980,8 +1072,13 @@ class MongoClient(metaclass=Singleton):
             create_ts = int(time.time())
             doc = result
             doc["create_ts"] = create_ts
+            if self._game_result_use_timeseries:
+                doc = self._to_timeseries_game_result(result)
             await self._game_result_store.insert_one(doc)
             done = True
+            # 出错的对战不计入对战统计, 与aggregate_game_win_rate保持一致
+            if result.get("err_code", 0) in (0, None):
+                await self.incr_personal_game_stats(result)
         except perrors.PyMongoError as exc:
             if exc.timeout:
                 await perror(f"Timeout to add new game result for user:{result['app_uid']}.")
@@ -992,6 +1089,282 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
+    async def aggregate_game_win_rate(self, uid: str, since_ts: int = 0, game_index: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        '''
+        按游戏统计用户的对战胜率, 分组键只有游戏索引, 内存占用与用户玩过的游戏数成正比.
+        '''
+        stats: List[Dict[str, Any]] = []
+        done = False
+        try:
+            if self._game_result_use_timeseries:
+                match = {"meta.app_uid": uid}
+                if since_ts > 0:
+                    match["receive_time"] = {"$gte": datetime.datetime.fromtimestamp(since_ts, tz=datetime.timezone.utc)}
+                if game_index is not None:
+                    match["meta.app_game_index"] = game_index
+                group_key = "$meta.app_game_index"
+            else:
+                match = {"app_uid": uid}
+                if since_ts > 0:
+                    match["create_ts"] = {"$gte": since_ts}
+                if game_index is not None:
+                    match["app_game_index"] = game_index
+                group_key = "$app_game_index"
+            # 出错的对战不计入胜率
+            match["err_code"] = {"$in": [0, None]}
+            pipeline = [
+                {"$match": match},
+                # 只保留分组所需字段, 避免把截图等大字段带入后续阶段
+                {"$project": {
+                    "_id": 0,
+                    "game_index": group_key,
+                    "win": {"$cond": [{"$eq": [{"$ifNull": ["$result.win", False]}, True]}, 1, 0]},
+                }},
+                {"$group": {
+                    "_id": "$game_index",
+                    "play_cnt": {"$sum": 1},
+                    "winning_play_cnt": {"$sum": "$win"},
+                }},
+            ]
+            async for x in self._game_result_store.aggregate(pipeline, allowDiskUse=True):
+                stats.append(
+                    {
+                        "game_index": x["_id"],
+                        "play_cnt": x["play_cnt"],
+                        "winning_play_cnt": x["winning_play_cnt"],
+                        "win_rate": x["winning_play_cnt"] / x["play_cnt"] if x["play_cnt"] > 0 else 0.0,
+                    }
+                )
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror(f"Timeout to aggregate game win rate for user:{uid}.")
+            else:
+                await perror(f"Failed to aggregate game win rate for user:{uid}, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to aggregate game win rate for user:{uid}, err:{exc}.")
+        finally:
+            return (stats, done)
+
+    async def migrate_game_results_to_timeseries(self, batch_size: int = 500) -> Tuple[int, bool]:
+        '''
+        把切换到时序集合之前写入game_result的对战结果按_id顺序复制到game_result_ts, 断点保存在game_result_migration中.
+
+        NOTE: 先在切换前执行一次完成大部分迁移, 打开MONGODB_GAME_RESULT_USE_TIMESERIES后再执行一次补齐切换期间的写入.
+        多个实例并发写入时_id不严格递增, 续跑时从断点往前回退一段时间重新扫描, 已迁移过的记录按_id去重.
+        '''
+        migrated_cnt = 0
+        done = False
+        try:
+            if not self._game_result_use_timeseries:
+                raise ValueError("game_result_use_timeseries is not enabled")
+            checkpoint = await self._game_result_migration_store.find_one({"_id": "game_result_ts"})
+            query = {}
+            if checkpoint is not None:
+                since = checkpoint["last_id"].generation_time - datetime.timedelta(seconds=_GAME_RESULT_MIGRATION_RESCAN_SECS)
+                query["_id"] = {"$gt": ObjectId.from_datetime(since)}
+            expire_before_ts = int(time.time()) - self._game_result_expire_secs if self._game_result_expire_secs > 0 else 0
+
+            async def _migrate(batch: List[Dict[str, Any]]) -> int:
+                ids = [x["_id"] for x in batch]
+                # 按(app_uid, receive_time)索引缩小范围后再按_id去重
+                existed = set()
+                async for x in self._game_result_store.find(
+                        {
+                            "meta.app_uid": {"$in": list({x["meta"]["app_uid"] for x in batch})},
+                            "receive_time": {"$gte": min(x["receive_time"] for x in batch), "$lte": max(x["receive_time"] for x in batch)},
+                            "_id": {"$in": ids},
+                        },
+                        projection={"_id": 1},
+                    ):
+                    existed.add(x["_id"])
+                docs = [x for x in batch if x["_id"] not in existed]
+                if len(docs) > 0:
+                    await self._game_result_store.insert_many(docs, ordered=False)
+                await self._game_result_migration_store.update_one(
+                    {"_id": "game_result_ts"},
+                    {"$max": {"last_id": ids[-1]}, "$set": {"update_ts": int(time.time())}},
+                    upsert=True,
+                )
+                return len(docs)
+
+            batch: List[Dict[str, Any]] = []
+            async for doc in self._legacy_game_result_store.find(query).sort("_id", pymongo.ASCENDING).batch_size(batch_size):
+                if doc.get("create_ts", 0) < expire_before_ts:
+                    # 已超出时序集合的过期时间, 写入后也会立即被删除
+                    continue
+                batch.append(self._to_timeseries_game_result(doc))
+                if len(batch) >= batch_size:
+                    migrated_cnt += await _migrate(batch)
+                    batch = []
+            if len(batch) > 0:
+                migrated_cnt += await _migrate(batch)
+            loguru_logger.debug(f"Migrated {migrated_cnt} game results to time-series collection.")
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror("Timeout to migrate game results to time-series collection.")
+            else:
+                await perror(f"Failed to migrate game results to time-series collection, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to migrate game results to time-series collection, err:{exc}.")
+        finally:
+            return (migrated_cnt, done)
+
+    @staticmethod
+    def _is_winning_game_result(result: Dict[str, Any]) -> bool:
+        if result.get("err_code", 0) != 0:
+            return False
+        inner = result.get("result")
+        return isinstance(inner, dict) and inner.get("win", False) is True
+
+    @staticmethod
+    def _personal_game_stats_update(win: bool, play_ts: int) -> List[Dict[str, Any]]:
+        # NOTE: 使用聚合管道形式的更新, 计数器累加/连胜重置/最大连胜在一次upsert内原子完成.
+        update_ts = int(time.time())
+        return [
+            {"$set": {
+                "play_cnt": {"$add": [{"$ifNull": ["$play_cnt", 0]}, 1]},
+                "winning_play_cnt": {"$add": [{"$ifNull": ["$winning_play_cnt", 0]}, 1 if win else 0]},
+                "cur_win_streak": {"$add": [{"$ifNull": ["$cur_win_streak", 0]}, 1]} if win else {"$literal": 0},
+                "last_play_ts": {"$max": [{"$ifNull": ["$last_play_ts", 0]}, play_ts]},
+                "update_ts": update_ts,
+            }},
+            {"$set": {
+                "max_win_streak": {"$max": [{"$ifNull": ["$max_win_streak", 0]}, "$cur_win_streak"]},
+                "win_rate": {"$divide": ["$winning_play_cnt", "$play_cnt"]},
+            }},
+        ]
+
+    async def incr_personal_game_stats(self, result: Dict[str, Any]) -> bool:
+        '''
+        根据一条新的对战结果增量更新用户的对战统计, 单游戏与全部游戏的汇总在同一次bulk_write中提交.
+        '''
+        done = False
+        try:
+            uid = result["app_uid"]
+            game_index = result.get("app_game_index", "")
+            play_ts = result.get("create_ts", int(time.time()))
+            update = self._personal_game_stats_update(self._is_winning_game_result(result), play_ts)
+            await self._personal_game_stats_store.bulk_write(
+                [
+                    pymongo.UpdateOne({"uid": uid, "game_index": game_index}, update, upsert=True),
+                    pymongo.UpdateOne({"uid": uid, "game_index": "all"}, update, upsert=True),
+                ],
+                ordered=False,
+            )
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror(f"Timeout to incr game stats for user:{result['app_uid']}.")
+            else:
+                await perror(f"Failed to incr game stats for user:{result['app_uid']}, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to incr game stats for user:{result.get('app_uid')}, err:{exc}.")
+        finally:
+            return done
+
+    async def query_personal_game_stats(self, uid: str, game_index: str = "all") -> Tuple[Dict[str, Any], bool]:
+        stats = {}
+        done = False
+        try:
+            query = {"uid": uid, "game_index": game_index}
+            doc = await self._personal_game_stats_store.find_one(query, projection={"_id": 0})
+            if doc is not None:
+                stats = doc
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror(f"Timeout to get game stats for user:{uid}.")
+            else:
+                await perror(f"Failed to get game stats for user:{uid}, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to get game stats for user:{uid}, err:{exc}.")
+        finally:
+            return (stats, done)
+
+    async def rebuild_personal_game_stats(self, uid: Optional[str] = None, batch_size: int = 500) -> Tuple[int, bool]:
+        '''
+        从对战结果流水中重建用户的对战统计, 按(用户, 时间)顺序流式遍历, 同一时刻只在内存中保留一个用户的统计.
+        出错的对战不计入统计, 与aggregate_game_win_rate保持一致.
+        '''
+        rebuilt_user_cnt = 0
+        done = False
+        try:
+            if self._game_result_use_timeseries:
+                uid_field, ts_field = "meta.app_uid", "receive_time"
+            else:
+                uid_field, ts_field = "app_uid", "create_ts"
+            query = {"err_code": {"$in": [0, None]}}
+            if uid is not None:
+                query[uid_field] = uid
+            # NOTE: 索引为(uid 1, ts -1), 反向遍历索引即为(uid -1, ts 1), 排序不在内存中进行, 不受100MB限制.
+            # 只需同一用户的结果相邻且按时间先后, 用户之间的顺序无关.
+            sort_rules = [
+                (uid_field, pymongo.DESCENDING),
+                (ts_field, pymongo.ASCENDING),
+            ]
+
+            requests: List[pymongo.ReplaceOne] = []
+            cur_uid = None
+            cur_stats: Dict[str, Dict[str, Any]] = {}
+
+            def _flush_user():
+                update_ts = int(time.time())
+                for game_index, x in cur_stats.items():
+                    x["win_rate"] = x["winning_play_cnt"] / x["play_cnt"]
+                    x["update_ts"] = update_ts
+                    requests.append(pymongo.ReplaceOne({"uid": cur_uid, "game_index": game_index}, x, upsert=True))
+
+            async for doc in self._game_result_store.find(query).sort(sort_rules).batch_size(batch_size):
+                if self._game_result_use_timeseries:
+                    doc_uid, doc_game_index = doc["meta"]["app_uid"], doc["meta"].get("app_game_index", "")
+                    play_ts = int(doc["receive_time"].replace(tzinfo=datetime.timezone.utc).timestamp())
+                else:
+                    doc_uid, doc_game_index = doc["app_uid"], doc.get("app_game_index", "")
+                    play_ts = doc["create_ts"]
+                if doc_uid != cur_uid:
+                    if cur_uid is not None:
+                        _flush_user()
+                        rebuilt_user_cnt += 1
+                    cur_uid = doc_uid
+                    cur_stats = {}
+                    if len(requests) >= batch_size:
+                        await self._personal_game_stats_store.bulk_write(requests, ordered=False)
+                        requests = []
+                win = self._is_winning_game_result(doc)
+                for game_index in (doc_game_index, "all"):
+                    x = cur_stats.setdefault(game_index, {
+                        "uid": doc_uid,
+                        "game_index": game_index,
+                        "play_cnt": 0,
+                        "winning_play_cnt": 0,
+                        "cur_win_streak": 0,
+                        "max_win_streak": 0,
+                        "last_play_ts": 0,
+                    })
+                    x["play_cnt"] += 1
+                    x["winning_play_cnt"] += 1 if win else 0
+                    x["cur_win_streak"] = x["cur_win_streak"] + 1 if win else 0
+                    x["max_win_streak"] = max(x["max_win_streak"], x["cur_win_streak"])
+                    x["last_play_ts"] = max(x["last_play_ts"], play_ts)
+            if cur_uid is not None:
+                _flush_user()
+                rebuilt_user_cnt += 1
+            if len(requests) > 0:
+                await self._personal_game_stats_store.bulk_write(requests, ordered=False)
+            loguru_logger.debug(f"Rebuilt game stats for {rebuilt_user_cnt} users.")
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror(f"Timeout to rebuild game stats for user:{uid}.")
+            else:
+                await perror(f"Failed to rebuild game stats for user:{uid}, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to rebuild game stats for user:{uid}, err:{exc}.")
+        finally:
+            return (rebuilt_user_cnt, done)
+
     async def query_chat_history(self, uid: str, pid: str, offset: int = 0, limit: int = 10) -> Tuple[List[Dict[str, Any]], bool]:
         history: List[Dict[str, Any]] = []
         done = False
@@ -1058,6 +1431,8 @@ class MongoClient(metaclass=Singleton):
                 "update_ts": update_ts,
             }}
             await self._installed_game_store.update_one(query, update, upsert=True)
+            await invalidate_cached("game", game["index"])
+            await invalidate_cached("game_list")
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -1069,6 +1444,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
+    @cached("game_list", ttl=300)
     async def list_games(self, offset: int = 0, limit: int = 5) -> Tuple[List[Dict[str, Any]], bool]:
         game_list: List[Dict[str, Any]] = []
         done = False
@@ -1098,6 +1474,24 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (game_list, done)
 
+    async def list_game_indexes(self) -> Tuple[List[str], bool]:
+        game_indexes: List[str] = []
+        done = False
+        try:
+            async for x in self._installed_game_store.find({}, {"_id": 0, "index": 1}):
+                game_indexes.append(x["index"])
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror("Timeout to list game indexes.")
+            else:
+                await perror(f"Failed to list game indexes, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to list game indexes, err:{exc}.")
+        finally:
+            return (game_indexes, done)
+
+    @cached("game", ttl=300)
     async def query_game(self, game_index: str) -> Tuple[Optional[Dict[str, Any]], bool]:
         game = None
         done = False
@@ -1144,6 +1538,7 @@ class MongoClient(metaclass=Singleton):
                 "update_ts": update_ts,
             }}
             await self._installed_ai_player_store.update_one(query, update, upsert=True)
+            await invalidate_cached("ai_player", ai_player["id"])
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -1155,6 +1550,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
+    @cached("ai_player", ttl=300)
     async def query_ai_player(self, aid: str) -> Tuple[Optional[Dict[str, Any]], bool]:
         ai = None
         done = False
@@ -1173,6 +1569,23 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (ai, done)
 
+    async def list_ai_player_ids(self) -> Tuple[List[str], bool]:
+        aids: List[str] = []
+        done = False
+        try:
+            async for x in self._installed_ai_player_store.find({}, {"_id": 0, "id": 1}):
+                aids.append(x["id"])
+            done = True
+        except perrors.PyMongoError as exc:
+            if exc.timeout:
+                await perror("Timeout to list ai_player ids.")
+            else:
+                await perror(f"Failed to list ai_player ids, err:{exc}.")
+        except Exception as exc:
+            await perror(f"Failed to list ai_player ids, err:{exc}.")
+        finally:
+            return (aids, done)
+
     async def update_ai_player_state(self, aid: str, state: int) -> bool:
         done = False
         try:
@@ -1183,6 +1596,7 @@ class MongoClient(metaclass=Singleton):
                 "update_ts": update_ts,
             }}
             await self._installed_ai_player_store.update_one(query, update, upsert=True)
+            await invalidate_cached("ai_player", aid)
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -1194,7 +1608,49 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
-    async def upsert_installed_game_room_info(self, room: Dict[str, Any], is_for_master: bool = True) -> bool:
+    @staticmethod
+    def _fenced_query(query: Dict[str, Any], fencing_token: int) -> Dict[str, Any]:
+        return {
+            **query,
+            "$or": [
+                {"fencing_token": {"$exists": False}},
+                {"fencing_token": {"$lte": fencing_token}},
+            ],
+        }
+
+    async def _fenced_update_one(self, store, query: Dict[str, Any], update: Dict[str, Any], fencing_token: Optional[int], **kwargs):
+        '''
+        以fencing令牌作为条件写入: 文档上记录的令牌比当前令牌大时说明锁已被别人重新获得, 放弃写入并抛出StaleFencingToken.
+        '''
+        if fencing_token is None:
+            return await store.update_one(query, update, **kwargs)
+        update = {**update, "$set": {**update.get("$set", {}), "fencing_token": fencing_token}}
+        try:
+            res = await store.update_one(self._fenced_query(query, fencing_token), update, **kwargs)
+        except perrors.DuplicateKeyError:
+            # NOTE: 条件不满足时upsert会尝试插入一条同id的新文档, 被唯一索引拒绝
+            raise StaleFencingToken(f"Stale fencing token:{fencing_token}, query:{query}")
+        if res.matched_count == 0 and res.upserted_id is None:
+            raise StaleFencingToken(f"Stale fencing token:{fencing_token}, query:{query}")
+        return res
+
+    async def _fence_room(self, room_id: str, fencing_token: Optional[int], session=None):
+        '''
+        在事务开始时推进房间文档上的fencing令牌, 令牌过期(小于已记录的令牌)时抛出StaleFencingToken中止后续写入.
+        同一房间的并发事务都会写这个文档, 由MongoDB的写冲突检测保证只有一个能提交.
+        '''
+        if fencing_token is None:
+            return
+        doc = await self._installed_game_room_store.find_one_and_update(
+            {"id": room_id},
+            {"$max": {"fencing_token": fencing_token}},
+            projection={"fencing_token": True},
+            session=session,
+        )
+        if (doc is not None) and (doc.get("fencing_token", 0) > fencing_token):
+            raise StaleFencingToken(f"Stale fencing token:{fencing_token} of room:{room_id}, current:{doc['fencing_token']}")
+
+    async def upsert_installed_game_room_info(self, room: Dict[str, Any], is_for_master: bool = True, fencing_token: Optional[int] = None) -> bool:
         done = False
         try:
             query = {"id": room["id"]}
@@ -1249,7 +1705,7 @@ class MongoClient(metaclass=Singleton):
                     "update_ts": update_ts,
                 }}
 
-            await self._installed_game_room_store.update_one(query, update, upsert=True)
+            await self._fenced_update_one(self._installed_game_room_store, query, update, fencing_token, upsert=True)
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -1261,7 +1717,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return done
 
-    async def upsert_game_room_info(self, room: Dict[str, Any]) -> bool:
+    async def upsert_game_room_info(self, room: Dict[str, Any], fencing_token: Optional[int] = None) -> bool:
         done = False
         try:
             query = {"id": room["id"]}
@@ -1281,7 +1737,7 @@ class MongoClient(metaclass=Singleton):
                 "be_hosting": room["be_hosting"],
                 "update_ts": update_ts,
             }}
-            await self._game_room_store.update_one(query, update, upsert=True)
+            await self._fenced_update_one(self._game_room_store, query, update, fencing_token, upsert=True)
             done = True
         except perrors.PyMongoError as exc:
             if exc.timeout:
@@ -1557,7 +2013,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (room, done)
 
-    async def upsert_game_room_online_users(self, room_user: Dict[str, Any]) -> bool:
+    async def upsert_game_room_online_users(self, room_user: Dict[str, Any], fencing_token: Optional[int] = None) -> bool:
         done = False
 
         while 1:
@@ -1565,6 +2021,7 @@ class MongoClient(metaclass=Singleton):
             try:
                 async with self._db_session.start_transaction(read_preference=pymongo.ReadPreference.PRIMARY):
                     try:
+                        await self._fence_room(room_user["room_id"], fencing_token, session=self._db_session)
                         # NOTE: 由于游戏房间在线用户的更新频率非常高, 为了避免频繁的IO操作, 这里使用了事务.
                         # 事务为什么能避免频繁的IO操作? 因为事务内的操作会被缓存, 只有事务提交时才会真正执行.
                         query = {"room_id": room_user["room_id"], "user_id": room_user["user_id"]}
@@ -1651,7 +2108,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (online_user_list, done)
 
-    async def upsert_game_room_in_game_queue_users(self, room_user: Dict[str, Any], force_exit: bool = False) -> Tuple[bool, bool, bool, bool, bool, int, bool]:
+    async def upsert_game_room_in_game_queue_users(self, room_user: Dict[str, Any], force_exit: bool = False, fencing_token: Optional[int] = None) -> Tuple[bool, bool, bool, bool, bool, int, bool]:
         # 用于标识操作是否被允许
         can = False
         # 用于标识坑位是否已被占
@@ -1672,6 +2129,7 @@ class MongoClient(metaclass=Singleton):
             try:
                 async with self._db_session.start_transaction(read_preference=pymongo.ReadPreference.PRIMARY):
                     try:
+                        await self._fence_room(room_user["room_id"], fencing_token, session=self._db_session)
                         query = {"room_id": room_user["room_id"], "user_id": room_user["user_id"]}
                         doc1 = await self._game_room_in_game_queue_users_store.find_one(query, session=self._db_session)
                         doc2 = await self._game_room_in_game_battle_users_store.find_one(query, session=self._db_session)
@@ -1797,7 +2255,7 @@ class MongoClient(metaclass=Singleton):
 
         return (can, occupied, full, filtered, frozen, frozen_time_left, done)
 
-    async def upsert_game_room_in_game_queue_be_ready_users(self, room_user: Dict[str, Any]) -> Tuple[bool, bool, bool]:
+    async def upsert_game_room_in_game_queue_be_ready_users(self, room_user: Dict[str, Any], fencing_token: Optional[int] = None) -> Tuple[bool, bool, bool]:
         can = False
         all_ready = False
         done = False
@@ -1807,6 +2265,7 @@ class MongoClient(metaclass=Singleton):
             try:
                 async with self._db_session.start_transaction(read_preference=pymongo.ReadPreference.PRIMARY):
                     try:
+                        await self._fence_room(room_user["room_id"], fencing_token, session=self._db_session)
                         query = {"room_id": room_user["room_id"], "user_id": room_user["user_id"]}
                         doc1 = await self._game_room_in_game_queue_be_ready_users_store.find_one(query, session=self._db_session)
                         doc2 = await self._game_room_in_game_battle_users_store.find_one(query, session=self._db_session)
@@ -1910,7 +2369,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (in_game_queue_user_list, done)
 
-    async def upsert_game_room_in_game_battle_users(self, room_user: Dict[str, Any]) -> Tuple[bool, bool]:
+    async def upsert_game_room_in_game_battle_users(self, room_user: Dict[str, Any], fencing_token: Optional[int] = None) -> Tuple[bool, bool]:
         all_in_game_battle = False
         done = False
         
@@ -1919,6 +2378,7 @@ class MongoClient(metaclass=Singleton):
             try:
                 async with self._db_session.start_transaction(read_preference=pymongo.ReadPreference.PRIMARY):
                     try:
+                        await self._fence_room(room_user["room_id"], fencing_token, session=self._db_session)
                         query = {"room_id": room_user["room_id"], "user_id": room_user["user_id"]}
                         doc = await self._game_room_in_game_battle_users_store.find_one(query, session=self._db_session)
                         if (doc is not None) and (doc["in_game_battle"] == room_user["in_game_battle"]):
@@ -2032,7 +2492,7 @@ class MongoClient(metaclass=Singleton):
         finally:
             return (room_id, done)
 
-    async def upsert_game_room_users(self, room_user: Dict[str, Any]) -> bool:
+    async def upsert_game_room_users(self, room_user: Dict[str, Any], fencing_token: Optional[int] = None) -> bool:
         done = False
 
         while 1:
@@ -2040,6 +2500,7 @@ class MongoClient(metaclass=Singleton):
             try:
                 async with self._db_session.start_transaction(read_preference=pymongo.ReadPreference.PRIMARY):
                     try:
+                        await self._fence_room(room_user["room_id"], fencing_token, session=self._db_session)
                         update_ts = int(time.time())
 
                         query = {"room_id": room_user["room_id"], "user_id": room_user["user_id"]}
@@ -2,14 +2,21 @@
 import asyncio
 import jsonschema
 import redis.asyncio as aio_redis
+import redis.asyncio.cluster as aio_redis_cluster
 import redis.exceptions as redis_exceptions
 import time
 
+from internal.extensions.ext_redis.client_cache import ClientSideCache
+from internal.extensions.ext_redis.codec import ObjectCodec
+from internal.extensions.ext_redis.metrics import RedisMetrics
+from internal.extensions.ext_redis.pool import InstrumentedBlockingConnectionPool, \
+    tcp_keepalive_options
 from internal.infra.alarm import perror
 from internal.singleton import Singleton
 from internal.utils.helper import get_midnight_timestamp
 from loguru import logger as loguru_logger
 from typing import Any, \
+    Callable, \
     Dict, \
     List, \
     Optional, \
@@ -21,6 +28,197 @@ class RedisClientSetupException(Exception):
     pass
 
 
+# KEYS: 令牌桶key列表; ARGV[1]: 过期时间点(unix时间戳); ARGV[2]: 是否扣减(0/1); ARGV[3..]: 每个令牌桶的每日总量.
+# 只有所有令牌桶都还有剩余时才会扣减, 返回每个令牌桶的剩余数量.
+# NOTE: 集群模式下同一次调用的所有令牌桶key必须落在同一个slot上(使用相同的hash tag), 否则会返回CROSSSLOT错误.
+DAILY_TOKEN_SCRIPT = """local expire_at = tonumber(ARGV[1])
+local take = tonumber(ARGV[2]) == 1
+local remaining = {}
+local all_available = true
+for i, key in ipairs(KEYS) do
+    local n = tonumber(redis.call("GET", key))
+    if n == nil then
+        n = tonumber(ARGV[i + 2])
+    end
+    remaining[i] = n
+    if n <= 0 then
+        all_available = false
+    end
+end
+if take and all_available then
+    for i, key in ipairs(KEYS) do
+        remaining[i] = remaining[i] - 1
+        redis.call("SET", key, remaining[i])
+        redis.call("EXPIREAT", key, expire_at)
+    end
+end
+return remaining"""
+
+
+def _decode_string(value: Any) -> Tuple[Optional[str], bool]:
+    if value is not None and isinstance(value, bytes):
+        return (value.decode("utf-8"), True)
+    return (None, False)
+
+
+def _decode_integer(value: Any) -> Tuple[Optional[int], bool]:
+    if value is not None and isinstance(value, bytes):
+        return (int(value.decode("utf-8")), True)
+    return (None, False)
+
+
+def _decode_reply(value: Any) -> Tuple[Any, bool]:
+    return (value, value is not None)
+
+
+def _object_decoder(codec: ObjectCodec, schema_version: Optional[int]) -> Callable[[Any], Tuple[Any, bool]]:
+    '''
+    schema_version不为None时, 版本号不一致的值视为不存在.
+    '''
+    def _decode_object(value: Any) -> Tuple[Any, bool]:
+        if value is None or not isinstance(value, bytes):
+            return (None, False)
+        obj, version = codec.decode(value)
+        if schema_version is not None and version != schema_version:
+            return (None, False)
+        return (obj, True)
+    return _decode_object
+
+
+class RedisBatchResult(object):
+    '''
+    批量命令中单条命令的结果, 语义与单条命令的(value, existed, done)一致, 在批量执行结束后才会被填充.
+    '''
+
+    __slots__ = ("value", "existed", "done")
+
+    def __init__(self) -> None:
+        self.value = None
+        self.existed = False
+        self.done = False
+
+    def unpack(self) -> Tuple[Any, bool, bool]:
+        return (self.value, self.existed, self.done)
+
+
+class RedisBatch(object):
+    '''
+    把多条不同类型的命令攒到一个非事务pipeline中, 一次网络往返执行完毕.
+
+    用法:
+        async with cache_instance().batch() as batch:
+            device_id = batch.get_string(key1)
+            device_type = batch.get_integer(key2)
+        value, existed, done = device_id.unpack()
+    '''
+
+    def __init__(
+            self,
+            conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+            codec: Optional[ObjectCodec] = None,
+            metrics: Optional[RedisMetrics] = None,
+        ) -> None:
+        self._conn = conn
+        self._codec = codec if codec is not None else ObjectCodec()
+        self._metrics = metrics
+        self._keys: List[str] = []
+        self._pipe = conn.pipeline(transaction=False)
+        self._pending: List[Tuple[Callable[[Any], Tuple[Any, bool]], RedisBatchResult]] = []
+        self.done = False
+
+    def _queue(self, decoder: Callable[[Any], Tuple[Any, bool]], *args) -> RedisBatchResult:
+        result = RedisBatchResult()
+        self._pipe.execute_command(*args)
+        self._keys.append(args[1])
+        self._pending.append((decoder, result))
+        return result
+
+    def get_string(self, key: str) -> RedisBatchResult:
+        return self._queue(_decode_string, "GET", key)
+
+    def get_integer(self, key: str) -> RedisBatchResult:
+        return self._queue(_decode_integer, "GET", key)
+
+    def get_obj(self, key: str, schema_version: Optional[int] = None) -> RedisBatchResult:
+        return self._queue(_object_decoder(self._codec, schema_version), "GET", key)
+
+    def cache_string(self, key: str, value: str, ttl: int = 0) -> RedisBatchResult:
+        if ttl > 0:
+            return self._queue(_decode_reply, "SET", key, value, "EX", ttl)
+        return self._queue(_decode_reply, "SET", key, value)
+
+    def cache_obj(self, key: str, value: Any, ttl: int = 0, schema_version: int = 1) -> RedisBatchResult:
+        return self.cache_string(key, self._codec.encode(value, schema_version), ttl)
+
+    def cache_string_if_absent(self, key: str, value: Union[str, int]) -> RedisBatchResult:
+        return self._queue(_decode_reply, "SET", key, value, "NX")
+
+    def cache_hash_fields_if_absent(self, key: str, mapping: Dict[str, Union[str, int]]) -> List[RedisBatchResult]:
+        return [self._queue(_decode_reply, "HSETNX", key, field, value) for field, value in mapping.items()]
+
+    def cache_integer(self, key: str, value: int, ttl: int = 0) -> RedisBatchResult:
+        if ttl > 0:
+            return self._queue(_decode_reply, "SET", key, value, "EX", ttl)
+        return self._queue(_decode_reply, "SET", key, value)
+
+    def incr_integer(self, key: str) -> RedisBatchResult:
+        return self._queue(_decode_reply, "INCR", key)
+
+    def decr_integer(self, key: str) -> RedisBatchResult:
+        return self._queue(_decode_reply, "DECR", key)
+
+    def expire(self, key: str, ttl: int) -> RedisBatchResult:
+        return self._queue(_decode_reply, "EXPIRE", key, ttl)
+
+    def delete(self, key: str) -> RedisBatchResult:
+        return self._queue(_decode_reply, "DEL", key)
+
+    async def execute(self) -> bool:
+        pending, self._pending = self._pending, []
+        keys, self._keys = self._keys, []
+        if len(pending) == 0:
+            self.done = True
+            return self.done
+
+        self.done = False
+        st = time.perf_counter()
+        try:
+            # NOTE: execute结束时pipeline会自行清空命令栈并归还连接, 单机/集群pipeline都不需要再手动reset.
+            error = True
+            try:
+                replies = await self._pipe.execute(raise_on_error=False)
+                error = False
+            finally:
+                if self._metrics is not None:
+                    self._metrics.observe("PIPELINE", keys, time.perf_counter() - st, error)
+            self.done = True
+            for (decoder, result), reply in zip(pending, replies):
+                if isinstance(reply, Exception):
+                    self.done = False
+                    await perror(f"Failed to exec batched command, err:{reply}")
+                    continue
+                result.value, result.existed = decoder(reply)
+                result.done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to exec {len(pending)} batched commands.")
+        except Exception as e:
+            await perror(f"Failed to exec {len(pending)} batched commands, err:{e}")
+        finally:
+            return self.done
+
+    async def __aenter__(self) -> "RedisBatch":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            await self.execute()
+        else:
+            # 尚未执行的命令只是缓存在本地, 直接丢弃即可.
+            self._pending = []
+            self._keys = []
+            self._pipe = self._conn.pipeline(transaction=False)
+
+
 class RedisClient(metaclass=Singleton):
     '''
     Redis自定义客户端
@@ -32,6 +230,17 @@ class RedisClient(metaclass=Singleton):
             "endpoint": {"type": "string"},
             "password": {"type": "string"},
             "db": {"type": "number"},
+            "cluster_mode": {"type": "boolean"},
+            "codec_compress_threshold": {"type": "number"},
+            "hot_key_sample_rate": {"type": "number"},
+            "client_cache_prefixes": {"type": "array", "items": {"type": "string"}},
+            "client_cache_max_entries": {"type": "number"},
+            "max_connections": {"type": "number"},
+            "pool_timeout": {"type": "number"},
+            "health_check_interval": {"type": "number"},
+            "socket_keepalive": {"type": "boolean"},
+            "socket_timeout": {"type": "number"},
+            "socket_connect_timeout": {"type": "number"},
         },
         "required": [
             "endpoint",
@@ -44,15 +253,68 @@ class RedisClient(metaclass=Singleton):
         if not self._validate_config(client_conf):
             raise RedisClientSetupException("Please provide valid redis config file.")
 
-        host, port = client_conf["endpoint"].split(":")[0], int(client_conf["endpoint"].split(":")[1])
-        self._conn = aio_redis.Redis(
+        # endpoint为逗号分隔的"host:port"列表, 集群模式下作为种子节点, 单机模式下只使用第一个.
+        endpoints = [
+            (endpoint.strip().split(":")[0], int(endpoint.strip().split(":")[1]))
+            for endpoint in client_conf["endpoint"].split(",") if len(endpoint.strip()) > 0
+        ]
+        host, port = endpoints[0]
+        socket_keepalive = client_conf.get("socket_keepalive", True)
+        self._cluster_mode = client_conf.get("cluster_mode", False)
+        self._codec = ObjectCodec(compress_threshold=int(client_conf.get("codec_compress_threshold", 1024)))
+        self._metrics = RedisMetrics(hot_key_sample_rate=client_conf.get("hot_key_sample_rate", 0.05))
+        self._pool: Optional[InstrumentedBlockingConnectionPool] = None
+        self._pubsub_conn: Optional[aio_redis.Redis] = None
+        if self._cluster_mode:
+            # NOTE: 集群客户端为每个节点维护独立的连接池, 并根据MOVED/ASK自动刷新slot路由表. 集群不支持select db.
+            self._conn = aio_redis_cluster.RedisCluster(
+                startup_nodes=[aio_redis_cluster.ClusterNode(h, p) for h, p in endpoints],
+                password=client_conf["password"],
+                max_connections=int(client_conf.get("max_connections", 64)),
+                health_check_interval=client_conf.get("health_check_interval", 30),
+                socket_keepalive=socket_keepalive,
+                socket_keepalive_options=tcp_keepalive_options() if socket_keepalive else None,
+                socket_timeout=client_conf.get("socket_timeout", 5),
+                socket_connect_timeout=client_conf.get("socket_connect_timeout", 2),
+            )
+            self._pubsub_conn = aio_redis.Redis(
+                host=host,
+                port=port,
+                password=client_conf["password"],
+                health_check_interval=client_conf.get("health_check_interval", 30),
+                socket_keepalive=socket_keepalive,
+                socket_keepalive_options=tcp_keepalive_options() if socket_keepalive else None,
+                socket_connect_timeout=client_conf.get("socket_connect_timeout", 2),
+            )
+        else:
+            # NOTE: 连接数达到上限后, 新请求最多阻塞等待pool_timeout秒, 而不是无限制地新建连接.
+            self._pool = InstrumentedBlockingConnectionPool(
+                host=host,
+                port=port,
+                password=client_conf["password"],
+                db=client_conf["db"],
+                max_connections=int(client_conf.get("max_connections", 64)),
+                timeout=client_conf.get("pool_timeout", 2),
+                health_check_interval=client_conf.get("health_check_interval", 30),
+                socket_keepalive=socket_keepalive,
+                socket_keepalive_options=tcp_keepalive_options() if socket_keepalive else None,
+                socket_timeout=client_conf.get("socket_timeout", 5),
+                socket_connect_timeout=client_conf.get("socket_connect_timeout", 2),
+            )
+            self._conn = aio_redis.Redis(connection_pool=self._pool)
+        # NOTE: register_script走EVALSHA, 遇到NOSCRIPT时自动回退为EVAL并缓存脚本.
+        self._daily_token_script = self._conn.register_script(DAILY_TOKEN_SCRIPT)
+        # 对很少变化却被频繁读取的key前缀开启客户端缓存.
+        # NOTE: 跟踪连接只连到单个节点, 收不到其他分片的invalidate消息, 所以集群模式下不启用.
+        self._client_cache = ClientSideCache(
             host=host,
             port=port,
             password=client_conf["password"],
             db=client_conf["db"],
-            socket_timeout=5,
-            socket_connect_timeout=2,
+            prefixes=[] if self._cluster_mode else client_conf.get("client_cache_prefixes", []),
+            max_entries=int(client_conf.get("client_cache_max_entries", 10000)),
         )
+        self._client_cache.start()
 
     def _validate_config(self, conf: Optional[Dict[str, Any]] = None) -> bool:
         valid = False
@@ -73,27 +335,102 @@ class RedisClient(metaclass=Singleton):
         finally:
             return connected
 
-    def get_connection(self) -> aio_redis.Redis:
+    def get_connection(self) -> Union[aio_redis.Redis, aio_redis_cluster.RedisCluster]:
         return self._conn
 
-    async def init_cache(self, pairs: List[Tuple[str, Union[str, int]]]) -> bool:
+    def get_pubsub_connection(self) -> aio_redis.Redis:
+        '''
+        集群客户端不支持pub/sub, 集群模式下返回连到某一个节点的独立连接(PUBLISH会在集群内广播), 单机模式下与get_connection()相同.
+        '''
+        return self._pubsub_conn if self._pubsub_conn is not None else self._conn
+
+    def is_cluster_mode(self) -> bool:
+        return self._cluster_mode
+
+    def batch(self) -> RedisBatch:
+        return RedisBatch(self._conn, codec=self._codec, metrics=self._metrics)
+
+    def pool_stats(self) -> Dict[str, Any]:
+        if self._pool is None:
+            return {}
+        return self._pool.stats()
+
+    def client_cache_stats(self) -> Dict[str, Any]:
+        return self._client_cache.stats()
+
+    def codec_stats(self) -> Dict[str, Any]:
+        return self._codec.stats()
+
+    def metrics_stats(self, top_k: int = 20) -> Dict[str, Any]:
+        return self._metrics.stats(top_k)
+
+    async def _command(self, *args) -> Any:
+        '''
+        执行单条命令并记录耗时, args[0]为命令名, MGET的所有参数都是key, 其他命令只有args[1]是key.
+        '''
+        st = time.perf_counter()
+        error = True
+        try:
+            reply = await self._conn.execute_command(*args)
+            error = False
+            return reply
+        finally:
+            self._metrics.observe(args[0], args[1:] if args[0] == "MGET" else args[1:2], time.perf_counter() - st, error)
+
+    async def _mget_nonatomic(self, keys: List[str]) -> List[Any]:
+        st = time.perf_counter()
+        error = True
+        try:
+            replies = await self._conn.mget_nonatomic(keys)
+            error = False
+            return replies
+        finally:
+            self._metrics.observe("MGET", keys, time.perf_counter() - st, error)
+
+    async def _mget(self, keys: List[str]) -> List[Any]:
+        if self._cluster_mode:
+            # NOTE: 集群模式下MGET的key必须落在同一个slot上, mget_nonatomic按slot拆分后并发执行.
+            replies = await self._mget_nonatomic(keys)
+        else:
+            replies = await self._command("MGET", *keys)
+        return replies
+
+    async def _get(self, key: str) -> Any:
+        if not self._client_cache.is_tracked(key):
+            return await self._command("GET", key)
+        found, value = self._client_cache.get(key)
+        if not found:
+            seq = self._client_cache.seq()
+            value = await self._command("GET", key)
+            self._client_cache.set(key, value, seq)
+        return value
+
+    async def init_cache(self, pairs: List[Tuple[str, Union[str, int, Any]]], ttl: int = 0, batch_size: int = 500) -> bool:
+        '''
+        按batch_size分批用pipeline写入, 每批一次网络往返. 字符串和整数原样写入, 其他值走cache_obj的编码.
+        '''
         done = True
-        for kv in pairs:
-            if isinstance(kv[1], str):
-                done = await self.cache_string(kv[0], kv[1])
-            elif isinstance(kv[1], int):
-                done = await self.cache_integer(kv[0], kv[1])
+        for i in range(0, len(pairs), batch_size):
+            batch = self.batch()
+            for key, value in pairs[i:i + batch_size]:
+                if isinstance(value, (str, int)):
+                    batch.cache_string(key, value, ttl)
+                else:
+                    batch.cache_obj(key, value, ttl)
+                self._client_cache.discard(key)
+            done = await batch.execute()
             if not done:
                 break
         return done
         
-    async def cache_string(self, key: str, value: str, ttl: int = 0) -> bool:
+    async def cache_string(self, key: str, value: Union[str, bytes], ttl: int = 0) -> bool:
         done = False
         try:
             if ttl > 0:
-                await self._conn.execute_command("SET", key, value, "EX", ttl)
+                await self._command("SET", key, value, "EX", ttl)
             else:
-                await self._conn.execute_command("SET", key, value)
+                await self._command("SET", key, value)
+            self._client_cache.discard(key)
             done = True
         except redis_exceptions.TimeoutError:
             await perror(f"Timeout to set value for key:{key}.")
@@ -107,7 +444,7 @@ class RedisClient(metaclass=Singleton):
         existed = False
         done = False
         try:
-            value = await self._conn.execute_command("GET", key)
+            value = await self._get(key)
             if value is not None and isinstance(value, bytes):
                 value = value.decode("utf-8")
                 existed = True
@@ -119,13 +456,77 @@ class RedisClient(metaclass=Singleton):
         finally:
             return (value, existed, done)
 
+    async def cache_obj(self, key: str, value: Any, ttl: int = 0, schema_version: int = 1) -> bool:
+        '''
+        以二进制编码缓存结构化对象, 结构变化不兼容时调用方应递增schema_version.
+        '''
+        done = False
+        try:
+            raw = self._codec.encode(value, schema_version)
+        except Exception as e:
+            await perror(f"Failed to encode value for key:{key}, err:{e}")
+            return done
+        return await self.cache_string(key, raw, ttl)
+
+    async def get_obj(self, key: str, schema_version: Optional[int] = None) -> Tuple[Optional[Any], bool, bool]:
+        '''
+        schema_version不为None时, 版本号不一致的旧数据视为不存在(existed为False).
+        '''
+        value = None
+        existed = False
+        done = False
+        try:
+            value, existed = _object_decoder(self._codec, schema_version)(await self._get(key))
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to get value for key:{key}.")
+        except Exception as e:
+            await perror(f"Failed to get value for key:{key}, err:{e}")
+        finally:
+            return (value, existed, done)
+
+    async def mget_strings(self, keys: List[str]) -> Tuple[List[Optional[str]], List[bool], bool]:
+        values: List[Optional[str]] = [None] * len(keys)
+        existed: List[bool] = [False] * len(keys)
+        done = False
+        try:
+            if len(keys) > 0:
+                replies = await self._mget(keys)
+                for i, reply in enumerate(replies):
+                    values[i], existed[i] = _decode_string(reply)
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to get values for keys:{keys}.")
+        except Exception as e:
+            await perror(f"Failed to get values for keys:{keys}, err:{e}")
+        finally:
+            return (values, existed, done)
+
+    async def mget_integers(self, keys: List[str]) -> Tuple[List[Optional[int]], List[bool], bool]:
+        values: List[Optional[int]] = [None] * len(keys)
+        existed: List[bool] = [False] * len(keys)
+        done = False
+        try:
+            if len(keys) > 0:
+                replies = await self._mget(keys)
+                for i, reply in enumerate(replies):
+                    values[i], existed[i] = _decode_integer(reply)
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to get values for keys:{keys}.")
+        except Exception as e:
+            await perror(f"Failed to get values for keys:{keys}, err:{e}")
+        finally:
+            return (values, existed, done)
+
     async def cache_integer(self, key: str, value: int, ttl: int = 0) -> bool:
         done = False
         try:
             if ttl > 0:
-                await self._conn.execute_command("SET", key, value, "EX", ttl)
+                await self._command("SET", key, value, "EX", ttl)
             else:
-                await self._conn.execute_command("SET", key, value)
+                await self._command("SET", key, value)
+            self._client_cache.discard(key)
             done = True
         except redis_exceptions.TimeoutError:
             await perror(f"Timeout to set value for key:{key}.")
@@ -137,7 +538,8 @@ class RedisClient(metaclass=Singleton):
     async def incr_integer(self, key: str) -> bool:
         done = False
         try:
-            await self._conn.execute_command("INCR", key)
+            await self._command("INCR", key)
+            self._client_cache.discard(key)
             done = True
         except redis_exceptions.TimeoutError:
             await perror(f"Timeout to incr for key:{key}.")
@@ -149,7 +551,8 @@ class RedisClient(metaclass=Singleton):
     async def decr_integer(self, key: str) -> bool:
         done = False
         try:
-            await self._conn.execute_command("DECR", key)
+            await self._command("DECR", key)
+            self._client_cache.discard(key)
             done = True
         except redis_exceptions.TimeoutError:
             await perror(f"Timeout to decr for key:{key}.")
@@ -163,7 +566,7 @@ class RedisClient(metaclass=Singleton):
         existed = False
         done = False
         try:
-            value = await self._conn.execute_command("GET", key)
+            value = await self._get(key)
             if value is not None and isinstance(value, bytes):
                 value = int(value.decode("utf-8"))
                 existed = True
@@ -175,52 +578,135 @@ class RedisClient(metaclass=Singleton):
         finally:
             return (value, existed, done)
 
-    async def get_daily_token(self, key: str, total: int = 5) -> Tuple[int, bool]:
-        remaining = 0
+    async def get_hash_fields(self, key: str, fields: List[str]) -> Tuple[Dict[str, Optional[str]], bool]:
+        '''
+        用一次HGETALL读取hash中的多个字段. 只读hash, 迁移前的string key要先用migrate_keys --hash-layout搬进hash.
+        '''
+        values: Dict[str, Optional[str]] = {field: None for field in fields}
         done = False
         try:
-            existed = await self._conn.execute_command("EXISTS", key)
-            if existed == 0:
-                remaining = total
-            else:
-                res = await self._conn.execute_command("GET", key)
-                remaining = int(res)
+            tracked = self._client_cache.is_tracked(key)
+            found, hvalues = self._client_cache.get(key) if tracked else (False, None)
+            if not found:
+                seq = self._client_cache.seq()
+                reply = await self._command("HGETALL", key)
+                pairs = reply.items() if isinstance(reply, dict) else zip(reply[::2], reply[1::2])
+                hvalues = {_decode_string(k)[0]: _decode_string(v)[0] for k, v in pairs}
+                if tracked:
+                    self._client_cache.set(key, hvalues, seq)
+            for field in fields:
+                values[field] = hvalues.get(field)
             done = True
         except redis_exceptions.TimeoutError:
-            await perror(f"Timeout to get daily token for key:{key}.")
+            await perror(f"Timeout to get fields for key:{key}.")
         except Exception as e:
-            await perror(f"Failed to get daily token for key:{key}, err:{e}")
+            await perror(f"Failed to get fields for key:{key}, err:{e}")
         finally:
-            return (remaining, done)
+            return (values, done)
+
+    async def set_hash_fields(self, key: str, mapping: Dict[str, Union[str, int]], string_keys: Dict[str, str]) -> bool:
+        '''
+        写入hash中的多个字段, string_keys为字段到迁移前string key的映射(见keys.hash_fields).
+        NOTE: 同一个事务中删除对应的string key, 写入方切换到hash之后不会留下会被误读的旧值.
+        hash与这些string key带有相同的hash tag, 集群模式下也在同一个slot上.
+        '''
+        done = False
+        try:
+            if len(mapping) > 0:
+                args = []
+                for field, value in mapping.items():
+                    args.extend([field, value])
+                st = time.perf_counter()
+                error = True
+                try:
+                    pipe = self._conn.pipeline(transaction=True)
+                    pipe.execute_command("HSET", key, *args)
+                    stale = [string_keys[field] for field in mapping if field in string_keys]
+                    if len(stale) > 0:
+                        pipe.execute_command("DEL", *stale)
+                    await pipe.execute()
+                    error = False
+                finally:
+                    self._metrics.observe("PIPELINE", [key], time.perf_counter() - st, error)
+                self._client_cache.discard(key)
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to set fields for key:{key}.")
+        except Exception as e:
+            await perror(f"Failed to set fields for key:{key}, err:{e}")
+        finally:
+            return done
+
+    async def delete_hash_fields(self, key: str, string_keys: Dict[str, str]) -> bool:
+        '''
+        删除hash中的多个字段以及对应的迁移前string key, string_keys同set_hash_fields.
+        '''
+        done = False
+        try:
+            if len(string_keys) > 0:
+                st = time.perf_counter()
+                error = True
+                try:
+                    pipe = self._conn.pipeline(transaction=True)
+                    pipe.execute_command("HDEL", key, *string_keys.keys())
+                    pipe.execute_command("DEL", *string_keys.values())
+                    await pipe.execute()
+                    error = False
+                finally:
+                    self._metrics.observe("PIPELINE", [key], time.perf_counter() - st, error)
+                self._client_cache.discard(key)
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to delete fields for key:{key}.")
+        except Exception as e:
+            await perror(f"Failed to delete fields for key:{key}, err:{e}")
+        finally:
+            return done
+
+    async def get_daily_token(self, key: str, total: int = 5) -> Tuple[int, bool]:
+        remaining, done = await self.get_daily_tokens([(key, total)])
+        return (remaining[0] if done else 0, done)
 
     async def take_daily_token(self, key: str, total: int = 5) -> Tuple[int, bool]:
-        remaining = 0
+        remaining, done = await self.take_daily_tokens([(key, total)])
+        return (remaining[0] if done else 0, done)
+
+    async def get_daily_tokens(self, buckets: List[Tuple[str, int]]) -> Tuple[List[int], bool]:
+        return await self._eval_daily_token_script(buckets, take=False)
+
+    async def take_daily_tokens(self, buckets: List[Tuple[str, int]]) -> Tuple[List[int], bool]:
+        '''
+        原子地从多个令牌桶中各取一个令牌, 任一令牌桶已耗尽时都不扣减.
+        '''
+        return await self._eval_daily_token_script(buckets, take=True)
+
+    async def _eval_daily_token_script(self, buckets: List[Tuple[str, int]], take: bool) -> Tuple[List[int], bool]:
+        remaining = [0] * len(buckets)
         done = False
+        keys = [bucket[0] for bucket in buckets]
+        st = time.perf_counter()
         try:
-            existed = await self._conn.execute_command("EXISTS", key)
-            if existed == 0:
-                remaining = total - 1
-                await self._conn.execute_command("SET", key, remaining)
-                await self._conn.execute_command("EXPIRE", key, get_midnight_timestamp() - int(time.time()))
-            else:
-                res = await self._conn.execute_command("GET", key)
-                old_remaining = int(res)
-                if old_remaining > 0:
-                    remaining = old_remaining - 1
-                    await self._conn.execute_command("SET", key, remaining)
-                    await self._conn.execute_command("EXPIRE", key, get_midnight_timestamp() - int(time.time()))
-                else:
-                    remaining = old_remaining
+            res = await self._daily_token_script(
+                keys=keys,
+                args=[get_midnight_timestamp(), 1 if take else 0] + [bucket[1] for bucket in buckets],
+            )
+            remaining = [int(n) for n in res]
             done = True
+            self._metrics.observe("EVALSHA", keys, time.perf_counter() - st)
         except redis_exceptions.TimeoutError:
-            await perror(f"Timeout to take daily token for key:{key}.")
+            await perror(f"Timeout to {'take' if take else 'get'} daily token for keys:{keys}.")
         except Exception as e:
-            await perror(f"Failed to take daily token for key:{key}, err:{e}")
+            await perror(f"Failed to {'take' if take else 'get'} daily token for keys:{keys}, err:{e}")
         finally:
             return (remaining, done)
 
     async def close(self):
+        await self._client_cache.stop()
         await self._conn.aclose()
+        if self._pubsub_conn is not None:
+            await self._pubsub_conn.aclose()
+        if self._pool is not None:
+            await self._pool.disconnect()
 
 
 _instance: RedisClient = None
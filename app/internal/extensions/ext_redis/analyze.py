@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+'''
+按key模板统计Redis内存占用, 用于容量规划和排查没有过期时间的泄漏key.
+
+以SCAN增量遍历keyspace(限速, 不会阻塞Redis), 把每个key归入keys.py中的模板(含迁移前不带hash tag的旧名),
+对所有key查询TTL, 按采样率抽样查询MEMORY USAGE并据此估算每类key的总字节数.
+
+使用说明 (在app目录下执行):
+
+    python -m internal.extensions.ext_redis.analyze                          # 默认采样10%, 每秒最多扫描2000个key
+    python -m internal.extensions.ext_redis.analyze --sample-rate 1 --rate 0 # 全量统计, 不限速
+    python -m internal.extensions.ext_redis.analyze --json > report.json
+'''
+import argparse
+import asyncio
+import heapq
+import random
+import re
+import string
+import sys
+import time
+import ujson as json
+import redis.asyncio as aio_redis
+import redis.asyncio.cluster as aio_redis_cluster
+
+from dependencies import settings
+from internal.extensions.ext_cache import CKEY_TIERED_CACHE_ENTRY, \
+    CKEY_TIERED_CACHE_NAMESPACE_KEYS
+from internal.extensions.ext_redis import keys as redis_keys
+from loguru import logger as loguru_logger
+from typing import Any, \
+    AsyncIterator, \
+    Dict, \
+    List, \
+    Optional, \
+    Pattern, \
+    Tuple, \
+    Union
+
+UNKNOWN_FAMILY = "UNKNOWN"
+
+
+def _template_to_regex(template: str, env: str) -> Pattern:
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        parts.append(re.escape(literal))
+        if field is None:
+            continue
+        parts.append(re.escape(env) if field == "env" else ".+?")
+    return re.compile("".join(parts) + "$")
+
+
+def _legacy_template(template: str) -> str:
+    return template.replace("{{{", "{").replace("}}}", "}")
+
+
+def build_families(env: str) -> List[Tuple[str, Pattern]]:
+    '''
+    返回(模板名, 正则)列表, 字面量越长的模板越具体, 排在前面优先匹配.
+    '''
+    templates: Dict[str, str] = {
+        name: value for name, value in vars(redis_keys).items()
+        if name.startswith("CKEY_") and isinstance(value, str)
+    }
+    templates["CKEY_TIERED_CACHE_ENTRY"] = CKEY_TIERED_CACHE_ENTRY
+    templates["CKEY_TIERED_CACHE_NAMESPACE_KEYS"] = CKEY_TIERED_CACHE_NAMESPACE_KEYS
+    templates["SMS_DAILY_TOKENS"] = "ai_play_user_{phone_number}_daily_tokens"
+    families = []
+    for name, template in templates.items():
+        families.append((name, template))
+        legacy = _legacy_template(template)
+        if legacy != template:
+            families.append((f"{name}(legacy)", legacy))
+    families.sort(key=lambda x: len(re.sub(r"\{[^{}]*\}", "", x[1])), reverse=True)
+    return [(name, _template_to_regex(template, env)) for name, template in families]
+
+
+def classify(key: str, families: List[Tuple[str, Pattern]]) -> str:
+    for name, regex in families:
+        if regex.match(key):
+            return name
+    return UNKNOWN_FAMILY
+
+
+class _FamilyStats(object):
+
+    def __init__(self, top_n: int) -> None:
+        self.count = 0
+        self.no_ttl = 0
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.top_n = top_n
+        # 最小堆, 保留采样到的最大的top_n个key
+        self.biggest: List[Tuple[int, str]] = []
+        self.no_ttl_examples: List[str] = []
+
+    def add(self, key: str, ttl: int, nbytes: Optional[int]):
+        self.count += 1
+        if ttl == -1:
+            self.no_ttl += 1
+            if len(self.no_ttl_examples) < 3:
+                self.no_ttl_examples.append(key)
+        if nbytes is not None:
+            self.sampled += 1
+            self.sampled_bytes += nbytes
+            if len(self.biggest) < self.top_n:
+                heapq.heappush(self.biggest, (nbytes, key))
+            elif nbytes > self.biggest[0][0]:
+                heapq.heapreplace(self.biggest, (nbytes, key))
+
+    def to_dict(self) -> Dict[str, Any]:
+        avg_bytes = self.sampled_bytes / self.sampled if self.sampled > 0 else 0
+        return {
+            "count": self.count,
+            "estimated_bytes": int(avg_bytes * self.count),
+            "avg_bytes": int(avg_bytes),
+            "sampled": self.sampled,
+            "no_ttl": self.no_ttl,
+            "no_ttl_examples": self.no_ttl_examples,
+            "biggest": [{"key": k, "bytes": n} for n, k in sorted(self.biggest, reverse=True)],
+        }
+
+
+async def _scan_keys(
+        conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+        scan_count: int,
+        rate: int,
+    ) -> AsyncIterator[List[str]]:
+    '''
+    逐批返回key, rate为每秒最多扫描的key数, 0表示不限速. 集群模式下依次扫描每个主节点.
+    '''
+    if isinstance(conn, aio_redis_cluster.RedisCluster):
+        targets = [{"target_nodes": node} for node in conn.get_primaries()]
+    else:
+        targets = [{}]
+    for target in targets:
+        cursor = 0
+        while True:
+            st = time.monotonic()
+            cursor, keys = await conn.execute_command("SCAN", cursor, "COUNT", scan_count, **target)
+            cursor = int(cursor)
+            if len(keys) > 0:
+                yield [k.decode("utf-8", errors="replace") if isinstance(k, bytes) else k for k in keys]
+            if cursor == 0:
+                break
+            if rate > 0:
+                await asyncio.sleep(max(0.0, len(keys) / rate - (time.monotonic() - st)))
+
+
+async def analyze_keyspace(
+        conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+        env: str,
+        sample_rate: float = 0.1,
+        scan_count: int = 500,
+        rate: int = 2000,
+        top_n: int = 5,
+        limit: int = 0,
+    ) -> Dict[str, Any]:
+    families = build_families(env)
+    stats: Dict[str, _FamilyStats] = {}
+    unknown_examples: List[str] = []
+    scanned = 0
+    st = time.time()
+    async for keys in _scan_keys(conn, scan_count, rate):
+        sampled = [random.random() < sample_rate for _ in keys]
+        pipe = conn.pipeline(transaction=False)
+        for key, do_sample in zip(keys, sampled):
+            pipe.execute_command("TTL", key)
+            if do_sample:
+                pipe.execute_command("MEMORY", "USAGE", key)
+        replies = iter(await pipe.execute(raise_on_error=False))
+        for key, do_sample in zip(keys, sampled):
+            ttl = next(replies)
+            nbytes = next(replies) if do_sample else None
+            if isinstance(ttl, Exception) or ttl == -2:
+                # 扫描期间已过期或被删除
+                continue
+            if isinstance(nbytes, Exception):
+                nbytes = None
+            family = classify(key, families)
+            if family == UNKNOWN_FAMILY and len(unknown_examples) < 10:
+                unknown_examples.append(key)
+            if family not in stats:
+                stats[family] = _FamilyStats(top_n)
+            stats[family].add(key, int(ttl), int(nbytes) if nbytes is not None else None)
+        scanned += len(keys)
+        if limit > 0 and scanned >= limit:
+            break
+    report = {name: x.to_dict() for name, x in stats.items()}
+    return {
+        "scanned": scanned,
+        "cost_secs": round(time.time() - st, 2),
+        "sample_rate": sample_rate,
+        "estimated_total_bytes": sum(x["estimated_bytes"] for x in report.values()),
+        "families": dict(sorted(report.items(), key=lambda x: x[1]["estimated_bytes"], reverse=True)),
+        "unknown_examples": unknown_examples,
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"scanned:{report['scanned']} keys in {report['cost_secs']}s, sample_rate:{report['sample_rate']}, "
+        f"estimated_total:{report['estimated_total_bytes'] / 1024 / 1024:.2f}MiB",
+        "",
+        f"{'family':<56}{'count':>10}{'est_MiB':>10}{'avg_B':>8}{'no_ttl':>10}",
+    ]
+    for name, x in report["families"].items():
+        lines.append(
+            f"{name:<56}{x['count']:>10}{x['estimated_bytes'] / 1024 / 1024:>10.2f}{x['avg_bytes']:>8}{x['no_ttl']:>10}"
+        )
+    lines.append("")
+    for name, x in report["families"].items():
+        if len(x["biggest"]) == 0 and x["no_ttl"] == 0:
+            continue
+        lines.append(f"[{name}]")
+        for item in x["biggest"]:
+            lines.append(f"    {item['bytes']:>10}B  {item['key']}")
+        if x["no_ttl"] > 0:
+            lines.append(f"    {x['no_ttl']} keys without ttl, e.g. {', '.join(x['no_ttl_examples'])}")
+    if len(report["unknown_examples"]) > 0:
+        lines.append("")
+        lines.append(f"unknown key examples: {', '.join(report['unknown_examples'])}")
+    return "\n".join(lines)
+
+
+def _connect() -> Union[aio_redis.Redis, aio_redis_cluster.RedisCluster]:
+    endpoints = [x.strip() for x in settings.REDIS_SERVER_ENDPOINT.split(",") if len(x.strip()) > 0]
+    if settings.REDIS_CLUSTER_MODE:
+        return aio_redis_cluster.RedisCluster(
+            startup_nodes=[aio_redis_cluster.ClusterNode(x.split(":")[0], int(x.split(":")[1])) for x in endpoints],
+            password=settings.REDIS_PASSWORD,
+        )
+    host, port = endpoints[0].split(":")[0], int(endpoints[0].split(":")[1])
+    return aio_redis.Redis(host=host, port=port, password=settings.REDIS_PASSWORD, db=settings.REDIS_DB)
+
+
+async def main(args: argparse.Namespace) -> bool:
+    conn = _connect()
+    ok = False
+    try:
+        report = await analyze_keyspace(
+            conn,
+            env=settings.DEPLOY_ENV,
+            sample_rate=args.sample_rate,
+            scan_count=args.scan_count,
+            rate=args.rate,
+            top_n=args.top_n,
+            limit=args.limit,
+        )
+        print(json.dumps(report, indent=2) if args.json else format_report(report))
+        ok = True
+    except Exception as e:
+        loguru_logger.error(f"Failed to analyze redis keyspace, err:{e}")
+    finally:
+        await conn.aclose()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report redis memory usage per key family.")
+    parser.add_argument("--sample-rate", type=float, default=0.1, help="fraction of keys to run MEMORY USAGE on")
+    parser.add_argument("--scan-count", type=int, default=500, help="COUNT hint for each SCAN call")
+    parser.add_argument("--rate", type=int, default=2000, help="max keys scanned per second, 0 for unlimited")
+    parser.add_argument("--top-n", type=int, default=5, help="biggest keys to report per family")
+    parser.add_argument("--limit", type=int, default=0, help="stop after scanning this many keys, 0 for all")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args = parser.parse_args()
+    ok = asyncio.run(main(args))
+    sys.exit(0 if ok else -1)
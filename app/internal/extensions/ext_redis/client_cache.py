@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import redis.asyncio as aio_redis
+import redis.exceptions as redis_exceptions
+import time
+
+from collections import OrderedDict
+from loguru import logger as loguru_logger
+from typing import Any, \
+    Dict, \
+    List, \
+    Optional, \
+    Tuple
+
+_MISSING = object()
+
+
+class ClientSideCache(object):
+    '''
+    基于服务端辅助(RESP3 CLIENT TRACKING)的进程内缓存.
+
+    专用连接以BCAST模式订阅若干key前缀, 这些前缀下任何key被修改/过期/淘汰时, Redis都会推送invalidate消息,
+    收到后立即删除本地副本. 跟踪连接断开期间缓存整体失效并被旁路, 重连成功后再重新启用.
+    '''
+
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            password: str,
+            db: int,
+            prefixes: List[str],
+            max_entries: int = 10000,
+            max_ttl: float = 300.0,
+        ) -> None:
+        self._host = host
+        self._port = port
+        self._password = password
+        self._db = db
+        self._prefixes = tuple(prefixes)
+        self._max_entries = max_entries
+        # NOTE: 兜底的本地过期时间, 防止极端情况下漏掉invalidate消息导致脏数据常驻.
+        self._max_ttl = max_ttl
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        # 每收到一次invalidate就加一, 用于丢弃与invalidate并发的回填.
+        self._invalidation_seq = 0
+        self._tracking = False
+        self._tracking_established = False
+        self._tracking_task: Optional[asyncio.Task] = None
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    def is_tracked(self, key: str) -> bool:
+        return self._tracking and key.startswith(self._prefixes)
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        entry = self._entries.get(key, _MISSING)
+        if entry is _MISSING or entry[1] < time.monotonic():
+            self._misses += 1
+            return (False, None)
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return (True, entry[0])
+
+    def seq(self) -> int:
+        return self._invalidation_seq
+
+    def set(self, key: str, value: Any, seq: int):
+        '''
+        回填本地缓存, seq为发起读请求之前调用seq()得到的值, 期间发生过invalidate则放弃回填.
+        '''
+        if not self._tracking or seq != self._invalidation_seq:
+            return
+        self._entries[key] = (value, time.monotonic() + self._max_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, keys: Optional[List[str]] = None):
+        self._invalidation_seq += 1
+        if keys is None:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            return
+        for key in keys:
+            if self._entries.pop(key, _MISSING) is not _MISSING:
+                self._invalidations += 1
+
+    def discard(self, key: str):
+        '''
+        本进程写入被跟踪的key后立即删除本地副本, 不必等待服务端的invalidate推送.
+        '''
+        if key.startswith(self._prefixes):
+            self.invalidate([key])
+
+    def stats(self) -> Dict[str, Any]:
+        total = self._hits + self._misses
+        return {
+            "tracking": self._tracking,
+            "entries": len(self._entries),
+            "max_entries": self._max_entries,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_ratio": self._hits / total if total > 0 else 0.0,
+            "invalidations": self._invalidations,
+            "evictions": self._evictions,
+        }
+
+    async def _track_once(self):
+        conn = aio_redis.Connection(
+            host=self._host,
+            port=self._port,
+            password=self._password,
+            db=self._db,
+            protocol=3,
+            socket_connect_timeout=2,
+        )
+        try:
+            await conn.connect()
+            args = ["CLIENT", "TRACKING", "ON", "BCAST"]
+            for prefix in self._prefixes:
+                args.extend(["PREFIX", prefix])
+            await conn.send_command(*args)
+            if await conn.read_response() != b"OK":
+                raise redis_exceptions.ConnectionError("Failed to enable client tracking.")
+            self._tracking = True
+            self._tracking_established = True
+            loguru_logger.debug(f"Client side caching is tracking prefixes:{self._prefixes}.")
+            while True:
+                msg = await conn.read_response(push_request=True)
+                if isinstance(msg, list) and len(msg) == 2 and msg[0] in (b"invalidate", "invalidate"):
+                    if msg[1] is None:
+                        # FLUSHDB/FLUSHALL
+                        self.invalidate()
+                    else:
+                        self.invalidate([k.decode("utf-8") if isinstance(k, bytes) else k for k in msg[1]])
+        finally:
+            self._tracking = False
+            self.invalidate()
+            await conn.disconnect()
+
+    async def _track_loop(self):
+        backoff = 0.5
+        while True:
+            try:
+                await self._track_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._tracking_established:
+                    self._tracking_established = False
+                    backoff = 0.5
+                loguru_logger.warning(f"Client side caching lost tracking connection, err:{e}, retry in {backoff:.1f}s.")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    def start(self):
+        if self._tracking_task is None and len(self._prefixes) > 0:
+            self._tracking_task = asyncio.get_event_loop().create_task(self._track_loop())
+
+    async def stop(self):
+        if self._tracking_task is not None:
+            self._tracking_task.cancel()
+            try:
+                await self._tracking_task
+            except asyncio.CancelledError:
+                pass
+            self._tracking_task = None
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import orjson
+import struct
+import zlib
+
+from typing import Any, \
+    Dict, \
+    Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 编码后的格式: MAGIC(1B) + FLAGS(1B) + SCHEMA_VERSION(2B, 大端) + PAYLOAD
+# PAYLOAD为orjson编码结果, 超过压缩阈值时按FLAGS中标记的算法压缩.
+_MAGIC = 0xC7
+_HEADER = struct.Struct(">BBH")
+FLAG_ZSTD = 0x01
+FLAG_ZLIB = 0x02
+
+# 不带头部的旧值(手工json.dumps写入的字符串)按此版本号返回
+LEGACY_SCHEMA_VERSION = 0
+
+
+class CodecError(Exception):
+    pass
+
+
+class ObjectCodec(object):
+    '''
+    缓存对象的二进制编解码器.
+
+    - 使用orjson编码, 比ujson/json更快, 并原生支持datetime/dataclass等类型.
+    - 编码结果超过compress_threshold字节时压缩, 优先使用zstd, 未安装zstandard时退回zlib.
+    - 头部携带schema版本号, 读取方可以据此丢弃结构不兼容的旧数据.
+    '''
+
+    def __init__(self, compress_threshold: int = 1024, compress_level: int = 3) -> None:
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+        if zstandard is not None:
+            self._zstd_compressor = zstandard.ZstdCompressor(level=compress_level)
+            self._zstd_decompressor = zstandard.ZstdDecompressor()
+        self._encoded = 0
+        self._compressed = 0
+        self._raw_bytes = 0
+        self._stored_bytes = 0
+
+    def encode(self, obj: Any, schema_version: int = 1) -> bytes:
+        # NOTE: ObjectId等orjson不认识的类型统一转成字符串.
+        payload = orjson.dumps(obj, default=str)
+        flags = 0
+        self._encoded += 1
+        self._raw_bytes += len(payload)
+        if self._compress_threshold > 0 and len(payload) >= self._compress_threshold:
+            if zstandard is not None:
+                compressed = self._zstd_compressor.compress(payload)
+                compressed_flag = FLAG_ZSTD
+            else:
+                compressed = zlib.compress(payload, self._compress_level)
+                compressed_flag = FLAG_ZLIB
+            # 压缩收益太小时保留原文, 省去读取时的解压开销
+            if len(compressed) < len(payload) * 0.9:
+                payload = compressed
+                flags |= compressed_flag
+                self._compressed += 1
+        self._stored_bytes += _HEADER.size + len(payload)
+        return _HEADER.pack(_MAGIC, flags, schema_version) + payload
+
+    def decode(self, raw: bytes) -> Tuple[Any, int]:
+        '''
+        返回(对象, schema版本号). 兼容迁移前直接写入的json字符串, 此时版本号为LEGACY_SCHEMA_VERSION.
+        '''
+        if len(raw) < _HEADER.size or raw[0] != _MAGIC:
+            try:
+                return (orjson.loads(raw), LEGACY_SCHEMA_VERSION)
+            except orjson.JSONDecodeError as e:
+                raise CodecError(f"Unrecognized cached value, err:{e}")
+        _, flags, schema_version = _HEADER.unpack_from(raw)
+        payload = memoryview(raw)[_HEADER.size:]
+        if flags & FLAG_ZSTD:
+            if zstandard is None:
+                raise CodecError("Cached value is zstd compressed, but zstandard is not installed.")
+            payload = self._zstd_decompressor.decompress(payload)
+        elif flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return (orjson.loads(payload), schema_version)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "zstd": zstandard is not None,
+            "encoded": self._encoded,
+            "compressed": self._compressed,
+            "raw_bytes": self._raw_bytes,
+            "stored_bytes": self._stored_bytes,
+        }
@@ -1,34 +1,90 @@
 # -*- coding: utf-8 -*-
+from typing import Dict, \
+    List
+
+# NOTE: 同一用户/房间/设备的key用hash tag(即"{...}"部分)标记, 集群模式下它们落在同一个slot上,
+# 因此可以在一个MULTI/Lua脚本/MGET中同时操作. "{{"/"}}"是str.format对花括号的转义.
+# 引入hash tag之前的key名等于去掉花括号后的名字, 见legacy_key(), 旧key由migrate_keys一次性迁移到新key名.
 
 # 用户总数
 CKEY_TOTAL_USER_CNT_KEY = "gcp_ags_{env}_total_user_cnt"
 # 应用权限
-CKEY_APP_PERMISSION_RECORD = "gcp_ags_{env}_app_permission_{device_id}_{permission_type}"
+CKEY_APP_PERMISSION_RECORD = "gcp_ags_{env}_app_permission_{{{device_id}}}_{permission_type}"
 # 设备类型
-CKEY_USER_DEVICE_TYPE = "gcp_ags_{env}_device_type_{uid}"
+CKEY_USER_DEVICE_TYPE = "gcp_ags_{env}_device_type_{{{uid}}}"
 # 设备ID
-CKEY_USER_DEVICE_ID = "gcp_ags_{env}_device_id_{uid}"
+CKEY_USER_DEVICE_ID = "gcp_ags_{env}_device_id_{{{uid}}}"
 # 设备ID
-CKEY_USER_DEVICE_ID_EXT = "gcp_ags_{env}_device_id_{account}"
+CKEY_USER_DEVICE_ID_EXT = "gcp_ags_{env}_device_id_{{{account}}}"
 # 用于极光推送的注册ID
-CKEY_USER_JPUSH_REGISTRATION_ID = "gcp_ags_{env}_jpush_registration_id_{uid}"
+CKEY_USER_JPUSH_REGISTRATION_ID = "gcp_ags_{env}_jpush_registration_id_{{{uid}}}"
 # 用于极光推送的注册ID
-CKEY_USER_JPUSH_REGISTRATION_ID_EXT = "gcp_ags_{env}_jpush_registration_id_{account}"
+CKEY_USER_JPUSH_REGISTRATION_ID_EXT = "gcp_ags_{env}_jpush_registration_id_{{{account}}}"
 # 用于判断用户是否在线
-CKEY_USER_ONLINE = "gcp_ags_{env}_user_{uid}_online"
+CKEY_USER_ONLINE = "gcp_ags_{env}_user_{{{uid}}}_online"
 # 用户所在房间的ID
-CKEY_USER_ENTERED_ROOM = "gcp_ags_{env}_user_{uid}_entered_room"
+CKEY_USER_ENTERED_ROOM = "gcp_ags_{env}_user_{{{uid}}}_entered_room"
 # 房间内的在线用户ID列表
-CKEY_ROOM_ONLINE_USERS = "gcp_ags_{env}_room_{room_id}_online_users"
+CKEY_ROOM_ONLINE_USERS = "gcp_ags_{env}_room_{{{room_id}}}_online_users"
 # 房间内的车队用户ID列表
-CKEY_ROOM_IN_GAME_QUEUE_USERS = "gcp_ags_{env}_room_{room_id}_in_game_queue_users"
+CKEY_ROOM_IN_GAME_QUEUE_USERS = "gcp_ags_{env}_room_{{{room_id}}}_in_game_queue_users"
 # 房间内处于准备状态的车队用户ID列表
-CKEY_ROOM_IN_GAME_QUEUE_BE_READY_USERS = "gcp_ags_{env}_room_{room_id}_in_game_queue_be_ready_users"
+CKEY_ROOM_IN_GAME_QUEUE_BE_READY_USERS = "gcp_ags_{env}_room_{{{room_id}}}_in_game_queue_be_ready_users"
 # 房间内的车队锁
-CKEY_ROOM_GAME_QUEUE_LOCK = "gcp_ags_{env}_room_{room_id}_game_queue_lock"
+CKEY_ROOM_GAME_QUEUE_LOCK = "gcp_ags_{env}_room_{{{room_id}}}_game_queue_lock"
 # 房间内用户是否需要发送游戏卡片
-CKEY_ROOM_USER_SEND_GAME_CARD = "gcp_ags_{env}_user_{uid}_send_game_card"
+CKEY_ROOM_USER_SEND_GAME_CARD = "gcp_ags_{env}_user_{{{uid}}}_send_game_card"
 # 用户专属的后台101任务
-CKEY_USER_BACKGROUND_101_DELAY_TASK = "gcp_ags_{env}_user_{uid}_background_101_delay_task"
+CKEY_USER_BACKGROUND_101_DELAY_TASK = "gcp_ags_{env}_user_{{{uid}}}_background_101_delay_task"
 # 用户专属的后台102任务
-CKEY_USER_BACKGROUND_102_DELAY_TASK = "gcp_ags_{env}_user_{uid}_background_102_delay_task"
+CKEY_USER_BACKGROUND_102_DELAY_TASK = "gcp_ags_{env}_user_{{{uid}}}_background_102_delay_task"
+# 游戏排行榜 (period: daily/weekly/total, period_id: 20240101/202401/all)
+CKEY_GAME_LEADERBOARD = "gcp_ags_{env}_game_{game_index}_leaderboard_{period}_{period_id}"
+
+# NOTE: 用户/账号维度的常驻状态合并为一个hash, 字段名尽量短, 字段数和字段值长度都远小于
+# hash-max-listpack-entries(128)/hash-max-listpack-value(64), Redis会用紧凑的listpack编码存储.
+# 需要独立过期时间的key(在线标记, 后台延迟任务)仍然是单独的string key.
+# 用户状态hash
+CKEY_USER_HASH = "gcp_ags_{env}_u_{{{uid}}}"
+# 账号状态hash
+CKEY_ACCOUNT_HASH = "gcp_ags_{env}_a_{{{account}}}"
+
+HFIELD_DEVICE_TYPE = "dt"
+HFIELD_DEVICE_ID = "di"
+HFIELD_JPUSH_REGISTRATION_ID = "jr"
+HFIELD_ENTERED_ROOM = "er"
+HFIELD_SEND_GAME_CARD = "gc"
+
+# hash字段 -> 迁移前对应的string key, 迁移期间hash中缺失的字段从这些key读取
+USER_HASH_LAYOUT = {
+    HFIELD_DEVICE_TYPE: CKEY_USER_DEVICE_TYPE,
+    HFIELD_DEVICE_ID: CKEY_USER_DEVICE_ID,
+    HFIELD_JPUSH_REGISTRATION_ID: CKEY_USER_JPUSH_REGISTRATION_ID,
+    HFIELD_ENTERED_ROOM: CKEY_USER_ENTERED_ROOM,
+    HFIELD_SEND_GAME_CARD: CKEY_ROOM_USER_SEND_GAME_CARD,
+}
+ACCOUNT_HASH_LAYOUT = {
+    HFIELD_DEVICE_ID: CKEY_USER_DEVICE_ID_EXT,
+    HFIELD_JPUSH_REGISTRATION_ID: CKEY_USER_JPUSH_REGISTRATION_ID_EXT,
+}
+
+
+def legacy_key(key: str) -> str:
+    '''
+    返回引入hash tag之前的key名.
+    '''
+    return key.replace("{", "").replace("}", "")
+
+
+def key_prefix(template: str, **kwargs) -> str:
+    '''
+    返回模板中第一个hash tag之前的固定前缀, 例如key_prefix(CKEY_USER_DEVICE_ID_EXT, env="dev") == "gcp_ags_dev_device_id_".
+    '''
+    return template.split("{{")[0].format(**kwargs)
+
+
+def hash_fields(layout: Dict[str, str], fields: List[str], **kwargs) -> Dict[str, str]:
+    '''
+    返回字段到迁移前string key的映射, 例如hash_fields(USER_HASH_LAYOUT, [HFIELD_DEVICE_ID], env="dev", uid="1").
+    '''
+    return {field: layout[field].format(**kwargs) for field in fields}
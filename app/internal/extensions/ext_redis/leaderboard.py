@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import redis.asyncio as aio_redis
+import redis.exceptions as redis_exceptions
+import time
+
+from collections import defaultdict
+from internal.extensions.ext_redis.keys import CKEY_GAME_LEADERBOARD
+from internal.infra.alarm import perror
+from loguru import logger as loguru_logger
+from typing import Any, \
+    Dict, \
+    List, \
+    Optional, \
+    Tuple
+
+PERIOD_DAILY = "daily"
+PERIOD_WEEKLY = "weekly"
+PERIOD_TOTAL = "total"
+PERIODS = (PERIOD_DAILY, PERIOD_WEEKLY, PERIOD_TOTAL)
+
+
+def _period_id(period: str, now: Optional[float] = None) -> str:
+    today = datetime.date.fromtimestamp(now if now is not None else time.time())
+    if period == PERIOD_DAILY:
+        return today.strftime("%Y%m%d")
+    elif period == PERIOD_WEEKLY:
+        year, week, _ = today.isocalendar()
+        return f"{year}{week:02d}"
+    return "all"
+
+
+def _period_expire_at(period: str, period_id: str) -> int:
+    '''
+    返回周期对应key的过期时间点, 过期时间点在周期结束后再保留一个周期, 便于查看上一期的榜单.
+    '''
+    if period == PERIOD_DAILY:
+        start = datetime.datetime.strptime(period_id, "%Y%m%d")
+        return int((start + datetime.timedelta(days=2)).timestamp())
+    elif period == PERIOD_WEEKLY:
+        monday = datetime.date.fromisocalendar(int(period_id[:-2]), int(period_id[-2:]), 1)
+        start = datetime.datetime.combine(monday, datetime.datetime.min.time())
+        return int((start + datetime.timedelta(days=14)).timestamp())
+    return 0
+
+
+class GameLeaderboard(object):
+    '''
+    基于Redis有序集合的游戏排行榜, 分值为胜场数.
+
+    对战结果先在进程内按(榜单, 用户)合并, 再由后台任务按批次通过pipeline一次性写入.
+    待写入的(榜单, 用户)数超过max_pending时(例如Redis长时间不可用)丢弃新的更新, 避免内存无限增长.
+    '''
+
+    def __init__(
+            self,
+            conn: aio_redis.Redis,
+            env: str,
+            flush_interval: float = 0.5,
+            flush_batch_size: int = 256,
+            max_pending: int = 100000,
+        ) -> None:
+        self._conn = conn
+        self._env = env
+        self._flush_interval = flush_interval
+        self._flush_batch_size = flush_batch_size
+        self._max_pending = max_pending
+        self._pending: Dict[Tuple[str, str, str, str], int] = defaultdict(int)
+        self._pending_cnt = 0
+        self._dropped = 0
+        self._flush_event = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _key(self, game_index: str, period: str, period_id: str) -> str:
+        return CKEY_GAME_LEADERBOARD.format(env=self._env, game_index=game_index, period=period, period_id=period_id)
+
+    def record(self, game_index: str, uid: str, win: bool):
+        '''
+        记录一条对战结果, 不等待写入完成. 输掉的对局也会记录, 以便用户能查到自己的名次.
+        '''
+        for period in PERIODS:
+            self._add((period, _period_id(period), game_index, uid), 1 if win else 0)
+        self._pending_cnt += 1
+        if self._pending_cnt >= self._flush_batch_size:
+            self._flush_event.set()
+
+    def _add(self, k: Tuple[str, str, str, str], incr: int):
+        if k not in self._pending and len(self._pending) >= self._max_pending:
+            self._dropped += 1
+            return
+        self._pending[k] += incr
+
+    async def flush(self) -> bool:
+        if self._dropped > 0:
+            dropped, self._dropped = self._dropped, 0
+            await perror(f"Dropped {dropped} leaderboard updates, more than {self._max_pending} pending.")
+        if len(self._pending) == 0:
+            return True
+        pending, pending_cnt = self._pending, self._pending_cnt
+        self._pending, self._pending_cnt = defaultdict(int), 0
+
+        done = False
+        sent = False
+        try:
+            # NOTE: ZINCRBY不是幂等的, 发出之后失败时无法确定哪些已生效, 重试会重复计分; 集群模式下各榜单不在同一slot, 也不能用事务.
+            # 因此先PING确认连接可用: PING失败时这批更新都没有发出, 合并回去下次重试; 发出之后失败时告警并丢弃, 宁可少计也不重复计分.
+            await self._conn.ping()
+            sent = True
+            expirations: Dict[str, int] = {}
+            pipe = self._conn.pipeline(transaction=False)
+            for (period, period_id, game_index, uid), incr in pending.items():
+                key = self._key(game_index, period, period_id)
+                pipe.zincrby(key, incr, uid)
+                if period != PERIOD_TOTAL and key not in expirations:
+                    # NOTE: 按记录时的周期计算过期时间, 跨零点合并的更新不会用到下一周期的过期时间.
+                    expirations[key] = _period_expire_at(period, period_id)
+            for key, expire_at in expirations.items():
+                pipe.expireat(key, expire_at)
+            await pipe.execute()
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to flush {len(pending)} leaderboard updates.")
+        except Exception as e:
+            await perror(f"Failed to flush {len(pending)} leaderboard updates, err:{e}")
+        finally:
+            # NOTE: 不在finally中return, 否则会吞掉CancelledError, stop()取消后台任务时会一直等待.
+            if not sent:
+                for k, incr in pending.items():
+                    self._add(k, incr)
+                self._pending_cnt += pending_cnt
+        return done
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    async def top_n(self, game_index: str, period: str = PERIOD_DAILY, n: int = 10, period_id: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        ranking: List[Dict[str, Any]] = []
+        done = False
+        key = self._key(game_index, period, period_id or _period_id(period))
+        try:
+            members = await self._conn.zrevrange(key, 0, n - 1, withscores=True)
+            for i, (uid, score) in enumerate(members):
+                ranking.append({"uid": uid.decode("utf-8"), "rank": i + 1, "score": int(score)})
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to get top {n} for key:{key}.")
+        except Exception as e:
+            await perror(f"Failed to get top {n} for key:{key}, err:{e}")
+        finally:
+            return (ranking, done)
+
+    async def rank_of(self, game_index: str, uid: str, period: str = PERIOD_DAILY, period_id: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], bool]:
+        ranking = None
+        done = False
+        key = self._key(game_index, period, period_id or _period_id(period))
+        try:
+            pipe = self._conn.pipeline(transaction=False)
+            pipe.zrevrank(key, uid)
+            pipe.zscore(key, uid)
+            rank, score = await pipe.execute()
+            if rank is not None:
+                ranking = {"uid": uid, "rank": rank + 1, "score": int(score)}
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to get rank of user:{uid} for key:{key}.")
+        except Exception as e:
+            await perror(f"Failed to get rank of user:{uid} for key:{key}, err:{e}")
+        finally:
+            return (ranking, done)
+
+    async def around_me(self, game_index: str, uid: str, period: str = PERIOD_DAILY, radius: int = 5, period_id: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        ranking: List[Dict[str, Any]] = []
+        done = False
+        key = self._key(game_index, period, period_id or _period_id(period))
+        try:
+            rank = await self._conn.zrevrank(key, uid)
+            if rank is not None:
+                start = max(rank - radius, 0)
+                members = await self._conn.zrevrange(key, start, rank + radius, withscores=True)
+                for i, (member, score) in enumerate(members):
+                    ranking.append({"uid": member.decode("utf-8"), "rank": start + i + 1, "score": int(score)})
+            done = True
+        except redis_exceptions.TimeoutError:
+            await perror(f"Timeout to get ranking around user:{uid} for key:{key}.")
+        except Exception as e:
+            await perror(f"Failed to get ranking around user:{uid} for key:{key}, err:{e}")
+        finally:
+            return (ranking, done)
+
+
+_instance: GameLeaderboard = None
+
+
+def init_instance(conn: aio_redis.Redis, env: str, flush_interval: float = 0.5, flush_batch_size: int = 256, max_pending: int = 100000):
+    global _instance
+    _instance = GameLeaderboard(conn, env, flush_interval, flush_batch_size, max_pending)
+    _instance.start()
+    loguru_logger.debug("Game leaderboard is ready.")
+
+
+def instance() -> GameLeaderboard:
+    return _instance
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+import random
+import re
+
+from collections import defaultdict
+from typing import Any, \
+    Dict, \
+    List, \
+    Optional, \
+    Sequence, \
+    Tuple
+
+# 命令耗时的分桶上界 (秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+_HASH_TAG_RE = re.compile(r"\{[^{}]*\}")
+_DIGITS_RE = re.compile(r"\d+")
+# 迁移前的旧key不带hash tag, 归类后基数可能很大, 超过上限的类别合并统计
+MAX_FAMILIES = 256
+OTHER_FAMILY = "other"
+
+
+def key_family(key: str) -> str:
+    '''
+    把key中的hash tag和数字替换掉得到key的类别, 例如gcp_ags_dev_user_{xxx}_online -> gcp_ags_dev_user_{}_online.
+    '''
+    return _DIGITS_RE.sub("#", _HASH_TAG_RE.sub("{}", key))
+
+
+def key_digest(key: str) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class LatencyHistogram(object):
+
+    __slots__ = ("count", "errors", "sum", "max", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, elapsed: float, error: bool = False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.sum += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def quantile(self, q: float) -> float:
+        '''
+        按分桶估算分位数, 返回所在分桶的上界.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        n = 0
+        for le, cnt in zip(LATENCY_BUCKETS, self.buckets):
+            n += cnt
+            if n >= rank:
+                return le
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg": self.sum / self.count if self.count > 0 else 0.0,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": {
+                **{f"le_{le}": n for le, n in zip(LATENCY_BUCKETS, self.buckets)},
+                "le_inf": self.buckets[-1],
+            },
+        }
+
+
+class SpaceSavingSketch(object):
+    '''
+    Space-Saving算法的Top-K热点统计, 只保留capacity个计数器.
+    计数器满时新key顶替计数最小的key, 并继承其计数作为误差上界, 真正的热点key不会被漏掉.
+    '''
+
+    def __init__(self, capacity: int = 64) -> None:
+        self._capacity = capacity
+        # key -> [count, error]
+        self._counters: Dict[str, List[int]] = {}
+
+    def offer(self, key: str, weight: int = 1):
+        counter = self._counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self._counters) < self._capacity:
+            self._counters[key] = [weight, 0]
+            return
+        victim = min(self._counters, key=lambda k: self._counters[k][0])
+        min_count = self._counters.pop(victim)[0]
+        self._counters[key] = [min_count + weight, min_count]
+
+    def top(self, k: int) -> List[Tuple[str, int, int]]:
+        '''
+        返回[(key, 估计次数, 误差上界)], 真实次数在[估计次数 - 误差上界, 估计次数]之间.
+        '''
+        items = sorted(self._counters.items(), key=lambda x: x[1][0], reverse=True)[:k]
+        return [(key, counter[0], counter[1]) for key, counter in items]
+
+
+class RedisMetrics(object):
+    '''
+    RedisClient的轻量级指标: 按命令和按key类别的耗时直方图, 以及按采样率统计的热点key.
+    '''
+
+    def __init__(self, hot_key_sample_rate: float = 0.05, hot_key_capacity: int = 64) -> None:
+        self._hot_key_sample_rate = hot_key_sample_rate
+        self._by_command: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self._by_family: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self._hot_keys = SpaceSavingSketch(hot_key_capacity)
+        self._sampled = 0
+
+    def observe(self, command: str, keys: Sequence[str], elapsed: float, error: bool = False):
+        self._by_command[command].observe(elapsed, error)
+        if len(keys) == 0:
+            return
+        family = key_family(keys[0])
+        if family not in self._by_family and len(self._by_family) >= MAX_FAMILIES:
+            family = OTHER_FAMILY
+        self._by_family[family].observe(elapsed, error)
+        if self._hot_key_sample_rate <= 0:
+            return
+        for key in keys:
+            if random.random() < self._hot_key_sample_rate:
+                self._sampled += 1
+                self._hot_keys.offer(key)
+
+    def stats(self, top_k: Optional[int] = 20) -> Dict[str, Any]:
+        scale = 1 / self._hot_key_sample_rate if self._hot_key_sample_rate > 0 else 0
+        return {
+            "commands": {cmd: x.to_dict() for cmd, x in self._by_command.items()},
+            "families": {family: x.to_dict() for family, x in self._by_family.items()},
+            "hot_keys": {
+                "sample_rate": self._hot_key_sample_rate,
+                "sampled": self._sampled,
+                # NOTE: key中可能含有手机号/账号等用户信息, 只输出key类别和key的摘要, 排查时对可疑key计算摘要比对即可.
+                "top": [
+                    {
+                        "family": key_family(key),
+                        "key_hash": key_digest(key),
+                        "estimated_hits": int(count * scale),
+                        "error": int(error * scale),
+                    }
+                    for key, count, error in self._hot_keys.top(top_k)
+                ],
+            },
+        }
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+'''
+把引入hash tag之前写入的旧key(不带花括号, 见keys.legacy_key)一次性迁移到带hash tag的新key名.
+
+服务只读写新key名, 不再回退读取旧key. 写入方切换到新key名之后执行一次:
+- 旧key用DUMP/RESTORE复制到新key名, 保留剩余的过期时间;
+- 新key已存在时说明写入方已经写过新值, 保留新key, 不覆盖;
+- 指定--delete-legacy时复制完成(或新key已存在)后删除旧key, 否则旧key保留到自然过期, 便于回滚.
+
+--hash-layout把用户/账号状态的string key(见keys.USER_HASH_LAYOUT/ACCOUNT_HASH_LAYOUT)搬进hash并删除string key.
+写入方切换到RedisClient.set_hash_fields之后执行一次, 然后再打开REDIS_HASH_LAYOUT:
+- 仍存在的string key是切换之前写入的值, 比hash中的值新, 直接覆盖hash字段;
+- 带过期时间的string key不搬, 由过期时间清理;
+- device_id_{X}/jpush_registration_id_{X}同时是用户和账号的key名, X为new_uid()生成的"User_"开头的uid时搬进用户hash, 否则搬进账号hash.
+
+使用说明 (在app目录下执行):
+
+    python -m internal.extensions.ext_redis.migrate_keys --dry-run          # 只统计需要迁移的key
+    python -m internal.extensions.ext_redis.migrate_keys                    # 复制旧key到新key名
+    python -m internal.extensions.ext_redis.migrate_keys --delete-legacy    # 复制后删除旧key
+    python -m internal.extensions.ext_redis.migrate_keys --hash-layout      # string key搬进用户/账号hash
+'''
+import argparse
+import asyncio
+import re
+import string
+import sys
+import time
+import redis.asyncio as aio_redis
+import redis.asyncio.cluster as aio_redis_cluster
+import redis.exceptions as redis_exceptions
+
+from dependencies import settings
+from internal.extensions.ext_redis import keys as redis_keys
+from loguru import logger as loguru_logger
+from typing import Any, \
+    AsyncIterator, \
+    Dict, \
+    List, \
+    Optional, \
+    Pattern, \
+    Tuple, \
+    Union
+
+# string key -> hash字段, 带过期时间的key不搬(返回-1), key已不存在返回0.
+HASH_LAYOUT_MIGRATE_SCRIPT = """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl == -2 then
+    return 0
+end
+if ttl ~= -1 then
+    return -1
+end
+redis.call('HSET', KEYS[2], ARGV[1], redis.call('GET', KEYS[1]))
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+# new_uid()生成的uid前缀, 用于区分同名的用户key和账号key
+_UID_PREFIX = "User_"
+
+
+def _template_regex(template: str, env: str, legacy: bool = True) -> Pattern:
+    '''
+    把带hash tag的模板转换成正则, 除env外的每个字段都是一个命名分组. legacy为True时匹配去掉花括号的旧key名.
+    hash tag中的字段(uid/device_id等)可能含下划线, 其他字段(例如permission_type)不含下划线.
+    '''
+    parts = []
+    tagged = False
+    for literal, field, _, _ in string.Formatter().parse(template):
+        # "{{"会被单独拆成一段字面量, 字段前最后一段非空字面量以"{"结尾时该字段在hash tag中
+        if len(literal) > 0:
+            tagged = literal.endswith("{")
+        parts.append(re.escape(literal.replace("{", "").replace("}", "") if legacy else literal))
+        if field is None:
+            continue
+        if field == "env":
+            parts.append(re.escape(env))
+        else:
+            parts.append(f"(?P<{field}>.+?)" if tagged else f"(?P<{field}>[^_]+)")
+    return re.compile("".join(parts) + "$")
+
+
+def build_templates(env: str) -> List[Tuple[str, Pattern]]:
+    '''
+    返回keys.py中所有带hash tag的(模板, 旧key正则), 字面量越长的模板越具体, 排在前面优先匹配.
+    '''
+    templates = [
+        value for name, value in vars(redis_keys).items()
+        if name.startswith("CKEY_") and isinstance(value, str) and "{{{" in value
+    ]
+    templates.sort(key=lambda x: len(re.sub(r"\{+[^{}]*\}+", "", x)), reverse=True)
+    return [(template, _template_regex(template, env)) for template in templates]
+
+
+def tagged_key(key: str, templates: List[Tuple[str, Pattern]], env: str) -> Optional[str]:
+    '''
+    返回旧key对应的新key名, 不是迁移前的key时返回None.
+    '''
+    if "{" in key or "}" in key:
+        return None
+    for template, regex in templates:
+        m = regex.match(key)
+        if m is None:
+            continue
+        new_key = template.format(env=env, **m.groupdict())
+        if redis_keys.legacy_key(new_key) == key:
+            return new_key
+    return None
+
+
+def build_hash_layout(env: str) -> List[Tuple[Pattern, str, str, str]]:
+    '''
+    返回(string key正则, hash模板, hash字段, hash tag字段名)列表.
+    '''
+    layouts = [
+        (redis_keys.USER_HASH_LAYOUT, redis_keys.CKEY_USER_HASH, "uid"),
+        (redis_keys.ACCOUNT_HASH_LAYOUT, redis_keys.CKEY_ACCOUNT_HASH, "account"),
+    ]
+    return [
+        (_template_regex(template, env, legacy=False), hash_template, field, tag)
+        for layout, hash_template, tag in layouts
+        for field, template in layout.items()
+    ]
+
+
+def hash_target(key: str, layout: List[Tuple[Pattern, str, str, str]], env: str) -> Optional[Tuple[str, str]]:
+    '''
+    返回string key对应的(hash key, hash字段), 不属于用户/账号状态时返回None.
+    '''
+    for regex, hash_template, field, tag in layout:
+        m = regex.match(key)
+        if m is None or (m.group(tag).startswith(_UID_PREFIX) != (tag == "uid")):
+            continue
+        return (hash_template.format(env=env, **{tag: m.group(tag)}), field)
+    return None
+
+
+async def _scan_keys(
+        conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+        match: str,
+        scan_count: int,
+        rate: int,
+    ) -> AsyncIterator[List[str]]:
+    '''
+    逐批返回key, rate为每秒最多扫描的key数, 0表示不限速. 集群模式下依次扫描每个主节点.
+    '''
+    if isinstance(conn, aio_redis_cluster.RedisCluster):
+        targets = [{"target_nodes": node} for node in conn.get_primaries()]
+    else:
+        targets = [{}]
+    for target in targets:
+        cursor = 0
+        while True:
+            st = time.monotonic()
+            cursor, keys = await conn.execute_command("SCAN", cursor, "MATCH", match, "COUNT", scan_count, **target)
+            cursor = int(cursor)
+            if len(keys) > 0:
+                yield [k.decode("utf-8", errors="replace") if isinstance(k, bytes) else k for k in keys]
+            if cursor == 0:
+                break
+            if rate > 0:
+                await asyncio.sleep(max(0.0, scan_count / rate - (time.monotonic() - st)))
+
+
+async def _migrate_batch(
+        conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+        pairs: List[Tuple[str, str]],
+        delete_legacy: bool,
+        stats: Dict[str, int],
+    ):
+    pipe = conn.pipeline(transaction=False)
+    for old_key, _ in pairs:
+        pipe.execute_command("DUMP", old_key)
+        pipe.execute_command("PTTL", old_key)
+    replies = await pipe.execute(raise_on_error=False)
+
+    restores: List[Tuple[str, str]] = []
+    pipe = conn.pipeline(transaction=False)
+    for i, (old_key, new_key) in enumerate(pairs):
+        dump, pttl = replies[2 * i], replies[2 * i + 1]
+        if isinstance(dump, Exception) or isinstance(pttl, Exception):
+            stats["failed"] += 1
+            continue
+        if dump is None or pttl == -2:
+            # 扫描期间已过期或被删除
+            continue
+        # NOTE: 不带REPLACE, 新key已存在时返回BUSYKEY错误, 不会覆盖写入方写入的新值.
+        pipe.execute_command("RESTORE", new_key, max(int(pttl), 0), dump)
+        restores.append((old_key, new_key))
+    if len(restores) == 0:
+        return
+    replies = await pipe.execute(raise_on_error=False)
+
+    deletes: List[str] = []
+    for (old_key, new_key), reply in zip(restores, replies):
+        if not isinstance(reply, Exception):
+            stats["copied"] += 1
+        elif isinstance(reply, redis_exceptions.ResponseError) and str(reply).startswith("BUSYKEY"):
+            stats["kept_new"] += 1
+        else:
+            stats["failed"] += 1
+            loguru_logger.warning(f"Failed to copy redis key:{old_key} to {new_key}, err:{reply}")
+            continue
+        deletes.append(old_key)
+    if delete_legacy and len(deletes) > 0:
+        pipe = conn.pipeline(transaction=False)
+        for old_key in deletes:
+            pipe.execute_command("DEL", old_key)
+        replies = await pipe.execute(raise_on_error=False)
+        stats["deleted"] += sum(1 for reply in replies if not isinstance(reply, Exception))
+
+
+async def migrate_legacy_keys(
+        conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+        env: str,
+        delete_legacy: bool = False,
+        dry_run: bool = False,
+        scan_count: int = 500,
+        rate: int = 2000,
+    ) -> Dict[str, Any]:
+    templates = build_templates(env)
+    stats = {"scanned": 0, "matched": 0, "copied": 0, "kept_new": 0, "deleted": 0, "failed": 0}
+    st = time.time()
+    async for keys in _scan_keys(conn, f"gcp_ags_{env}_*", scan_count, rate):
+        stats["scanned"] += len(keys)
+        pairs = [(key, tagged_key(key, templates, env)) for key in keys]
+        pairs = [(old_key, new_key) for old_key, new_key in pairs if new_key is not None]
+        stats["matched"] += len(pairs)
+        if not dry_run and len(pairs) > 0:
+            await _migrate_batch(conn, pairs, delete_legacy, stats)
+    stats["cost_secs"] = round(time.time() - st, 2)
+    return stats
+
+
+async def migrate_hash_layout(
+        conn: Union[aio_redis.Redis, aio_redis_cluster.RedisCluster],
+        env: str,
+        dry_run: bool = False,
+        scan_count: int = 500,
+        rate: int = 2000,
+    ) -> Dict[str, Any]:
+    layout = build_hash_layout(env)
+    script = conn.register_script(HASH_LAYOUT_MIGRATE_SCRIPT)
+    stats = {"scanned": 0, "matched": 0, "moved": 0, "kept_ttl": 0, "failed": 0}
+    st = time.time()
+    async for keys in _scan_keys(conn, f"gcp_ags_{env}_*", scan_count, rate):
+        stats["scanned"] += len(keys)
+        targets = [(key, hash_target(key, layout, env)) for key in keys]
+        targets = [(key, target) for key, target in targets if target is not None]
+        stats["matched"] += len(targets)
+        if dry_run or len(targets) == 0:
+            continue
+        # NOTE: string key和hash带有相同的hash tag, 同一个脚本里原子地完成搬迁, 不会与写入方交错.
+        replies = await asyncio.gather(
+            *[script(keys=[key, hash_key], args=[field]) for key, (hash_key, field) in targets],
+            return_exceptions=True,
+        )
+        for (key, _), reply in zip(targets, replies):
+            if isinstance(reply, Exception):
+                stats["failed"] += 1
+                loguru_logger.warning(f"Failed to move redis key:{key} into hash, err:{reply}")
+            elif reply == 1:
+                stats["moved"] += 1
+            elif reply == -1:
+                stats["kept_ttl"] += 1
+    stats["cost_secs"] = round(time.time() - st, 2)
+    return stats
+
+
+def _connect() -> Union[aio_redis.Redis, aio_redis_cluster.RedisCluster]:
+    endpoints = [x.strip() for x in settings.REDIS_SERVER_ENDPOINT.split(",") if len(x.strip()) > 0]
+    if settings.REDIS_CLUSTER_MODE:
+        return aio_redis_cluster.RedisCluster(
+            startup_nodes=[aio_redis_cluster.ClusterNode(x.split(":")[0], int(x.split(":")[1])) for x in endpoints],
+            password=settings.REDIS_PASSWORD,
+        )
+    host, port = endpoints[0].split(":")[0], int(endpoints[0].split(":")[1])
+    return aio_redis.Redis(host=host, port=port, password=settings.REDIS_PASSWORD, db=settings.REDIS_DB)
+
+
+async def main(args: argparse.Namespace) -> bool:
+    conn = _connect()
+    ok = False
+    try:
+        if args.hash_layout:
+            stats = await migrate_hash_layout(
+                conn,
+                env=settings.DEPLOY_ENV,
+                dry_run=args.dry_run,
+                scan_count=args.scan_count,
+                rate=args.rate,
+            )
+            loguru_logger.info(f"Migrated user/account state into hashes: {stats}.")
+        else:
+            stats = await migrate_legacy_keys(
+                conn,
+                env=settings.DEPLOY_ENV,
+                delete_legacy=args.delete_legacy,
+                dry_run=args.dry_run,
+                scan_count=args.scan_count,
+                rate=args.rate,
+            )
+            loguru_logger.info(f"Migrated legacy redis keys: {stats}.")
+        ok = stats["failed"] == 0
+    except Exception as e:
+        loguru_logger.error(f"Failed to migrate legacy redis keys, err:{e}")
+    finally:
+        await conn.aclose()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy pre-hash-tag redis keys to their hash-tagged names.")
+    parser.add_argument("--delete-legacy", action="store_true", help="delete each legacy key once it has been copied")
+    parser.add_argument("--hash-layout", action="store_true", help="move user/account string keys into their hashes")
+    parser.add_argument("--dry-run", action="store_true", help="only count the legacy keys")
+    parser.add_argument("--scan-count", type=int, default=500, help="COUNT hint for each SCAN call")
+    parser.add_argument("--rate", type=int, default=2000, help="max keys scanned per second, 0 for unlimited")
+    args = parser.parse_args()
+    ok = asyncio.run(main(args))
+    sys.exit(0 if ok else -1)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import redis.asyncio as aio_redis
+import redis.exceptions as redis_exceptions
+import socket
+import time
+
+from typing import Any, \
+    Dict
+
+# 获取连接等待时长的分桶上界 (秒)
+WAIT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0)
+
+
+def tcp_keepalive_options() -> Dict[int, int]:
+    '''
+    空闲60s后开始探测, 每10s一次, 连续3次无响应即断开. 仅设置当前平台支持的选项.
+    '''
+    options = {}
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options[socket.TCP_KEEPIDLE] = 60
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options[socket.TCP_KEEPINTVL] = 10
+    if hasattr(socket, "TCP_KEEPCNT"):
+        options[socket.TCP_KEEPCNT] = 3
+    return options
+
+
+class InstrumentedBlockingConnectionPool(aio_redis.BlockingConnectionPool):
+    '''
+    连接数有上限的连接池, 连接耗尽时请求方最多等待timeout秒, 同时统计连接的使用情况和等待时长.
+    '''
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._waiting = 0
+        self._acquired = 0
+        self._acquire_timeouts = 0
+        self._connect_errors = 0
+        self._wait_time_sum = 0.0
+        self._wait_time_max = 0.0
+        self._wait_time_buckets = [0] * (len(WAIT_TIME_BUCKETS) + 1)
+
+    async def get_connection(self, *args, **kwargs):
+        st = time.perf_counter()
+        self._waiting += 1
+        try:
+            conn = await super().get_connection(*args, **kwargs)
+        except redis_exceptions.ConnectionError as e:
+            # NOTE: 等待空闲连接超时会被包装成ConnectionError("No connection available."), 其余为建立连接失败.
+            if isinstance(e.__cause__, asyncio.TimeoutError) or "No connection available" in str(e):
+                self._acquire_timeouts += 1
+            else:
+                self._connect_errors += 1
+            raise
+        finally:
+            self._waiting -= 1
+        elapsed = time.perf_counter() - st
+        self._acquired += 1
+        self._wait_time_sum += elapsed
+        self._wait_time_max = max(self._wait_time_max, elapsed)
+        self._wait_time_buckets[bisect.bisect_left(WAIT_TIME_BUCKETS, elapsed)] += 1
+        return conn
+
+    def stats(self) -> Dict[str, Any]:
+        in_use = len(getattr(self, "_in_use_connections", ()))
+        idle = len(getattr(self, "_available_connections", ()))
+        return {
+            "max_connections": self.max_connections,
+            "in_use": in_use,
+            "idle": idle,
+            "waiting": self._waiting,
+            "acquired": self._acquired,
+            "acquire_timeouts": self._acquire_timeouts,
+            "connect_errors": self._connect_errors,
+            "wait_time_avg": self._wait_time_sum / self._acquired if self._acquired > 0 else 0.0,
+            "wait_time_max": self._wait_time_max,
+            "wait_time_buckets": {
+                **{f"le_{le}": n for le, n in zip(WAIT_TIME_BUCKETS, self._wait_time_buckets)},
+                "le_inf": self._wait_time_buckets[-1],
+            },
+        }
@@ -4,10 +4,14 @@ import ujson as json
 
 from dependencies import settings
 from internal.extensions.ext_redis import instance as cache_instance
-from internal.extensions.ext_redis.keys import CKEY_USER_DEVICE_ID, \
-    CKEY_APP_PERMISSION_RECORD, \
+from internal.extensions.ext_redis.keys import CKEY_APP_PERMISSION_RECORD, \
+    CKEY_USER_DEVICE_ID, \
     CKEY_USER_DEVICE_TYPE, \
-    CKEY_USER_JPUSH_REGISTRATION_ID
+    CKEY_USER_HASH, \
+    CKEY_USER_JPUSH_REGISTRATION_ID, \
+    HFIELD_DEVICE_ID, \
+    HFIELD_DEVICE_TYPE, \
+    HFIELD_JPUSH_REGISTRATION_ID
 from internal.infra.http_session import get_aio_session
 from loguru import logger as loguru_logger
 
@@ -28,13 +32,35 @@ async def send_jpush(uid: str, push_title: str, push_content: str = "") -> bool:
     done = False
     loguru_logger.debug("Try to send JPush for user.")
                     
-    device_id, _, ok = await cache_instance().exist_or_get_string(key=CKEY_USER_DEVICE_ID.format(
-        env=settings.DEPLOY_ENV, uid=uid
-    ))
+    if settings.REDIS_HASH_LAYOUT:
+        # NOTE: 用户状态都在同一个hash中, 一次HGETALL取回, 只有推送权限需要在拿到device_id之后再查.
+        user_state, ok = await cache_instance().get_hash_fields(
+            key=CKEY_USER_HASH.format(env=settings.DEPLOY_ENV, uid=uid),
+            fields=[HFIELD_DEVICE_ID, HFIELD_DEVICE_TYPE, HFIELD_JPUSH_REGISTRATION_ID],
+        )
+    else:
+        # NOTE: 与device_id无关的key合并到同一个pipeline中, 只有推送权限需要在拿到device_id之后再查.
+        async with cache_instance().batch() as batch:
+            device_id_res = batch.get_string(key=CKEY_USER_DEVICE_ID.format(
+                env=settings.DEPLOY_ENV, uid=uid
+            ))
+            device_type_res = batch.get_string(key=CKEY_USER_DEVICE_TYPE.format(
+                env=settings.DEPLOY_ENV, uid=uid
+            ))
+            registration_id_res = batch.get_string(key=CKEY_USER_JPUSH_REGISTRATION_ID.format(
+                env=settings.DEPLOY_ENV, uid=uid
+            ))
+        user_state = {
+            HFIELD_DEVICE_ID: device_id_res.value,
+            HFIELD_DEVICE_TYPE: device_type_res.value,
+            HFIELD_JPUSH_REGISTRATION_ID: registration_id_res.value,
+        }
+        ok = batch.done
+    device_id = user_state[HFIELD_DEVICE_ID]
     if not ok:
         loguru_logger.error("Failed to send JPush for user, since we cannot get his/her device_id.")
         return False
-    if len(device_id) == 0:
+    if device_id is None or len(device_id) == 0:
         loguru_logger.error("Failed to send JPush for user, since his/her device_id is empty.")
         return False    
     app_push_permission, _, ok = await cache_instance().exist_or_get_integer(key=CKEY_APP_PERMISSION_RECORD.format(
@@ -46,25 +72,15 @@ async def send_jpush(uid: str, push_title: str, push_content: str = "") -> bool:
     if app_push_permission == 0:
         loguru_logger.warning("No need to push for user.")
         return True
-    device_type, _, ok = await cache_instance().exist_or_get_integer(key=CKEY_USER_DEVICE_TYPE.format(
-        env=settings.DEPLOY_ENV, uid=uid
-    ))
-    if not ok:
-        loguru_logger.error("Failed to send JPush for user, since we cannot get his/her device_type.")
-        return False
+    device_type = int(user_state[HFIELD_DEVICE_TYPE]) if user_state[HFIELD_DEVICE_TYPE] is not None else None
     if device_type == 0:
         device_type_symbol = "ios"
     elif device_type == 1:
         device_type_symbol = "android"
     else:
         device_type_symbol = "ios"
-    registration_id, _, ok = await cache_instance().exist_or_get_string(key=CKEY_USER_JPUSH_REGISTRATION_ID.format(
-        env=settings.DEPLOY_ENV, uid=uid
-    ))
-    if not ok:
-        loguru_logger.error("Failed to send JPush for user, since we cannot get his/her registration_id.")
-        return False
-    if len(registration_id) == 0:
+    registration_id = user_state[HFIELD_JPUSH_REGISTRATION_ID]
+    if registration_id is None or len(registration_id) == 0:
         loguru_logger.error("Failed to send JPush for user, since his/her registration_id is empty.")
         return False   
 
@@ -6,18 +6,65 @@ import redis.asyncio as aio_redis
 import redis.exceptions as redis_exceptions
 import string
 import time
+import weakref
 
 from collections import namedtuple
+from internal.infra.redlock.metrics import LockMetrics
+from internal.infra.redlock.notify import ReleaseNotifier, \
+    RELEASE_CHANNEL_SUFFIX
 from loguru import logger as loguru_logger
-from typing import List, Optional, Tuple, Union
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
-Lock = namedtuple("Lock", ("validity", "resource", "val"))
+# fencing_token只在alock(fencing=True)时返回, 否则为None
+Lock = namedtuple("Lock", ("validity", "resource", "val", "fencing_token"), defaults=(None,))
+
+# 抢锁失败后的等待方式: poll为固定间隔重试retry_count次; backoff为带随机抖动的指数退避, 直到总期限;
+# notify在backoff的基础上订阅解锁通知, 锁一释放就立即重试.
+WAIT_MODE_POLL = "poll"
+WAIT_MODE_BACKOFF = "backoff"
+WAIT_MODE_NOTIFY = "notify"
+
+UNLOCK_SCRIPT = f"""if redis.call("get",KEYS[1]) == ARGV[1] then
+    redis.call("del",KEYS[1])
+    redis.call("publish",KEYS[1] .. "{RELEASE_CHANNEL_SUFFIX}","1")
+    return 1
+else
+    return 0
+end"""
+
+EXTEND_SCRIPT = """if redis.call("get",KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire",KEYS[1],ARGV[2])
+else
+    return 0
+end"""
+
+# fencing计数器不存在(首次使用或已过期)时以节点当前时间(微秒)为初值, 过期重建后的令牌仍然大于之前发出的令牌.
+# 需要Redis 5+(脚本按效果复制, 可以在TIME之后写入).
+FENCING_COUNTER_SUFFIX = "_fencing"
+FENCING_COUNTER_TTL = 7 * 24 * 3600 * 1000
+
+FENCING_SCRIPT = """if redis.call("exists",KEYS[1]) == 0 then
+    local t = redis.call("time")
+    redis.call("set",KEYS[1],t[1] .. string.format("%06d",tonumber(t[2])))
+end
+local v = redis.call("incr",KEYS[1])
+local floor = tonumber(ARGV[1])
+if v < floor then
+    redis.call("set",KEYS[1],ARGV[1])
+    v = floor
+end
+redis.call("pexpire",KEYS[1],ARGV[2])
+return v"""
 
 
 class CannotObtainLock(Exception):
     pass
 
 
+class LockLost(Exception):
+    pass
+
+
 class MultipleRedlockException(Exception):
     def __init__(self, errors, *args, **kwargs):
         super(MultipleRedlockException, self).__init__(*args, **kwargs)
@@ -37,11 +84,22 @@ class Redlock(object):
             connections: List[Union[redis.Redis, aio_redis.Redis]],
             async_mode: bool = True,
             retry_count: float = None,
-            retry_delay: float = None
+            retry_delay: float = None,
+            node_timeout: float = None,
+            wait_mode: str = WAIT_MODE_POLL,
+            wait_deadline: float = None,
+            pubsub_conn: Optional[aio_redis.Redis] = None,
+            local_lock: bool = False
         ):
 
+        # NOTE: 脚本注册在connections[0]上, 同步/异步客户端不能混用; 异步模式只能调用alock/aunlock/aextend.
+        for conn in connections:
+            if isinstance(conn, (redis.Redis, redis.RedisCluster)) == async_mode:
+                raise ValueError(f"Redlock in {'async' if async_mode else 'sync'} mode got a mismatched redis client:{type(conn).__name__}")
         self._async_mode = async_mode
         self._servers = connections
+        # 由from_endpoints创建的连接归Redlock所有, 需要在aclose时释放
+        self._owned_servers: List[aio_redis.Redis] = []
         self._quorum = (len(connections) // 2) + 1
         loguru_logger.debug("Redis Server Quorum:{}".format(self._quorum))
 
@@ -49,17 +107,84 @@ class Redlock(object):
         self.retry_count = retry_count or default_retry_count
         default_retry_delay = 0.2
         self.retry_delay = retry_delay or default_retry_delay
+        # 异步模式下每个专用节点的单次请求超时(秒), 慢节点按失败处理, 不会拖长整个加锁过程.
+        # NOTE: 只作用于from_endpoints创建的专用连接; 与业务共用的连接池客户端在取连接时可能排队,
+        # 中途取消会让加锁/解锁命令处于未知状态, 因此不加这层超时, 由客户端自身的socket超时兜底.
+        default_node_timeout = 0.1
+        self.node_timeout = node_timeout or default_node_timeout
+        if wait_mode not in (WAIT_MODE_POLL, WAIT_MODE_BACKOFF, WAIT_MODE_NOTIFY):
+            raise ValueError(f"Unknown redlock wait mode:{wait_mode}")
+        self.wait_mode = wait_mode
+        # backoff/notify模式下alock的默认总等待期限(秒)
+        default_wait_deadline = 2.0
+        self.wait_deadline = wait_deadline or default_wait_deadline
+        self._backoff_base = 0.01
+        self._backoff_cap = 0.5
+        self._notifier: Optional[ReleaseNotifier] = None
+        if async_mode and wait_mode == WAIT_MODE_NOTIFY:
+            # NOTE: 解锁脚本会在每个节点上发布通知, 只需订阅其中一个节点; 集群客户端不支持pub/sub, 需要单独传入连接.
+            conn = pubsub_conn if pubsub_conn is not None else connections[0]
+            if hasattr(conn, "pubsub"):
+                self._notifier = ReleaseNotifier(conn)
+            else:
+                loguru_logger.warning("Redlock notify wait mode needs a pub/sub capable connection, fallback to backoff.")
+        # NOTE: 同一进程内竞争同一资源的协程先在本地的asyncio.Lock上排队, 只有队头去Redis抢锁, 锁在进程内交接时不需要重试.
+        # 本地锁按资源名弱引用保存, 没有协程持有或等待时自动回收.
+        self._local_locks: Optional[weakref.WeakValueDictionary] = weakref.WeakValueDictionary() if async_mode and local_lock else None
+        # lock.val -> (本地锁, 到期时自动释放本地锁的定时器)
+        self._local_held: Dict[str, Tuple[asyncio.Lock, asyncio.TimerHandle]] = {}
+        self._metrics = LockMetrics()
         self._clock_drift_factor = 0.01
-        self._unlock_script = """if redis.call("get",KEYS[1]) == ARGV[1] then
-    return redis.call("del",KEYS[1])
-else
-    return 0
-end"""
-        self._extend_script = """if redis.call("get",KEYS[1]) == ARGV[1] then
-    return redis.call("pexpire",KEYS[1],ARGV[2])
-else
-    return 0
-end"""
+        # NOTE: 脚本只注册一次, 之后以EVALSHA调用, 节点上没有缓存该脚本(NOSCRIPT)时自动回退为EVAL.
+        # 所有节点的sha相同, 调用时通过client参数指定目标节点.
+        self._unlock_script = connections[0].register_script(UNLOCK_SCRIPT)
+        self._extend_script = connections[0].register_script(EXTEND_SCRIPT)
+        self._fencing_script = connections[0].register_script(FENCING_SCRIPT)
+
+    @classmethod
+    def from_endpoints(
+            cls,
+            endpoints: List[str],
+            password: str,
+            db: int = 0,
+            retry_count: float = None,
+            retry_delay: float = None,
+            node_timeout: float = None,
+            wait_mode: str = WAIT_MODE_POLL,
+            wait_deadline: float = None,
+            local_lock: bool = False
+        ) -> "Redlock":
+        """Each endpoint must be an independent redis master (not replicas of each other, not a cluster)."""
+        connections = []
+        for endpoint in endpoints:
+            host, port = endpoint.split(":")[0], int(endpoint.split(":")[1])
+            connections.append(aio_redis.Redis(
+                host=host,
+                port=port,
+                password=password,
+                db=db,
+                socket_timeout=1,
+                socket_connect_timeout=1,
+            ))
+        dlm = cls(
+            connections,
+            async_mode=True,
+            retry_count=retry_count,
+            retry_delay=retry_delay,
+            node_timeout=node_timeout,
+            wait_mode=wait_mode,
+            wait_deadline=wait_deadline,
+            local_lock=local_lock,
+        )
+        dlm._owned_servers = connections
+        return dlm
+
+    async def aclose(self):
+        if self._notifier is not None:
+            await self._notifier.close()
+        for server in self._owned_servers:
+            await server.aclose()
+        self._owned_servers = []
 
     async def _alock_instance(
             self,
@@ -72,7 +197,8 @@ end"""
             assert isinstance(ttl, int), "ttl {} is not an integer".format(ttl)
         except AssertionError as e:
             raise ValueError(str(e))
-        return await server.execute_command(f"SET {resource} {val} NX PX {ttl}") == b"OK"
+        # NOTE: 以参数列表的形式发送, 不需要再切分命令字符串, 集群客户端也能从中解析出key并路由到正确的节点.
+        return await server.execute_command("SET", resource, val, "NX", "PX", ttl) == b"OK"
 
     def _lock_instance(
             self,
@@ -85,7 +211,7 @@ end"""
             assert isinstance(ttl, int), "ttl {} is not an integer".format(ttl)
         except AssertionError as e:
             raise ValueError(str(e))
-        return server.execute_command(f"SET {resource} {val} NX PX {ttl}") == b"OK"
+        return server.execute_command("SET", resource, val, "NX", "PX", ttl) == b"OK"
 
     async def _aunlock_instance(
             self,
@@ -93,7 +219,7 @@ end"""
             resource: str,
             val: str
         ) -> bool:
-        return await server.execute_command("EVAL", self._unlock_script, 1, resource, val) == 1
+        return await self._unlock_script(keys=[resource], args=[val], client=server) == 1
 
     def _unlock_instance(
             self,
@@ -101,7 +227,7 @@ end"""
             resource: str,
             val: str
         ) -> bool:
-        return server.execute_command("EVAL", self._unlock_script, 1, resource, val) == 1
+        return self._unlock_script(keys=[resource], args=[val], client=server) == 1
 
     async def _aextend_instance(
             self,
@@ -110,7 +236,7 @@ end"""
             val: str,
             ttl: int
         ) -> bool:
-        return await server.execute_command("EVAL", self._extend_script, 1, resource, val, ttl) == 1
+        return await self._extend_script(keys=[resource], args=[val, ttl], client=server) == 1
 
     def _extend_instance(
             self,
@@ -119,16 +245,185 @@ end"""
             val: str,
             ttl: int
         ) -> bool:
-        return server.execute_command("EVAL", self._extend_script, 1, resource, val, ttl) == 1
+        return self._extend_script(keys=[resource], args=[val, ttl], client=server) == 1
+
+    async def _afencing_instance(
+            self,
+            server: aio_redis.Redis,
+            resource: str,
+            floor: int
+        ) -> int:
+        return int(await self._fencing_script(
+            keys=[f"{resource}{FENCING_COUNTER_SUFFIX}"],
+            args=[floor, FENCING_COUNTER_TTL],
+            client=server,
+        ))
+
+    async def _anext_fencing_token(self, resource: str) -> Tuple[Optional[int], List[Exception]]:
+        """
+        Increment the fencing counter of resource on all servers, the token is the max among a quorum of replies.
+
+        Any two quorums share at least one server, and lagging counters are raised to the issued token, so a later
+        holder always gets a larger token than an earlier one.
+        """
+        async def _call(server: aio_redis.Redis) -> int:
+            return await self._acall_node(server, self._afencing_instance(server, resource, 0))
+
+        results = await asyncio.gather(*[_call(server) for server in self._servers], return_exceptions=True)
+        tokens = []
+        errors = []
+        for res in results:
+            if isinstance(res, asyncio.TimeoutError):
+                errors.append(redis_exceptions.TimeoutError(f"No reply within {self.node_timeout}s"))
+            elif isinstance(res, redis_exceptions.RedisError):
+                errors.append(res)
+            elif isinstance(res, BaseException):
+                raise res
+            else:
+                tokens.append(res)
+        if len(tokens) < self._quorum:
+            return (None, errors)
+        token = max(tokens)
+        if len(tokens) < len(self._servers) or min(tokens) < token:
+            async def _raise(server: aio_redis.Redis) -> bool:
+                await self._afencing_instance(server, resource, token)
+                return True
+
+            _, raise_errors = await self._afan_out(_raise)
+            errors.extend(raise_errors)
+        return (token, errors)
+
+    async def _acall_node(self, server: aio_redis.Redis, aw: Awaitable[Any]) -> Any:
+        if server not in self._owned_servers:
+            return await aw
+        return await asyncio.wait_for(aw, timeout=self.node_timeout)
+
+    async def _afan_out(self, fn: Callable[..., Awaitable[bool]], *args) -> Tuple[int, List[Exception]]:
+        """Run fn(server, *args) on all servers concurrently, return (number of successes, errors)."""
+        async def _call(server: aio_redis.Redis) -> bool:
+            return await self._acall_node(server, fn(server, *args))
+
+        results = await asyncio.gather(*[_call(server) for server in self._servers], return_exceptions=True)
+        n = 0
+        errors = []
+        for res in results:
+            if isinstance(res, asyncio.TimeoutError):
+                errors.append(redis_exceptions.TimeoutError(f"No reply within {self.node_timeout}s"))
+            elif isinstance(res, redis_exceptions.RedisError):
+                errors.append(res)
+            elif isinstance(res, BaseException):
+                raise res
+            elif res:
+                n += 1
+        return (n, errors)
 
     def _get_unique_id(self) -> str:
         CHARACTERS = string.ascii_letters + string.digits
-        return "".join([random.choice(CHARACTERS) for _ in range(22)])
+        return "".join(random.choices(CHARACTERS, k=22))
 
-    async def alock(self, resource: str, ttl: int) -> Tuple[bool, Optional[Lock]]:
-        """To acquire a lock. Param ttl should be milliseconds."""
+    def _backoff(self, retry: int) -> float:
+        """Full jitter exponential backoff."""
+        return random.uniform(0, min(self._backoff_cap, self._backoff_base * (2 ** retry)))
+
+    async def alock(
+            self,
+            resource: str,
+            ttl: int,
+            deadline: float = None,
+            fencing: bool = False
+        ) -> Tuple[bool, Optional[Lock]]:
+        """
+        To acquire a lock. Param ttl should be milliseconds.
+
+        With fencing, the returned lock also carries a fencing token that increases with every acquisition of the
+        resource. Pass it to the guarded write so the storage can reject writes from a holder whose lock expired.
+
+        Param deadline is the overall seconds to keep retrying. In poll mode without deadline, give up after
+        retry_count attempts spaced retry_delay apart; otherwise retry with jittered backoff (and wake on release
+        notifications in notify mode) until the deadline, which defaults to wait_deadline.
+        """
+        st = time.monotonic()
+        ok, lock = await self._alock_local(resource, ttl, deadline, fencing)
+        self._metrics.on_acquire(resource, time.monotonic() - st, ok)
+        if ok:
+            self._metrics.on_held(lock.val, resource, ttl, lock.fencing_token)
+        return (ok, lock)
+
+    async def _alock_local(
+            self,
+            resource: str,
+            ttl: int,
+            deadline: Optional[float],
+            fencing: bool
+        ) -> Tuple[bool, Optional[Lock]]:
+        if deadline is None and self.wait_mode != WAIT_MODE_POLL:
+            deadline = self.wait_deadline
+        if self._local_locks is None:
+            return await self._alock_remote(resource, ttl, deadline, fencing)
+
+        local = self._local_locks.get(resource)
+        if local is None:
+            local = asyncio.Lock()
+            self._local_locks[resource] = local
+        # 本地排队与Redis重试共用同一个等待期限; poll模式没有期限时按重试总时长计
+        local_timeout = deadline if deadline is not None else self.retry_count * self.retry_delay
+        st = time.monotonic()
+        if not await self._acquire_local(local, local_timeout):
+            return (False, None)
+        try:
+            if deadline is not None:
+                deadline = max(0.0, deadline - (time.monotonic() - st))
+            ok, lock = await self._alock_remote(resource, ttl, deadline, fencing)
+        except BaseException:
+            local.release()
+            raise
+        if not ok:
+            local.release()
+            return (False, None)
+        handle = asyncio.get_event_loop().call_later(lock.validity / 1000, self._release_local, lock.val)
+        self._local_held[lock.val] = (local, handle)
+        return (True, lock)
+
+    async def _acquire_local(self, local: asyncio.Lock, timeout: float) -> bool:
+        # NOTE: Python 3.12之前wait_for超时与授予同时发生时会丢掉已经拿到的锁, 这里显式取消并检查结果.
+        acquire = asyncio.ensure_future(local.acquire())
+        try:
+            await asyncio.wait([acquire], timeout=timeout)
+        except asyncio.CancelledError:
+            await self._abandon_local_acquire(local, acquire)
+            raise
+        if acquire.done():
+            return True
+        await self._abandon_local_acquire(local, acquire)
+        return False
+
+    @staticmethod
+    async def _abandon_local_acquire(local: asyncio.Lock, acquire: asyncio.Future):
+        acquire.cancel()
+        await asyncio.wait([acquire])
+        if not acquire.cancelled():
+            # 取消之前已经拿到了锁, 归还给下一个等待者
+            local.release()
+
+    def _release_local(self, val: str):
+        held = self._local_held.pop(val, None)
+        if held is None:
+            return
+        local, handle = held
+        handle.cancel()
+        if local.locked():
+            local.release()
+
+    async def _alock_remote(
+            self,
+            resource: str,
+            ttl: int,
+            deadline: Optional[float],
+            fencing: bool
+        ) -> Tuple[bool, Optional[Lock]]:
         retry = 0
         val = self._get_unique_id()
+        give_up_at = time.monotonic() + deadline if deadline is not None else None
 
         # Add 2 milliseconds to the drift to account for Redis expires
         # precision, which is 1 millisecond, plus 1 millisecond min
@@ -141,36 +436,53 @@ end"""
             n = 0
             del redis_errors[:]
 
-            st = int(time.time() * 1000)
-            for server in self._servers:
-                try:
-                    ok = await self._alock_instance(server, resource, val, ttl)
-                    if ok:
-                        n += 1
-                except redis_exceptions.RedisError as e:
-                    redis_errors.append(e)
-            ed = int(time.time() * 1000)
-            elapsed_time = ed - st
-            
+            # NOTE: 所有节点并发加锁, 耗时约等于最慢节点的一次往返, 而不是所有节点往返之和.
+            st = time.monotonic()
+            n, errors = await self._afan_out(self._alock_instance, resource, val, ttl)
+            redis_errors.extend(errors)
+            token = None
+            if fencing and n >= self._quorum:
+                token, errors = await self._anext_fencing_token(resource)
+                redis_errors.extend(errors)
+                if token is None:
+                    n = 0
+            elapsed_time = int((time.monotonic() - st) * 1000)
+
             validity = int(ttl - elapsed_time - drift)
             if validity > 0 and n >= self._quorum:
                 if len(redis_errors) > 0:
                     loguru_logger.error(f"Redlock Lock Error:{MultipleRedlockException(redis_errors)}")
-                return (True, Lock(validity, resource, val))
+                return (True, Lock(validity, resource, val, token))
             else:
-                for server in self._servers:
-                    try:
-                        await self._aunlock_instance(server, resource, val)
-                    except:
-                        pass
+                try:
+                    await self._afan_out(self._aunlock_instance, resource, val)
+                except Exception:
+                    pass
                 retry += 1
-                restart_attempt = retry < self.retry_count
-                if restart_attempt:
-                    await asyncio.sleep(self.retry_delay)
+                self._metrics.on_retry(resource)
+                if give_up_at is None:
+                    restart_attempt = retry < self.retry_count
+                    if restart_attempt:
+                        await asyncio.sleep(self.retry_delay)
+                else:
+                    remaining = give_up_at - time.monotonic()
+                    restart_attempt = remaining > 0
+                    if restart_attempt:
+                        if self._notifier is not None:
+                            # NOTE: 解锁通知会提前唤醒, 等待上限取不带抖动的退避时间; 订阅前错过的通知最多多等这么久.
+                            delay = min(remaining, self._backoff_cap, self._backoff_base * (2 ** retry))
+                            await self._notifier.wait(resource, delay)
+                        else:
+                            await asyncio.sleep(min(remaining, self._backoff(retry)))
         return (False, None)
 
+    def _require_sync_mode(self):
+        if self._async_mode:
+            raise RuntimeError("Redlock is in async mode, use alock/aunlock/aextend instead.")
+
     def lock(self, resource: str, ttl: int) -> Tuple[bool, Optional[Lock]]:
         """To acquire a lock. Param ttl should be milliseconds."""
+        self._require_sync_mode()
         retry = 0
         val = self._get_unique_id()
 
@@ -215,12 +527,12 @@ end"""
 
     async def aunlock(self, lock: Lock) -> bool:
         """To release a lock you already own"""
-        redis_errors = []
-        for server in self._servers:
-            try:
-                await self._aunlock_instance(server, lock.resource, lock.val)
-            except redis_exceptions.RedisError as e:
-                redis_errors.append(e)
+        try:
+            _, redis_errors = await self._afan_out(self._aunlock_instance, lock.resource, lock.val)
+        finally:
+            # NOTE: Redis上的锁释放之后再唤醒本地的下一个等待者, 避免它抢到仍被占用的锁.
+            self._release_local(lock.val)
+            self._metrics.on_released(lock.val)
         if len(redis_errors) > 0:
             loguru_logger.error(f"Redlock Unlock Error:{MultipleRedlockException(redis_errors)}")
             return False
@@ -228,6 +540,7 @@ end"""
 
     def unlock(self, lock: Lock) -> bool:
         """To release a lock you already own"""
+        self._require_sync_mode()
         redis_errors = []
         for server in self._servers:
             try:
@@ -241,21 +554,21 @@ end"""
 
     async def aextend(self, lock: Lock, ttl: int) -> bool:
         """To extend your ownership of a lock you already own. Param ttl should be milliseconds."""
-        redis_errors = []
-        n = 0
-        for server in self._servers:
-            try:
-                ok = await self._aextend_instance(server, lock.resource, lock.val, ttl)
-                if ok:
-                    n += 1
-            except redis_exceptions.RedisError as e:
-                redis_errors.append(e)
+        n, redis_errors = await self._afan_out(self._aextend_instance, lock.resource, lock.val, ttl)
         if len(redis_errors) > 0:
             loguru_logger.error(f"Redlock Extend Error:{MultipleRedlockException(redis_errors)}")
-        return n >= self._quorum
+        ok = n >= self._quorum
+        self._metrics.on_extend(lock.val, lock.resource, ttl, ok)
+        held = self._local_held.get(lock.val)
+        if ok and held is not None:
+            local, handle = held
+            handle.cancel()
+            self._local_held[lock.val] = (local, asyncio.get_event_loop().call_later(ttl / 1000, self._release_local, lock.val))
+        return ok
 
     def extend(self, lock: Lock, ttl: int) -> bool:
         """To extend your ownership of a lock you already own. Param ttl should be milliseconds."""
+        self._require_sync_mode()
         redis_errors = []
         n = 0
         for server in self._servers:
@@ -269,12 +582,136 @@ end"""
             loguru_logger.error(f"Redlock Extend Error:{MultipleRedlockException(redis_errors)}")
         return n >= self._quorum
 
+    def metrics_stats(self) -> Dict[str, Any]:
+        return self._metrics.stats()
+
+    def held_locks(self) -> List[Dict[str, Any]]:
+        """Locks currently held by this process, longest held first."""
+        return self._metrics.held_locks()
+
+    def hold(self, resource: str, ttl: int, renew_ratio: float = 1 / 3, fencing: bool = False) -> "LockHolder":
+        """
+        Hold a lock for the duration of an async with block. Param ttl should be milliseconds.
+
+            async with redlock.hold(resource, ttl=3000) as lock:
+                ...
+
+        Raises CannotObtainLock on enter if the lock cannot be acquired, and LockLost if the lock is lost mid-block.
+        """
+        return LockHolder(self, resource, ttl, renew_ratio, fencing)
+
+
+class LockHolder(object):
+    """
+    Async context manager returned by Redlock.hold.
+
+    A watchdog task extends the lock every ttl * renew_ratio milliseconds. If the lock cannot be extended before it
+    expires, the block is cancelled and LockLost is raised in its place. The lock is always released on exit.
+    """
+
+    def __init__(self, dlm: Redlock, resource: str, ttl: int, renew_ratio: float, fencing: bool = False) -> None:
+        self._dlm = dlm
+        self._resource = resource
+        self._ttl = ttl
+        self._fencing = fencing
+        self._renew_interval = ttl * renew_ratio / 1000
+        self._lock: Optional[Lock] = None
+        self._owner: Optional[asyncio.Task] = None
+        self._watchdog: Optional[asyncio.Task] = None
+        self._lost = False
+
+    @property
+    def lost(self) -> bool:
+        return self._lost
+
+    async def _watch(self):
+        expires_at = time.monotonic() + self._lock.validity / 1000
+        while True:
+            await asyncio.sleep(self._renew_interval)
+            # NOTE: 续期失败时在锁真正过期之前快速重试, 偶发的网络抖动不至于直接丢锁.
+            while True:
+                st = time.monotonic()
+                if await self._dlm.aextend(self._lock, self._ttl):
+                    expires_at = st + self._ttl / 1000
+                    break
+                if time.monotonic() + self._dlm.retry_delay >= expires_at:
+                    self._lost = True
+                    self._dlm._metrics.on_lost(self._resource)
+                    loguru_logger.error(f"Redlock lost lock on resource:{self._resource}.")
+                    self._owner.cancel()
+                    return
+                await asyncio.sleep(self._dlm.retry_delay)
+
+    async def __aenter__(self) -> Lock:
+        ok, self._lock = await self._dlm.alock(self._resource, self._ttl, fencing=self._fencing)
+        if not ok:
+            raise CannotObtainLock(f"Cannot obtain lock on resource:{self._resource}")
+        self._owner = asyncio.current_task()
+        self._watchdog = asyncio.get_event_loop().create_task(self._watch())
+        return self._lock
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> bool:
+        self._watchdog.cancel()
+        # NOTE: 释放锁放在shield中, 即使当前任务在此期间被取消也会执行完, 否则其他请求要等到锁自然过期.
+        try:
+            await asyncio.wait([self._watchdog])
+            await asyncio.shield(self._dlm.aunlock(self._lock))
+        except asyncio.CancelledError:
+            # 看门狗发起的取消可能在块已经结束之后才送达
+            if not self._lost:
+                raise
+            exc_type = asyncio.CancelledError
+        except Exception as e:
+            loguru_logger.error(f"Redlock failed to release lock on resource:{self._resource}, err:{e}")
+        if self._lost and exc_type is asyncio.CancelledError:
+            # 由看门狗发起的取消转换为LockLost, 外部发起的取消照常向上传播
+            if hasattr(self._owner, "uncancel"):
+                self._owner.uncancel()
+            raise LockLost(f"Lost lock on resource:{self._resource}") from exc_value
+        return False
+
+
 _instance: Redlock = None
 
 
-def init_instance(connections: List[aio_redis.Redis], retry_count: float = None, retry_delay: float = None):
+def init_instance(
+        connections: Optional[List[aio_redis.Redis]] = None,
+        endpoints: Optional[List[str]] = None,
+        password: str = "",
+        db: int = 0,
+        retry_count: float = None,
+        retry_delay: float = None,
+        node_timeout: float = None,
+        wait_mode: str = WAIT_MODE_POLL,
+        wait_deadline: float = None,
+        pubsub_conn: Optional[aio_redis.Redis] = None,
+        local_lock: bool = False
+    ):
     global _instance
-    _instance = Redlock(connections, retry_count, retry_delay)
+    if endpoints:
+        _instance = Redlock.from_endpoints(
+            endpoints,
+            password,
+            db,
+            retry_count=retry_count,
+            retry_delay=retry_delay,
+            node_timeout=node_timeout,
+            wait_mode=wait_mode,
+            wait_deadline=wait_deadline,
+            local_lock=local_lock,
+        )
+    else:
+        _instance = Redlock(
+            connections,
+            async_mode=True,
+            retry_count=retry_count,
+            retry_delay=retry_delay,
+            node_timeout=node_timeout,
+            wait_mode=wait_mode,
+            wait_deadline=wait_deadline,
+            pubsub_conn=pubsub_conn,
+            local_lock=local_lock,
+        )
 
 
 def instance() -> Redlock:
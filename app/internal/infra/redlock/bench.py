@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+对比两种Redlock单节点调用方式的耗时:
+
+- legacy: 加锁命令为整条字符串(由客户端切分), 解锁每次都以EVAL发送完整的Lua脚本.
+- current: 加锁命令为参数列表, 解锁以EVALSHA调用预先注册的脚本.
+
+使用说明 (在app目录下执行, 连接settings中配置的Redis):
+
+    python -m internal.infra.redlock.bench --rounds 5000
+'''
+import argparse
+import asyncio
+import redis.asyncio as aio_redis
+import sys
+import time
+
+from dependencies import settings
+from internal.infra.redlock import Redlock, \
+    UNLOCK_SCRIPT
+from loguru import logger as loguru_logger
+from typing import Awaitable, \
+    Callable
+
+
+async def _legacy_cycle(server: aio_redis.Redis, resource: str, val: str, ttl: int):
+    await server.execute_command(f"SET {resource} {val} NX PX {ttl}")
+    await server.execute_command("EVAL", UNLOCK_SCRIPT, 1, resource, val)
+
+
+def _current_cycle(dlm: Redlock) -> Callable[[aio_redis.Redis, str, str, int], Awaitable[None]]:
+    async def _cycle(server: aio_redis.Redis, resource: str, val: str, ttl: int):
+        await dlm._alock_instance(server, resource, val, ttl)
+        await dlm._aunlock_instance(server, resource, val)
+    return _cycle
+
+
+async def _run(
+        name: str,
+        cycle: Callable[[aio_redis.Redis, str, str, int], Awaitable[None]],
+        server: aio_redis.Redis,
+        rounds: int,
+    ) -> float:
+    # 预热连接和脚本缓存
+    for i in range(10):
+        await cycle(server, "redlock_bench_warm_up", "v", 1000)
+    st = time.perf_counter()
+    for i in range(rounds):
+        await cycle(server, f"redlock_bench_{i % 64}", f"v{i}", 1000)
+    per_cycle = (time.perf_counter() - st) / rounds
+    print(f"{name:<8} {per_cycle * 1e6:>8.1f}us per lock+unlock, {rounds} rounds")
+    return per_cycle
+
+
+async def main(rounds: int) -> bool:
+    host, port = settings.REDIS_SERVER_ENDPOINT.split(",")[0].split(":")
+    server = aio_redis.Redis(host=host, port=int(port), password=settings.REDIS_PASSWORD, db=settings.REDIS_DB)
+    ok = False
+    try:
+        dlm = Redlock([server])
+        legacy = await _run("legacy", _legacy_cycle, server, rounds)
+        current = await _run("current", _current_cycle(dlm), server, rounds)
+        print(f"saving   {(legacy - current) * 1e6:>8.1f}us per lock+unlock ({(1 - current / legacy) * 100:.1f}%)")
+        print(f"script   {len(UNLOCK_SCRIPT.encode('utf-8'))}B lua source vs 40B sha per unlock")
+        ok = True
+    except Exception as e:
+        loguru_logger.error(f"Failed to run redlock benchmark, err:{e}")
+    finally:
+        await server.aclose()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark redlock single node lock/unlock round trips.")
+    parser.add_argument("--rounds", type=int, default=5000, help="lock+unlock cycles per variant")
+    args = parser.parse_args()
+    ok = asyncio.run(main(args.rounds))
+    sys.exit(0 if ok else -1)
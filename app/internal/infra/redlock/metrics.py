@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+from collections import defaultdict
+from internal.extensions.ext_redis.metrics import LatencyHistogram, \
+    MAX_FAMILIES, \
+    OTHER_FAMILY, \
+    key_family
+from typing import Any, \
+    Dict, \
+    List, \
+    Optional
+
+# 已过期却没有解锁的持有记录超过该数量时顺带清理一次
+_PRUNE_HELD_THRESHOLD = 1024
+
+
+class _FamilyLockStats(object):
+
+    __slots__ = ("acquire", "hold", "retries", "failures", "extends", "extend_failures", "expired", "lost")
+
+    def __init__(self) -> None:
+        self.acquire = LatencyHistogram()
+        self.hold = LatencyHistogram()
+        self.retries = 0
+        self.failures = 0
+        self.extends = 0
+        self.extend_failures = 0
+        # 没有解锁, 等到过期才释放的次数
+        self.expired = 0
+        # LockHolder续期失败丢锁的次数
+        self.lost = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "acquire": self.acquire.to_dict(),
+            "hold": self.hold.to_dict(),
+            "retries": self.retries,
+            "failures": self.failures,
+            "extends": self.extends,
+            "extend_failures": self.extend_failures,
+            "expired": self.expired,
+            "lost": self.lost,
+        }
+
+
+class _HeldLock(object):
+
+    __slots__ = ("resource", "fencing_token", "owner", "acquired_at", "acquired_mono", "expires_mono", "extends")
+
+    def __init__(self, resource: str, fencing_token: Optional[int], owner: str, ttl: int) -> None:
+        self.resource = resource
+        self.fencing_token = fencing_token
+        self.owner = owner
+        self.acquired_at = int(time.time())
+        self.acquired_mono = time.monotonic()
+        self.expires_mono = self.acquired_mono + ttl / 1000
+        self.extends = 0
+
+
+class LockMetrics(object):
+    '''
+    Redlock的竞争指标, 按资源类别(例如room_#_game_queue_lock)统计抢锁耗时、重试、失败、持有时长和续期次数,
+    并记录本进程当前持有的锁.
+    '''
+
+    def __init__(self) -> None:
+        self._by_family: Dict[str, _FamilyLockStats] = defaultdict(_FamilyLockStats)
+        # lock.val -> 持有记录
+        self._held: Dict[str, _HeldLock] = {}
+
+    def _family(self, resource: str) -> _FamilyLockStats:
+        family = key_family(resource)
+        if family not in self._by_family and len(self._by_family) >= MAX_FAMILIES:
+            family = OTHER_FAMILY
+        return self._by_family[family]
+
+    def on_retry(self, resource: str):
+        self._family(resource).retries += 1
+
+    def on_acquire(self, resource: str, elapsed: float, ok: bool):
+        stats = self._family(resource)
+        stats.acquire.observe(elapsed, error=not ok)
+        if not ok:
+            stats.failures += 1
+
+    def on_held(self, val: str, resource: str, ttl: int, fencing_token: Optional[int] = None):
+        if len(self._held) >= _PRUNE_HELD_THRESHOLD:
+            self._prune()
+        task = asyncio.current_task()
+        owner = task.get_name() if task is not None else ""
+        self._held[val] = _HeldLock(resource, fencing_token, owner, ttl)
+
+    def on_released(self, val: str):
+        held = self._held.pop(val, None)
+        if held is None:
+            return
+        self._family(held.resource).hold.observe(time.monotonic() - held.acquired_mono)
+
+    def on_extend(self, val: str, resource: str, ttl: int, ok: bool):
+        stats = self._family(resource)
+        if not ok:
+            stats.extend_failures += 1
+            return
+        stats.extends += 1
+        held = self._held.get(val)
+        if held is not None:
+            held.extends += 1
+            held.expires_mono = time.monotonic() + ttl / 1000
+
+    def on_lost(self, resource: str):
+        self._family(resource).lost += 1
+
+    def _prune(self):
+        now = time.monotonic()
+        for val in [val for val, held in self._held.items() if held.expires_mono <= now]:
+            held = self._held.pop(val)
+            stats = self._family(held.resource)
+            stats.expired += 1
+            stats.hold.observe(held.expires_mono - held.acquired_mono)
+
+    def held_locks(self) -> List[Dict[str, Any]]:
+        '''
+        返回本进程当前持有的锁, 持有时间最长的排在前面.
+        '''
+        self._prune()
+        now = time.monotonic()
+        items = sorted(self._held.values(), key=lambda x: x.acquired_mono)
+        return [
+            {
+                "resource": x.resource,
+                "family": key_family(x.resource),
+                "owner": x.owner,
+                "fencing_token": x.fencing_token,
+                "acquired_at": x.acquired_at,
+                "held_secs": round(now - x.acquired_mono, 3),
+                "expires_in_secs": round(x.expires_mono - now, 3),
+                "extends": x.extends,
+            }
+            for x in items
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune()
+        return {
+            "held": len(self._held),
+            "families": {family: x.to_dict() for family, x in self._by_family.items()},
+        }
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import redis.asyncio as aio_redis
+
+from loguru import logger as loguru_logger
+from typing import Dict, \
+    Optional, \
+    Set
+
+# 解锁脚本删除锁之后在该频道上发布通知
+RELEASE_CHANNEL_SUFFIX = "_released"
+
+
+def release_channel(resource: str) -> str:
+    return f"{resource}{RELEASE_CHANNEL_SUFFIX}"
+
+
+class ReleaseNotifier(object):
+    """
+    Wake lock waiters as soon as the holder releases the lock.
+
+    All waiters share one pub/sub connection; a resource's channel is subscribed while it has at least one waiter,
+    and stays subscribed for idle_grace seconds after the last waiter leaves so hot locks skip SUBSCRIBE/UNSUBSCRIBE.
+    A release that happens between a failed attempt and the subscription is missed, so waiters must always bound
+    their wait with a backoff delay and then retry.
+    """
+
+    def __init__(self, conn: aio_redis.Redis, idle_grace: float = 5.0) -> None:
+        self._conn = conn
+        self._pubsub = None
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        # 仍处于订阅状态但已没有等待方的频道 -> 最后一个等待方离开的时间
+        self._idle: Dict[str, float] = {}
+        self._idle_grace = idle_grace
+        # 有频道处于订阅状态时置位, 读取任务空闲时等待该事件, 不轮询
+        self._subscribed = asyncio.Event()
+        self._reader_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def _ensure_reader(self):
+        if self._reader_task is None or self._reader_task.done():
+            self._pubsub = self._conn.pubsub(ignore_subscribe_messages=True)
+            self._reader_task = asyncio.get_event_loop().create_task(self._read())
+
+    async def _read(self):
+        try:
+            while True:
+                if not self._pubsub.subscribed:
+                    self._subscribed.clear()
+                    await self._subscribed.wait()
+                    continue
+                msg = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if msg is not None:
+                    channel = msg["channel"].decode("utf-8") if isinstance(msg["channel"], bytes) else msg["channel"]
+                    for fut in self._waiters.get(channel, ()):
+                        if not fut.done():
+                            fut.set_result(True)
+                await self._unsubscribe_idle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 连接中断期间的等待方会退化为按退避时间重试, 下一次wait时重建连接
+            loguru_logger.warning(f"Redlock release notifier interrupted, err:{e}.")
+            for futs in self._waiters.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_result(False)
+            self._waiters.clear()
+            self._idle.clear()
+            await self._close_pubsub()
+
+    async def _unsubscribe_idle(self):
+        now = asyncio.get_event_loop().time()
+        if all(now - ts < self._idle_grace for ts in self._idle.values()):
+            return
+        async with self._lock:
+            # 等锁期间频道可能又有了等待方, 在锁内重新检查
+            expired = [channel for channel, ts in self._idle.items() if now - ts >= self._idle_grace]
+            for channel in expired:
+                del self._idle[channel]
+            if len(expired) > 0:
+                await self._pubsub.unsubscribe(*expired)
+
+    async def _close_pubsub(self):
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = None
+
+    async def wait(self, resource: str, timeout: float) -> bool:
+        """Wait until resource is released or timeout seconds elapse, return True if woken by a release."""
+        channel = release_channel(resource)
+        fut = asyncio.get_event_loop().create_future()
+        try:
+            async with self._lock:
+                await self._ensure_reader()
+                if channel not in self._waiters:
+                    if self._idle.pop(channel, None) is None:
+                        await self._pubsub.subscribe(channel)
+                    self._waiters[channel] = set()
+                    self._subscribed.set()
+                self._waiters[channel].add(fut)
+        except Exception as e:
+            loguru_logger.warning(f"Redlock failed to subscribe release channel:{channel}, err:{e}.")
+            await asyncio.sleep(timeout)
+            return False
+        try:
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            async with self._lock:
+                futs = self._waiters.get(channel)
+                if futs is not None:
+                    futs.discard(fut)
+                    if len(futs) == 0:
+                        # 频道保持订阅到idle_grace之后, 由读取任务退订
+                        del self._waiters[channel]
+                        if self._pubsub is not None:
+                            self._idle[channel] = asyncio.get_event_loop().time()
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self._idle.clear()
+        await self._close_pubsub()
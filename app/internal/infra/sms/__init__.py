@@ -51,8 +51,8 @@ async def send_short_message(phone_number: str) -> Tuple[int, bool]:
                 data = json.loads(response_body)
                 if "error" not in data:
                     msg_id = data["msg_id"]
-                    done = await cache_instance().cache_string(
-                        key=phone_number, value=json.dumps({"msg_id": msg_id, "expired": int(time.time())}))
+                    done = await cache_instance().cache_obj(
+                        key=phone_number, value={"msg_id": msg_id, "expired": int(time.time())})
                 else:
                     if data["error"]["message"] == "invalid mobile":
                         invalid_mobile = True
@@ -81,12 +81,11 @@ async def verify_short_message(phone_number: str, code: str) -> Tuple[bool, bool
     is_valid = False
     done = False
 
-    value, existed, _ = await cache_instance().exist_or_get_string(key=phone_number)
+    msg_data, existed, _ = await cache_instance().get_obj(key=phone_number)
     if not existed:
         done = True
         loguru_logger.error(f"Failed SM verify, phone_number:{phone_number} has not appeared.")
         return (is_valid, done)
-    msg_data = json.loads(value)
     msg_id, ts = msg_data["msg_id"], msg_data["expired"]
     if int(time.time()) - ts > settings.SM_PERIOD_OF_VALIDITY:
         done = True